@@ -14,6 +14,7 @@ from .models.imagery.annotation import (
 )
 from .models.imagery.base import (
     BandMetaEntry,
+    ChipArchive,
     ConvertedImageFile,
     ImageEntry,
     ImageFile,
@@ -69,10 +70,26 @@ class KWCOCOArchiveAdmin(OSMGeoAdmin):
         'id',
         'name',
         'status',
+        'progress',
         'modified',
         'created',
     )
-    readonly_fields = ('image_set',) + TASK_EVENT_READONLY
+    readonly_fields = ('image_set', 'progress') + TASK_EVENT_READONLY
+    actions = (actions.reprocess,)
+
+
+@admin.register(ChipArchive)
+class ChipArchiveAdmin(OSMGeoAdmin):
+    list_display = (
+        'id',
+        'image_set',
+        'label',
+        'status',
+        'count',
+        'modified',
+        'created',
+    )
+    readonly_fields = ('shards', 'index_file', 'count') + TASK_EVENT_READONLY
     actions = (actions.reprocess,)
 
 
@@ -139,6 +156,8 @@ class ImageEntryAdmin(OSMGeoAdmin):
         'height',
         'width',
         'driver',
+        'is_cog',
+        'cog_errors',
         'modified',
         'created',
     )
@@ -258,11 +277,17 @@ class ConvertedImageFileAdmin(OSMGeoAdmin):
     list_display = (
         'id',
         'source_image',
+        'profile',
         'status',
         'modified',
         'created',
     )
-    readonly_fields = ('converted_file',) + TASK_EVENT_READONLY
+    readonly_fields = (
+        'converted_file',
+        'is_source_alias',
+        'conversion_time',
+        'size_ratio',
+    ) + TASK_EVENT_READONLY
     actions = (actions.reprocess,)
 
 
@@ -295,8 +320,10 @@ class GeometryEntryInline(admin.StackedInline):
         'modified',
         'created',
         'geometry_archive',
+        'layer',
     )
     modifiable = False  # To still show the footprint and outline
+    extra = 0
 
 
 @admin.register(GeometryArchive)
@@ -1,12 +1,27 @@
-from django.http import HttpResponseRedirect
+import json
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import get_object_or_404  # , render
 from drf_yasg.utils import swagger_auto_schema
+from rest_framework import serializers as rfserializers
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 
-from rgd.geodata import models
+from rgd.geodata import models, serializers
+from rgd.geodata.models.imagery.export import iter_kwcoco_json
+from rgd.geodata.models.imagery.subsample import (
+    encode_subsample,
+    get_subsample_window,
+    open_pooled_dataset,
+    read_subsample,
+)
 from rgd.geodata.permissions import check_read_perm
 
+SampleTypes = models.imagery.SubsampledImage.SampleTypes
+
 
 @swagger_auto_schema(
     method='GET',
@@ -44,6 +59,116 @@ def download_cog_file(request, pk):
     return HttpResponseRedirect(instance.get_url())
 
 
+@swagger_auto_schema(
+    method='GET',
+    operation_summary='Download the KWCOCO JSON spec of an ImageSet and its annotations.',
+)
+@api_view(['GET'])
+def download_image_set_kwcoco(request, pk):
+    """Stream the ImageSet as KWCOCO JSON without loading it into memory."""
+    instance = get_object_or_404(models.imagery.ImageSet, pk=pk)
+    check_read_perm(request.user, instance)
+    response = StreamingHttpResponse(iter_kwcoco_json(instance), content_type='application/json')
+    response['Content-Disposition'] = f'attachment; filename="image_set_{pk}.kwcoco.json"'
+    return response
+
+
+class SubsampleWindowSerializer(rfserializers.Serializer):
+    sample_type = rfserializers.ChoiceField(
+        choices=[SampleTypes.PIXEL_BOX, SampleTypes.GEO_BOX, SampleTypes.GEOJSON],
+        default=SampleTypes.PIXEL_BOX,
+    )
+    umin = rfserializers.FloatField(required=False, help_text='Pixel box minimum column.')
+    umax = rfserializers.FloatField(required=False, help_text='Pixel box maximum column.')
+    vmin = rfserializers.FloatField(required=False, help_text='Pixel box minimum row.')
+    vmax = rfserializers.FloatField(required=False, help_text='Pixel box maximum row.')
+    xmin = rfserializers.FloatField(required=False, help_text='Geographic box minimum x.')
+    xmax = rfserializers.FloatField(required=False, help_text='Geographic box maximum x.')
+    ymin = rfserializers.FloatField(required=False, help_text='Geographic box minimum y.')
+    ymax = rfserializers.FloatField(required=False, help_text='Geographic box maximum y.')
+    geojson = rfserializers.JSONField(
+        required=False, help_text='A GeoJSON geometry in the coordinates of the image.'
+    )
+    format = rfserializers.ChoiceField(choices=['tif', 'png', 'npy'], default='tif')
+
+    def validate(self, data):
+        keys = {
+            SampleTypes.PIXEL_BOX: ['umin', 'umax', 'vmin', 'vmax'],
+            SampleTypes.GEO_BOX: ['xmin', 'xmax', 'ymin', 'ymax'],
+            SampleTypes.GEOJSON: ['geojson'],
+        }[data['sample_type']]
+        missing = [key for key in keys if key not in data]
+        if missing:
+            raise ValidationError(f'Missing parameters for {data["sample_type"]}: {missing}')
+        if data['sample_type'] == SampleTypes.GEOJSON:
+            data['sample_parameters'] = data['geojson']
+        else:
+            data['sample_parameters'] = {key: data[key] for key in keys}
+        return data
+
+
+def _create_subsampled_image(request, pk, sample_type, sample_parameters):
+    serializer = serializers.SubsampledImageSerializer(
+        data={
+            'source_image': pk,
+            'sample_type': sample_type,
+            'sample_parameters': sample_parameters,
+        },
+        # Reading the image is enough to get a subsample of it
+        context={'request': request, 'read_only_source': True},
+    )
+    serializer.is_valid(raise_exception=True)
+    return serializer.save()
+
+
+@swagger_auto_schema(
+    method='GET',
+    operation_summary='Read a small subsample of an ImageEntry directly.',
+    operation_description=(
+        'Read a pixel box, geographic box or GeoJSON window of the image and return it as '
+        'GeoTIFF, PNG or NPY bytes. Windows larger than the size cap are redirected to an '
+        'asynchronous SubsampledImage.'
+    ),
+    query_serializer=SubsampleWindowSerializer,
+)
+@api_view(['GET'])
+def download_image_entry_subsample(request, pk):
+    image_entry = get_object_or_404(models.imagery.ImageEntry, pk=pk)
+    check_read_perm(request.user, image_entry)
+    params = request.query_params.dict()
+    if 'geojson' in params:
+        try:
+            params['geojson'] = json.loads(params['geojson'])
+        except ValueError:
+            raise ValidationError('`geojson` must be valid JSON.')
+    query = SubsampleWindowSerializer(data=params)
+    query.is_valid(raise_exception=True)
+    sample_type = query.validated_data['sample_type']
+    sample_parameters = query.validated_data['sample_parameters']
+
+    max_pixels = getattr(settings, 'GEODATA_SUBSAMPLE_MAX_PIXELS', 4096 * 4096)
+    cog = models.imagery.ConvertedImageFile.objects.filter(source_image=image_entry).first()
+    source = cog.converted_file if cog and cog.converted_file else image_entry.image_file.file
+    with open_pooled_dataset(source) as src:
+        try:
+            window = get_subsample_window(src, sample_type, sample_parameters)
+        except ValueError as exc:
+            raise ValidationError(str(exc))
+        if window.width * window.height <= max_pixels:
+            data, transform = read_subsample(src, window, sample_type, sample_parameters)
+            try:
+                content, content_type = encode_subsample(
+                    src, data, transform, query.validated_data['format']
+                )
+            except ValueError as exc:
+                raise ValidationError(str(exc))
+            return HttpResponse(content, content_type=content_type)
+
+    # Too large to read in the request, so fall back to the asynchronous path
+    subsampled = _create_subsampled_image(request, pk, sample_type, sample_parameters)
+    return HttpResponseRedirect(reverse('subsampled', args=[subsampled.pk]))
+
+
 def _get_status_response(request, model, pk):
     model_class = ''.join([part[:1].upper() + part[1:] for part in model.split('_')])
     if not hasattr(models, model_class):
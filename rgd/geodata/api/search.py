@@ -3,7 +3,8 @@ import json
 
 import dateutil.parser
 from django.contrib.gis.db.models import Collect, Extent
-from django.contrib.gis.geos import GEOSGeometry, Point, Polygon
+from django.contrib.gis.gdal import GDALException
+from django.contrib.gis.geos import GEOSException, GEOSGeometry, Point, Polygon
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db.models import Max, Min, Q
 from django.db.models.functions import Coalesce
@@ -13,11 +14,18 @@ from drf_yasg.utils import swagger_auto_schema
 from rest_framework import serializers as rfserializers
 from rest_framework.decorators import api_view
 from rest_framework.generics import ListAPIView
+from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.response import Response
 
 from rgd.geodata import serializers
-from rgd.geodata.filters import SpatialEntryFilter
-from rgd.geodata.models import GeometryEntry, RasterMetaEntry, SpatialEntry
+from rgd.geodata.filters import AnnotationFilter, SpatialEntryFilter
+from rgd.geodata.models import (
+    Annotation,
+    FMVFrame,
+    GeometryEntry,
+    RasterMetaEntry,
+    SpatialEntry,
+)
 from rgd.geodata.permissions import filter_read_perm
 
 
@@ -89,6 +97,32 @@ class GeoJsonSerializer(rfserializers.Serializer):
     )
 
 
+class FMVFrameSearchSerializer(rfserializers.Serializer):
+    geojson = rfserializers.CharField(
+        required=False,
+        help_text='A URL-encoded text of a GeoJSON Geometry object that frame footprints must intersect.',
+    )
+    start_time = rfserializers.DateTimeField(allow_null=True, required=False)
+    end_time = rfserializers.DateTimeField(allow_null=True, required=False)
+    fmv_entry = rfserializers.IntegerField(
+        required=False, help_text='Only search the frames of this FMV entry.'
+    )
+
+    def validate_geojson(self, value):
+        try:
+            GEOSGeometry(value)
+        except (GDALException, GEOSException, ValueError) as e:
+            raise rfserializers.ValidationError(f'Invalid GeoJSON: {e}')
+        return value
+
+    def validate(self, data):
+        if not any(data.get(key) is not None for key in self.fields):
+            raise rfserializers.ValidationError(
+                'A geojson, start_time, end_time or fmv_entry filter is required.'
+            )
+        return data
+
+
 def _add_time_to_query(query, timefield, starttime, endtime, has_created=False):
     starttime = make_aware(starttime)
     endtime = make_aware(endtime)
@@ -337,6 +371,98 @@ def search_geojson_geometry(request, *args, **kwargs):
     return Response(serializers.GeometryEntrySerializer(results, many=True).data)
 
 
+def search_fmv_frames_filter(params):
+    """
+    Get a filter object that can be used when searching FMVFrame models.
+
+    :param params: a dictionary of parameters, optionally including
+        geojson, start_time, end_time, and fmv_entry.
+    :raises ValueError: String input unrecognized as WKT EWKT, and HEXEWKB.
+    :returns: a Django query (Q) object.
+    """
+    query = Q()
+    if params.get('geojson') is not None:
+        geom = GEOSGeometry(params.get('geojson'))
+        query.add(Q(footprint__intersects=(geom)), Q.AND)
+    if params.get('start_time') is not None:
+        starttime = dateutil.parser.isoparser().isoparse(params['start_time'])
+        query.add(Q(timestamp__gte=make_aware(starttime)), Q.AND)
+    if params.get('end_time') is not None:
+        endtime = dateutil.parser.isoparser().isoparse(params['end_time'])
+        query.add(Q(timestamp__lte=make_aware(endtime)), Q.AND)
+    if params.get('fmv_entry') is not None:
+        query.add(Q(fmv_entry=int(params['fmv_entry'])), Q.AND)
+    return query
+
+
+def _frame_range(frame_number, timestamp, frame_rate):
+    return {
+        'start_frame': frame_number,
+        'end_frame': frame_number,
+        'start_time': timestamp.isoformat() if timestamp else None,
+        'end_time': timestamp.isoformat() if timestamp else None,
+        'start_offset': frame_number / frame_rate if frame_rate else None,
+        'end_offset': frame_number / frame_rate if frame_rate else None,
+    }
+
+
+def fmv_frame_ranges(found):
+    """
+    Group FMVFrame results into ranges of consecutive frames for each video.
+
+    :param found: a query set with FMVFrame results.
+    :returns: a list of dictionaries with the fmv_entry and a list of its
+        frame ranges.  Each range has the first and last frame numbers,
+        timestamps, and offsets in seconds into the video (if the frame rate
+        is known).
+    """
+    results = []
+    found = found.order_by('fmv_entry', 'frame_number').values_list(
+        'fmv_entry',
+        'fmv_entry__name',
+        'fmv_entry__fmv_file__frame_rate',
+        'frame_number',
+        'timestamp',
+    )
+    for fmv_entry, name, frame_rate, frame_number, timestamp in found.iterator():
+        if not results or results[-1]['fmv_entry'] != fmv_entry:
+            results.append({'fmv_entry': fmv_entry, 'name': name, 'ranges': []})
+        ranges = results[-1]['ranges']
+        if ranges and ranges[-1]['end_frame'] + 1 == frame_number:
+            current = _frame_range(frame_number, timestamp, frame_rate)
+            for key in ('end_frame', 'end_time', 'end_offset'):
+                ranges[-1][key] = current[key]
+        else:
+            ranges.append(_frame_range(frame_number, timestamp, frame_rate))
+    return results
+
+
+class FMVFramePagination(LimitOffsetPagination):
+    default_limit = 100
+    max_limit = 1000
+
+
+@swagger_auto_schema(
+    method='GET',
+    operation_summary='List FMV frame ranges in a GeoJSON geometry',
+    operation_description='List the ranges of consecutive FMV frames whose footprint intersects a GeoJSON geometry within a time window',
+    query_serializer=FMVFrameSearchSerializer,
+)
+@api_view(['GET'])
+def search_fmv_frames(request, *args, **kwargs):
+    params = request.query_params
+    FMVFrameSearchSerializer(data=params).is_valid(raise_exception=True)
+    found = FMVFrame.objects.filter(search_fmv_frames_filter(params))
+    found = filter_read_perm(request.user, found)
+    # Results are paged by video so that the ranges of a video are never split
+    paginator = FMVFramePagination()
+    fmv_entries = paginator.paginate_queryset(
+        found.order_by('fmv_entry').values_list('fmv_entry', flat=True).distinct(), request
+    )
+    results = fmv_frame_ranges(found.filter(fmv_entry__in=fmv_entries))
+    return paginator.get_paginated_response(results)
+
+
 def extent_summary_spatial(found):
     """
     Given a query set of SpatialEntry, return a result dictionary with the summary.
@@ -605,3 +731,29 @@ class SearchSpatialEntryView(ListAPIView):
 
     def get_queryset(self):
         return filter_read_perm(self.request.user, super().get_queryset())
+
+
+class AnnotationPagination(LimitOffsetPagination):
+    default_limit = 100
+    max_limit = 1000
+
+
+class SearchAnnotationView(ListAPIView):
+    """List annotations by image, image set, label and pixel window.
+
+    Results are paged so that tile viewers and chip samplers only fetch the
+    annotations they need.
+    """
+
+    queryset = Annotation.objects.select_related(
+        'segmentation',
+        'segmentation__polygonsegmentation',
+        'segmentation__rlesegmentation',
+    ).order_by('pk')
+    serializer_class = serializers.AnnotationSerializer
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = AnnotationFilter
+    pagination_class = AnnotationPagination
+
+    def get_queryset(self):
+        return filter_read_perm(self.request.user, super().get_queryset())
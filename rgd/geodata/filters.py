@@ -6,6 +6,7 @@ from django.db.models import Q, Sum
 from django_filters import rest_framework as filters
 
 from rgd.geodata.models.common import SpatialEntry
+from rgd.geodata.models.imagery.annotation import Annotation, get_pixel_window
 
 
 class GeometryFilter(filters.Filter):
@@ -277,3 +278,50 @@ class SpatialEntryFilter(filters.FilterSet):
             'frame_rate',
             'cloud_cover',
         ]
+
+
+class AnnotationFilter(filters.FilterSet):
+
+    image = filters.NumberFilter(
+        field_name='image',
+        help_text='Only annotations of this ImageEntry.',
+        label='Image',
+    )
+    image_set = filters.NumberFilter(
+        field_name='image__imageset',
+        help_text='Only annotations of the images in this ImageSet.',
+        label='Image set',
+    )
+    label = filters.CharFilter(
+        field_name='label',
+        help_text='Only annotations with this label.',
+        label='Label',
+    )
+    window = filters.CharFilter(
+        help_text=(
+            'A pixel window as `xmin,ymin,xmax,ymax`. Only annotations whose extent intersects '
+            'this window are returned.'
+        ),
+        label='Pixel window',
+        method='filter_window',
+        validators=(
+            RegexValidator(
+                regex=r'^\s*-?[\d.]+(\s*,\s*-?[\d.]+){3}\s*$',
+                message='Enter a window as four comma-separated numbers.',
+            ),
+        ),
+    )
+
+    def filter_window(self, queryset, name, value):
+        """Filter the annotations to those intersecting the pixel window.
+
+        This uses the spatial index on the annotation bounds.
+        """
+        if value:
+            window = get_pixel_window(float(v) for v in value.split(','))
+            return queryset.filter(bounds__intersects=window)
+        return queryset
+
+    class Meta:
+        model = Annotation
+        fields = ['image', 'image_set', 'label', 'window']
@@ -214,7 +214,8 @@ def load_shape_files(shape_files):
     ids = []
     for shpfile in shape_files:
         entry = _get_or_create_file_model(models.GeometryArchive, shpfile)
-        ids.append(entry.geometryentry.pk)
+        # An archive can produce many entries: one per layer
+        ids.extend(entry.geometryentry_set.values_list('pk', flat=True))
     return ids
 
 
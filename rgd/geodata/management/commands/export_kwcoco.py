@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rgd.geodata import models
+from rgd.geodata.models.imagery.export import write_kwcoco_image_archive, write_kwcoco_json
+
+SUCCESS_MSG = 'Exported ImageSet ({}) to {}.'
+
+
+class Command(BaseCommand):
+    help = 'Export an ImageSet and its annotations to a KWCOCO JSON spec.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('image_set', type=int, help='The ID of the ImageSet to export.')
+        parser.add_argument('spec', type=str, help='Path to write the KWCOCO JSON spec.')
+        parser.add_argument(
+            '-a',
+            '--archive',
+            type=str,
+            help='Path to also write a zip archive of the images.',
+            default=None,
+        )
+
+    def handle(self, *args, **options):
+        try:
+            image_set = models.ImageSet.objects.get(pk=options['image_set'])
+        except models.ImageSet.DoesNotExist:
+            raise CommandError(f'ImageSet ({options["image_set"]}) does not exist.')
+
+        with open(options['spec'], 'w') as f:
+            write_kwcoco_json(image_set, f)
+        self.stdout.write(self.style.SUCCESS(SUCCESS_MSG.format(image_set.pk, options['spec'])))
+
+        if options['archive']:
+            write_kwcoco_image_archive(image_set, options['archive'])
+            self.stdout.write(
+                self.style.SUCCESS(SUCCESS_MSG.format(image_set.pk, options['archive']))
+            )
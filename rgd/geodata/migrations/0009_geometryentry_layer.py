@@ -0,0 +1,32 @@
+# Generated by Django 3.2 on 2026-10-19 14:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0008_rasterentry_ancillary_files'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='geometryentry',
+            name='geometry_archive',
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to='geodata.geometryarchive',
+            ),
+        ),
+        migrations.AddField(
+            model_name='geometryentry',
+            name='layer',
+            field=models.CharField(
+                blank=True,
+                help_text='The archive member and layer name this entry was read from.',
+                max_length=1000,
+            ),
+        ),
+    ]
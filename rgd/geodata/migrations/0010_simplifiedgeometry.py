@@ -0,0 +1,48 @@
+# Generated by Django 3.2 on 2026-10-19 15:11
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0009_geometryentry_layer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimplifiedGeometry',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name='ID'
+                    ),
+                ),
+                (
+                    'field',
+                    models.CharField(help_text='The name of the simplified field.', max_length=100),
+                ),
+                (
+                    'tolerance',
+                    models.FloatField(help_text='The simplification tolerance in degrees.'),
+                ),
+                ('geometry', django.contrib.gis.db.models.fields.GeometryField(srid=4326)),
+                (
+                    'spatial_entry',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to='geodata.spatialentry'
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='simplifiedgeometry',
+            constraint=models.UniqueConstraint(
+                fields=('spatial_entry', 'field', 'tolerance'),
+                name='unique_simplified_geometry_level',
+            ),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.2 on 2026-10-19 15:48
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0010_simplifiedgeometry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FMVFrame',
+            fields=[
+                (
+                    'id',
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name='ID'
+                    ),
+                ),
+                ('frame_number', models.PositiveIntegerField()),
+                (
+                    'timestamp',
+                    models.DateTimeField(
+                        blank=True,
+                        db_index=True,
+                        help_text='The KLV timestamp of the frame, if any.',
+                        null=True,
+                    ),
+                ),
+                ('sensor_location', django.contrib.gis.db.models.fields.PointField(srid=4326)),
+                ('footprint', django.contrib.gis.db.models.fields.PolygonField(srid=4326)),
+                (
+                    'fmv_entry',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='frames',
+                        to='geodata.fmventry',
+                    ),
+                ),
+            ],
+            options={
+                'ordering': ['fmv_entry', 'frame_number'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='fmvframe',
+            index=models.Index(
+                fields=['fmv_entry', 'frame_number'], name='fmvframe_entry_frame_idx'
+            ),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 3.2 on 2026-10-19 16:20
+
+import base64
+import pickle
+import zlib
+
+from django.db import migrations
+import numpy as np
+
+BATCH_SIZE = 500
+
+
+# A frozen copy of ``rgd.utility.array_to_blob`` as of this migration
+def array_to_blob(array, compress=False):
+    array = np.asarray(array)
+    code = 1 if not array.size or array.max() <= np.iinfo(np.uint32).max else 2
+    data = array.astype({1: '<u4', 2: '<u8'}[code], copy=False).tobytes()
+    if compress:
+        code |= 0x80
+        data = zlib.compress(data)
+    return bytes([code]) + data
+
+
+def _is_legacy_blob(blob):
+    # Legacy blobs are base64 text, new blobs start with a non-printable header byte
+    return blob is not None and len(blob) > 0 and bytes(blob[:1]).isalnum()
+
+
+def _convert_blobs(model, field, compress):
+    batch = []
+    for obj in model.objects.only('pk', field).iterator():
+        blob = getattr(obj, field)
+        if not _is_legacy_blob(blob):
+            continue
+        array = pickle.loads(base64.b64decode(bytes(blob)))
+        setattr(obj, field, array_to_blob(array, compress=compress))
+        batch.append(obj)
+        if len(batch) >= BATCH_SIZE:
+            model.objects.bulk_update(batch, [field])
+            batch = []
+    if batch:
+        model.objects.bulk_update(batch, [field])
+
+
+def convert_pickled_blobs(apps, schema_editor):
+    _convert_blobs(apps.get_model('geodata', 'FMVEntry'), 'frame_numbers', compress=True)
+    _convert_blobs(apps.get_model('geodata', 'RLESegmentation'), 'blob', compress=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0011_fmvframe'),
+    ]
+
+    operations = [
+        migrations.RunPython(convert_pickled_blobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2 on 2026-10-19 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0012_array_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kwcocoarchive',
+            name='progress',
+            field=models.FloatField(
+                default=0, help_text='The fraction of images read by the most recent import.'
+            ),
+        ),
+    ]
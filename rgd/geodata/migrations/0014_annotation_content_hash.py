@@ -0,0 +1,22 @@
+# Generated by Django 3.2 on 2026-10-19 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0013_kwcocoarchive_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='content_hash',
+            field=models.CharField(
+                blank=True,
+                help_text='A hash of the source annotation content used to detect changes on re-import.',
+                max_length=64,
+            ),
+        ),
+    ]
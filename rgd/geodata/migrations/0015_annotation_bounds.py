@@ -0,0 +1,116 @@
+# Generated by Django 3.2 on 2026-10-19 18:05
+
+import zlib
+
+import django.contrib.gis.db.models.fields
+from django.contrib.gis.geos import Polygon
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import migrations
+import numpy as np
+
+BATCH_SIZE = 500
+
+
+# Frozen copies of ``rgd.utility.blob_to_array`` and
+#  ``rgd.geodata.models.imagery.rle.rle_bbox`` as of this migration
+def blob_to_array(blob):
+    blob = memoryview(blob)
+    code = blob[0]
+    data = blob[1:]
+    if code & 0x80:
+        data = zlib.decompress(data)
+    return np.frombuffer(data, dtype={1: '<u4', 2: '<u8'}[code & ~0x80])
+
+
+def rle_bbox(counts, width):
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    keep = counts[1::2] > 0
+    starts, ends = starts[1::2][keep], ends[1::2][keep]
+    if not starts.size:
+        return None
+    row_start, col_start = np.divmod(starts, width)
+    row_end, col_end = np.divmod(ends - 1, width)
+    # Runs that wrap onto another row cover every column in between
+    wraps = row_start != row_end
+    xmin = np.where(wraps, 0, col_start).min()
+    xmax = np.where(wraps, width - 1, col_end).max()
+    ymin = row_start.min()
+    ymax = row_end.max()
+    return [int(xmin), int(ymin), int(xmax - xmin + 1), int(ymax - ymin + 1)]
+
+
+def _get_extents(annotation):
+    geometries = [annotation.keypoints, annotation.line]
+    extents = []
+    try:
+        segmentation = annotation.segmentation
+    except ObjectDoesNotExist:
+        segmentation = None
+    if segmentation is not None:
+        geometries.append(segmentation.outline)
+        try:
+            geometries.append(segmentation.polygonsegmentation.feature)
+        except ObjectDoesNotExist:
+            pass
+        try:
+            rle = segmentation.rlesegmentation
+            bbox = rle_bbox(blob_to_array(rle.blob), rle.width)
+            if bbox is not None:
+                x, y, w, h = bbox
+                extents.append((x, y, x + w, y + h))
+        except ObjectDoesNotExist:
+            pass
+    extents.extend(g.extent for g in geometries if g is not None and not g.empty)
+    return extents
+
+
+def populate_bounds(apps, schema_editor):
+    Annotation = apps.get_model('geodata', 'Annotation')
+    annotations = Annotation.objects.select_related(
+        'segmentation',
+        'segmentation__polygonsegmentation',
+        'segmentation__rlesegmentation',
+    )
+    batch = []
+    for annotation in annotations.iterator():
+        extents = _get_extents(annotation)
+        if not extents:
+            continue
+        bounds = Polygon.from_bbox(
+            (
+                min(e[0] for e in extents),
+                min(e[1] for e in extents),
+                max(e[2] for e in extents),
+                max(e[3] for e in extents),
+            )
+        )
+        bounds.srid = 0
+        annotation.bounds = bounds
+        batch.append(annotation)
+        if len(batch) >= BATCH_SIZE:
+            Annotation.objects.bulk_update(batch, ['bounds'])
+            batch = []
+    if batch:
+        Annotation.objects.bulk_update(batch, ['bounds'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0014_annotation_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='bounds',
+            field=django.contrib.gis.db.models.fields.PolygonField(
+                help_text='The pixel extent of the keypoints, line and segmentation of this annotation.',
+                null=True,
+                srid=0,
+            ),
+        ),
+        migrations.RunPython(populate_bounds, migrations.RunPython.noop),
+    ]
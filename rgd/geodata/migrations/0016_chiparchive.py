@@ -0,0 +1,94 @@
+# Generated by Django 3.2 on 2026-10-19 18:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+import rgd.geodata.models.mixins
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0015_annotation_bounds'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChipArchive',
+            fields=[
+                (
+                    'modifiableentry_ptr',
+                    models.OneToOneField(
+                        auto_created=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        parent_link=True,
+                        primary_key=True,
+                        serialize=False,
+                        to='geodata.modifiableentry',
+                    ),
+                ),
+                ('failure_reason', models.TextField(null=True)),
+                (
+                    'status',
+                    models.CharField(
+                        choices=[
+                            ('created', 'Created but not queued'),
+                            ('queued', 'Queued for processing'),
+                            ('running', 'Processing'),
+                            ('failed', 'Failed'),
+                            ('success', 'Succeeded'),
+                        ],
+                        default='created',
+                        max_length=20,
+                    ),
+                ),
+                (
+                    'label',
+                    models.CharField(
+                        blank=True,
+                        help_text='Only extract chips of annotations with this label.',
+                        max_length=100,
+                    ),
+                ),
+                (
+                    'padding',
+                    models.PositiveIntegerField(
+                        default=0, help_text='The number of pixels to pad around each annotation.'
+                    ),
+                ),
+                (
+                    'shard_size',
+                    models.PositiveIntegerField(
+                        default=10000, help_text='The maximum number of chips in each shard.'
+                    ),
+                ),
+                (
+                    'count',
+                    models.PositiveIntegerField(
+                        default=0, help_text='The number of chips extracted.'
+                    ),
+                ),
+                (
+                    'image_set',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to='geodata.imageset'
+                    ),
+                ),
+                (
+                    'index_file',
+                    models.OneToOneField(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name='+',
+                        to='geodata.checksumfile',
+                    ),
+                ),
+                (
+                    'shards',
+                    models.ManyToManyField(blank=True, related_name='+', to='geodata.checksumfile'),
+                ),
+            ],
+            bases=('geodata.modifiableentry', rgd.geodata.models.mixins.TaskEventMixin),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2 on 2026-10-19 18:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0016_chiparchive'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='subsampledimage',
+            name='data',
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to='geodata.checksumfile',
+            ),
+        ),
+        migrations.AddField(
+            model_name='subsampledimage',
+            name='cache_key',
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                help_text='A hash of the source content, subsample arguments and output format.',
+                max_length=64,
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2 on 2026-10-19 19:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0017_subsampledimage_cache_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='convertedimagefile',
+            name='profile',
+            field=models.CharField(
+                default='default',
+                help_text='The conversion profile (compression and tiling) to use.',
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name='convertedimagefile',
+            name='conversion_time',
+            field=models.FloatField(
+                blank=True, help_text='The number of seconds the conversion took.', null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name='convertedimagefile',
+            name='size_ratio',
+            field=models.FloatField(
+                blank=True,
+                help_text='The size of the converted file relative to the source.',
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2 on 2026-10-19 19:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0018_convertedimagefile_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageentry',
+            name='is_cog',
+            field=models.BooleanField(
+                help_text='Whether the original file is a valid Cloud Optimized GeoTIFF.', null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name='imageentry',
+            name='cog_errors',
+            field=models.TextField(
+                blank=True,
+                help_text='The reasons the original file is not a Cloud Optimized GeoTIFF.',
+            ),
+        ),
+    ]
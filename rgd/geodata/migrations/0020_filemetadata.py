@@ -0,0 +1,96 @@
+# Generated by Django 3.2 on 2026-10-19 20:02
+
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0019_imageentry_is_cog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileMetadata',
+            fields=[
+                (
+                    'modifiableentry_ptr',
+                    models.OneToOneField(
+                        auto_created=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        parent_link=True,
+                        primary_key=True,
+                        serialize=False,
+                        to='geodata.modifiableentry',
+                    ),
+                ),
+                ('checksum', models.CharField(max_length=128, unique=True)),
+                ('driver', models.CharField(max_length=100)),
+                ('height', models.PositiveIntegerField()),
+                ('width', models.PositiveIntegerField()),
+                ('number_of_bands', models.PositiveIntegerField()),
+                ('is_cog', models.BooleanField(null=True)),
+                ('cog_errors', models.TextField(blank=True)),
+                (
+                    'band_descriptions',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.TextField(blank=True), default=list, size=None
+                    ),
+                ),
+                (
+                    'band_dtypes',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.CharField(blank=True, max_length=20),
+                        default=list,
+                        size=None,
+                    ),
+                ),
+                (
+                    'band_nodata_values',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.FloatField(null=True), default=list, size=None
+                    ),
+                ),
+                (
+                    'band_interpretations',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.TextField(), default=list, size=None
+                    ),
+                ),
+                ('crs', models.TextField(blank=True, help_text='PROJ string', null=True)),
+                (
+                    'origin',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.FloatField(), null=True, size=2
+                    ),
+                ),
+                (
+                    'extent',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.FloatField(), null=True, size=4
+                    ),
+                ),
+                (
+                    'resolution',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.FloatField(), null=True, size=2
+                    ),
+                ),
+                (
+                    'transform',
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.FloatField(), null=True, size=6
+                    ),
+                ),
+                ('outline', django.contrib.gis.db.models.fields.PolygonField(null=True, srid=4326)),
+                (
+                    'footprint',
+                    django.contrib.gis.db.models.fields.PolygonField(null=True, srid=4326),
+                ),
+            ],
+            bases=('geodata.modifiableentry',),
+        ),
+    ]
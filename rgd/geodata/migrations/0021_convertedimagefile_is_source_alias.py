@@ -0,0 +1,29 @@
+# Generated by Django 3.2 on 2026-10-19 21:12
+
+from django.db import migrations, models
+
+
+def mark_source_aliases(apps, schema_editor):
+    ConvertedImageFile = apps.get_model('geodata', 'ConvertedImageFile')
+    ConvertedImageFile.objects.filter(
+        converted_file=models.F('source_image__image_file__file')
+    ).update(is_source_alias=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geodata', '0020_filemetadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='convertedimagefile',
+            name='is_source_alias',
+            field=models.BooleanField(
+                default=False,
+                help_text='Whether the converted file is the source image file, which already is a COG.',
+            ),
+        ),
+        migrations.RunPython(mark_source_aliases, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,12 @@
 # These are models we want to expose in the top-level model namespace
 from .collection import Collection, CollectionMembership  # noqa
-from .common import ChecksumFile, FileSourceType, ModifiableEntry, SpatialEntry  # noqa
+from .common import (  # noqa
+    ChecksumFile,
+    FileSourceType,
+    ModifiableEntry,
+    SimplifiedGeometry,
+    SpatialEntry,
+)
 from .fmv import *  # noqa
 from .geometry import *  # noqa
 from .imagery import *  # noqa
@@ -1,7 +1,11 @@
 import contextlib
+import hashlib
+import json
 import logging
+import math
 import os
 from urllib.parse import urlencode, urlparse
+from urllib.request import Request
 
 # from django.contrib.auth import get_user_model
 from django.contrib.gis.db import models
@@ -24,7 +28,7 @@ from rgd.utility import (
 
 # from .. import tasks
 from .collection import Collection
-from .constants import DB_SRID
+from .constants import DB_SRID, SIMPLIFY_TOLERANCES
 from .mixins import TaskEventMixin
 
 logger = logging.getLogger(__name__)
@@ -101,6 +105,133 @@ class SpatialEntry(models.Model):
     def subentry_type(self):
         return type(self.subentry).__name__
 
+    def populate_simplified_geometries(self, fields, decimate=()):
+        """Precompute simplified levels of detail for the given geometry fields.
+
+        A level is stored for each of ``SIMPLIFY_TOLERANCES`` that actually
+        reduces the number of coordinates. Each level is simplified from the
+        previous (finer) level.
+
+        Parameters
+        ----------
+        fields : list of str
+            The names of the geometry fields on this entry to simplify.
+        decimate : list of str, optional
+            Fields holding sequences of geometries (e.g. per-frame
+            footprints) that should be decimated rather than simplified.
+            Parts within the tolerance of the previously kept part are dropped.
+
+        """
+        SimplifiedGeometry.objects.filter(
+            spatial_entry_id=self.spatial_id, field__in=fields
+        ).delete()
+        levels = []
+        for field in fields:
+            geometry = getattr(self, field)
+            if not geometry:
+                continue
+            num_coords = geometry.num_coords
+            for tolerance in SIMPLIFY_TOLERANCES:
+                if field in decimate:
+                    simplified = _decimate_geometry(geometry, tolerance)
+                else:
+                    simplified = geometry.simplify(tolerance, preserve_topology=True)
+                if simplified.empty or simplified.num_coords >= num_coords:
+                    continue
+                geometry = simplified
+                num_coords = simplified.num_coords
+                levels.append(
+                    SimplifiedGeometry(
+                        spatial_entry_id=self.spatial_id,
+                        field=field,
+                        tolerance=tolerance,
+                        geometry=simplified,
+                    )
+                )
+        SimplifiedGeometry.objects.bulk_create(levels)
+
+    def get_simplified_geometry(self, field, tolerance=None):
+        """Get the coarsest level of detail of a field within the given tolerance.
+
+        Falls back to the full resolution geometry if no ``tolerance`` is
+        given or no precomputed level is fine enough.
+
+        """
+        if tolerance:
+            level = (
+                SimplifiedGeometry.objects.filter(
+                    spatial_entry_id=self.spatial_id, field=field, tolerance__lte=tolerance
+                )
+                .order_by('-tolerance')
+                .first()
+            )
+            if level:
+                return level.geometry
+        return getattr(self, field)
+
+
+def _decimate_geometry(geometry, tolerance):
+    """Drop the parts of a multi-geometry that are within tolerance of the last kept part."""
+    parts = []
+    last = None
+    for part in geometry:
+        centroid = part.centroid
+        if last is None or centroid.distance(last) > tolerance:
+            parts.append(part)
+            last = centroid
+    return type(geometry)(parts, srid=geometry.srid)
+
+
+# The range of web map zoom levels accepted for simplification
+MIN_ZOOM = 0
+MAX_ZOOM = 30
+
+
+def get_simplify_tolerance(params):
+    """Get the simplification tolerance requested in the query parameters.
+
+    The tolerance (in degrees) can be given directly with ``tolerance`` or
+    derived from a web map ``zoom`` level, where it is the size of a single
+    256 pixel tile's pixel at that zoom.
+
+    Raises ``ValueError`` if the parameters are malformed or out of range.
+
+    """
+    if params.get('tolerance') is not None:
+        tolerance = float(params['tolerance'])
+        if not math.isfinite(tolerance) or tolerance < 0:
+            raise ValueError('`tolerance` must be a non-negative number.')
+        return tolerance
+    if params.get('zoom') is not None:
+        zoom = float(params['zoom'])
+        if not MIN_ZOOM <= zoom <= MAX_ZOOM:
+            raise ValueError(f'`zoom` must be between {MIN_ZOOM} and {MAX_ZOOM}.')
+        return 360.0 / (256 * 2**zoom)
+    return None
+
+
+class SimplifiedGeometry(models.Model):
+    """A precomputed, simplified level of detail of a ``SpatialEntry`` geometry field.
+
+    Full resolution geometries (e.g. ``GeometryEntry.data`` or
+    ``FMVEntry.ground_frames``) can be massive. These levels let clients
+    request geometry sized to their display.
+
+    """
+
+    spatial_entry = models.ForeignKey(SpatialEntry, on_delete=models.CASCADE)
+    field = models.CharField(max_length=100, help_text='The name of the simplified field.')
+    tolerance = models.FloatField(help_text='The simplification tolerance in degrees.')
+    geometry = models.GeometryField(srid=DB_SRID)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['spatial_entry', 'field', 'tolerance'],
+                name='unique_simplified_geometry_level',
+            )
+        ]
+
 
 class FileSourceType(models.IntegerChoices):
     FILE_FIELD = 1, 'FileField'
@@ -174,6 +305,31 @@ class ChecksumFile(ModifiableEntry, TaskEventMixin):
             ]
         )
 
+    def get_content_key(self):
+        """Get a key of the content of this file without reading it.
+
+        This is the checksum if it is set. Otherwise, the key is built from
+        the identity of the stored file (its storage name, or the URL with
+        its ``ETag``, ``Last-Modified`` and ``Content-Length`` headers), which
+        changes whenever the file is replaced but is not shared by duplicate
+        uploads.
+
+        """
+        if self.checksum:
+            return self.checksum
+        identity = {'pk': self.pk, 'type': self.type}
+        if self.type == FileSourceType.FILE_FIELD:
+            identity['file'] = self.file.name
+        elif self.type == FileSourceType.URL:
+            identity['url'] = self.url
+            try:
+                with safe_urlopen(Request(self.url, method='HEAD')) as remote:
+                    for header in ('ETag', 'Last-Modified', 'Content-Length'):
+                        identity[header] = remote.headers.get(header)
+            except (OSError, ValueError):
+                pass  # Fallback to the URL alone
+        return hashlib.sha512(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
     def validate(self):
         previous = self.checksum
         self.update_checksum()
@@ -203,7 +359,20 @@ class ChecksumFile(ModifiableEntry, TaskEventMixin):
                 ]
             )
 
+    def _source_changed(self):
+        """Check if the file or URL differs from the one that is saved."""
+        if not self.pk:
+            return False
+        saved = ChecksumFile.objects.filter(pk=self.pk).values_list('file', 'url').first()
+        return saved is not None and (saved[0] or None, saved[1] or None) != (
+            self.file.name or None,
+            self.url or None,
+        )
+
     def save(self, *args, **kwargs):
+        if self.checksum and kwargs.get('update_fields') is None and self._source_changed():
+            # The content was replaced so the saved checksum no longer applies
+            self.checksum = ''
         if not self.name:
             if self.type == FileSourceType.FILE_FIELD and self.file.name:
                 self.name = os.path.basename(self.file.name)
@@ -1,2 +1,9 @@
 DB_SRID = 4326
 WEB_MERCATOR = 3857
+
+# Tolerances (in degrees of DB_SRID) of the precomputed simplified levels of
+# detail for large geometries. Roughly 1 meter to 10 kilometers at the equator.
+SIMPLIFY_TOLERANCES = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1)
+
+# The GDAL driver of the files produced by subsampling images
+SUBSAMPLE_FORMAT = 'GTiff'
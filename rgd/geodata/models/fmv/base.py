@@ -1,10 +1,7 @@
-import base64
-import pickle
-
 from django.contrib.gis.db import models
 from s3_file_field import S3FileField
 
-from rgd.utility import _link_url
+from rgd.utility import _link_url, array_to_blob, blob_to_array
 
 from ... import tasks
 from ..common import ChecksumFile, ModifiableEntry, SpatialEntry
@@ -52,8 +49,32 @@ class FMVEntry(ModifiableEntry, SpatialEntry):
 
     @staticmethod
     def _array_to_blob(array):
-        return base64.b64encode(pickle.dumps(array))
+        # Frame numbers are mostly consecutive so they compress well
+        return array_to_blob(array, compress=True)
 
     @staticmethod
     def _blob_to_array(blob):
-        return pickle.loads(base64.b64decode(blob))
+        return blob_to_array(blob)
+
+
+class FMVFrame(models.Model):
+    """The sensor location and ground footprint of a single frame of an FMV entry.
+
+    These are indexed so that the frames that observed a location (and
+    when) can be found without decoding the whole ``FMVEntry``.
+
+    """
+
+    fmv_entry = models.ForeignKey(FMVEntry, on_delete=models.CASCADE, related_name='frames')
+    frame_number = models.PositiveIntegerField()
+    timestamp = models.DateTimeField(
+        null=True, blank=True, db_index=True, help_text='The KLV timestamp of the frame, if any.'
+    )
+    sensor_location = models.PointField(srid=DB_SRID)
+    footprint = models.PolygonField(srid=DB_SRID)
+
+    class Meta:
+        ordering = ['fmv_entry', 'frame_number']
+        indexes = [
+            models.Index(fields=['fmv_entry', 'frame_number'], name='fmvframe_entry_frame_idx')
+        ]
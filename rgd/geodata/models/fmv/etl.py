@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
 import os
 import re
 import shutil
@@ -5,74 +7,122 @@ import subprocess
 import tempfile
 
 from celery.utils.log import get_task_logger
+from django.conf import settings
 from django.contrib.gis.geos import MultiPoint, MultiPolygon, Point, Polygon
 from girder_utils.files import field_file_to_local_path
 import numpy as np
 
 from rgd.utility import get_or_create_no_commit
 
-from .base import FMVEntry, FMVFile
+from .base import FMVEntry, FMVFile, FMVFrame
 
 logger = get_task_logger(__name__)
 
+# The fields of ``FMVFile`` that the ETL steps produce files for
+FMV_FILE_FIELDS = ('klv_file', 'web_video_file')
 
-def _extract_klv(fmv_file_entry):
+
+def _extract_klv(fmv_file_entry, dataset_path, tmpdir):
+    """Run ``dump-klv`` on the local video, writing its output to ``tmpdir``.
+
+    Nothing is stored on the entry so that this can run alongside
+    ``_convert_video_to_mp4``. Returns the fields to update, with the
+    path of the output for file fields.
+
+    """
     logger.info('Entered `_extract_klv`')
 
     if not shutil.which('kwiver'):
         raise RuntimeError('kwiver not installed. Run `pip install kwiver`.')
 
     video_file = fmv_file_entry.file
-    with tempfile.TemporaryDirectory() as tmpdir, video_file.yield_local_path() as dataset_path:
-        logger.info(f'Running dump-klv with data: {dataset_path}')
-        output_path = os.path.join(tmpdir, os.path.basename(video_file.file.name) + '.klv')
-        stderr_path = os.path.join(tmpdir, 'stderr.dat')
-        cmd = [
-            'kwiver',
-            'dump-klv',
-            dataset_path,
-        ]
-        try:
-            with open(dataset_path, 'rb') as stdin, open(output_path, 'wb') as stdout, open(
-                stderr_path, 'wb'
-            ) as stderr:
-                subprocess.check_call(
-                    cmd,
-                    stdin=stdin,
-                    stdout=stdout,
-                    stderr=stderr,
-                )
-        except subprocess.CalledProcessError as exc:
-            logger.info('Failed to successfully run dump-klv ({exc!r})')
-            raise exc
-        # Store result
-        with open(output_path, 'rb') as f:
-            fmv_file_entry.klv_file.save(os.path.basename(output_path), f)
-        fmv_file_entry.save(
-            update_fields=[
-                'klv_file',
-            ]
-        )
-
-
-def _get_spatial_ref_of_frame(frame):
-    """Get the sensor location and bounding box footprint for the given frame."""
-    meta_regex = re.compile(r'---------------- Metadata from: (.+)')
-    idxs = [m.start() for m in re.finditer(meta_regex, frame)]
-    if len(idxs) > 1:
-        meta_block = [frame[idxs[i] : idxs[i + 1]] for i in range(len(idxs) - 1)][-1]
-    else:
-        meta_block = frame[idxs[0] : :]
+    logger.info(f'Running dump-klv with data: {dataset_path}')
+    output_path = os.path.join(tmpdir, os.path.basename(video_file.file.name) + '.klv')
+    stderr_path = os.path.join(tmpdir, 'stderr.dat')
+    cmd = [
+        'kwiver',
+        'dump-klv',
+        dataset_path,
+    ]
+    try:
+        with open(dataset_path, 'rb') as stdin, open(output_path, 'wb') as stdout, open(
+            stderr_path, 'wb'
+        ) as stderr:
+            subprocess.check_call(
+                cmd,
+                stdin=stdin,
+                stdout=stdout,
+                stderr=stderr,
+            )
+    except subprocess.CalledProcessError as exc:
+        logger.info('Failed to successfully run dump-klv ({exc!r})')
+        raise exc
+    return {'klv_file': output_path}
+
+
+FRAME_REGEX = re.compile(r'========== Read frame (\d+) \(index (\d+)\) ==========')
+META_REGEX = re.compile(r'---------------- Metadata from: (.+)')
+LOC_REGEX = re.compile(
+    r'Metadata item: Sensor Geodetic Location (.+): geo_point.\[(.+)\] @ (\d+) (.+)'
+)
+CORNERS_REGEX = re.compile(r'Metadata item: Corner points (.+): {(.+)} @ (\d+)')
+TIMESTAMP_REGEX = re.compile(r'Metadata item: Unix Timestamp \(microseconds\): (\d+)')
+
+
+def _iter_klv_frames(lines):
+    """Stream the frames of ``dump-klv`` output one line at a time.
+
+    Only the sensor location, corner points and timestamp of the last two
+    metadata blocks of the current frame are held, so memory use does not grow with
+    the size of the dump.
+
+    Yields ``(frame_number, blocks)`` where ``blocks`` is a list of
+    ``[location_match, corners_match, timestamp_match]`` (any can be ``None``).
+
+    The final frame is not yielded as it may be truncated.
+
+    """
+    frame_number = None
+    blocks = []
+    for line in lines:
+        match = FRAME_REGEX.search(line)
+        if match:
+            if frame_number is not None:
+                yield frame_number, blocks
+            frame_number = int(match.group(1))
+            blocks = []
+        elif frame_number is None:
+            continue
+        elif META_REGEX.search(line):
+            blocks = blocks[-1:] + [[None, None, None]]
+        elif blocks:
+            block = blocks[-1]
+            if block[0] is None:
+                block[0] = LOC_REGEX.search(line)
+            if block[1] is None:
+                block[1] = CORNERS_REGEX.search(line)
+            if block[2] is None:
+                block[2] = TIMESTAMP_REGEX.search(line)
+
+
+def _get_spatial_ref_of_frame(blocks):
+    """Get the sensor location, bounding box footprint and timestamp for the given frame.
+
+    The timestamp is ``None`` if the frame does not have one. Raises ``IndexError`` if the frame has no spatial metadata.
+
+    """
+    if not blocks:
+        raise IndexError('No metadata for frame')
+    # Use the second to last metadata block if there are many
+    loc_match, corners_match, timestamp_match = blocks[-2] if len(blocks) > 1 else blocks[0]
+    if loc_match is None or corners_match is None:
+        raise IndexError('No spatial metadata for frame')
 
     # Sensor Geodetic Location
-    loc_regex = re.compile(
-        r'Metadata item: Sensor Geodetic Location (.+): geo_point.\[(.+)\] @ (\d+) (.+)'
-    )
-    _, loc, srida, _ = re.findall(loc_regex, meta_block)[0]
+    _, loc, srida, _ = loc_match.groups()
 
     # Corner points
-    corners_regex = re.compile(r'Metadata item: Corner points (.+): {(.+)} @ (\d+)')
-    _, corners, sridb = re.findall(corners_regex, meta_block)[0]
+    _, corners, sridb = corners_match.groups()
 
     # make usable
     srida = int(srida)
@@ -83,30 +133,62 @@ def _get_spatial_ref_of_frame(frame):
     path = np.array([float(s) for s in loc.split(',')])
     bbox = np.array([float(v) for c in corners.split(',') for v in c.split('/')]).reshape((-1, 2))
 
-    return path, bbox, srida
+    timestamp = None
+    if timestamp_match is not None:
+        timestamp = datetime.datetime.fromtimestamp(
+            int(timestamp_match.group(1)) / 1e6, tz=datetime.timezone.utc
+        )
+
+    return path, bbox, srida, timestamp
+
 
+def _union_footprints(polys, tolerance=None):
+    """Get the union of all frame footprints in a single cascaded union.
 
-def _get_path_and_footprints(content):
-    """Get the flight path and all footprints for entire video."""
-    frame_regex = re.compile(r'========== Read frame (\d+) \(index (\d+)\) ==========')
-    idxs = [m.start() for m in re.finditer(frame_regex, content)]
-    frames = [content[idxs[i] : idxs[i + 1]] for i in range(len(idxs) - 1)]
-    nf = [int(c[0]) for c in re.findall(frame_regex, content)]
+    Unioning each frame into a running total is quadratic in the number of
+    frames, whereas GEOS's ``UnaryUnion`` over the whole collection unions
+    the footprints as a balanced tree.
 
-    assert len(nf[:-1]) == len(frames)
+    If ``tolerance`` is given, frames whose footprint is equal to the last
+    kept footprint within that tolerance are dropped first, since
+    consecutive frames of a hovering sensor are often near-duplicates.
 
+    """
+    if not polys:
+        return None
+    if tolerance:
+        parts = [polys[0]]
+        for p in polys[1:]:
+            if not p.equals_exact(parts[-1], tolerance):
+                parts.append(p)
+    else:
+        parts = polys
+    return MultiPolygon(parts, srid=parts[0].srid).unary_union
+
+
+def _get_path_and_footprints(lines, union_tolerance=None):
+    """Get the flight path and all footprints for entire video.
+
+    ``lines`` is any iterable of the lines of ``dump-klv`` output, such as
+    an open file, which is parsed as a stream.
+
+    Returns the flight path, frame footprints, their union, and the frame
+    number and timestamp of each footprint.
+
+    """
     path = []
     polys = []
-    union = None
     frame_numbers = []
-    for i, f in enumerate(frames):
+    timestamps = []
+    for frame_number, blocks in _iter_klv_frames(lines):
         try:
-            sensor, bbox, srid = _get_spatial_ref_of_frame(f)
+            sensor, bbox, srid, timestamp = _get_spatial_ref_of_frame(blocks)
         except IndexError:
             # No data for that frame
             continue
 
-        frame_numbers.append(nf[i])
+        frame_numbers.append(frame_number)
+        timestamps.append(timestamp)
 
         point = Point(*sensor[:2], srid=srid)
         path.append(point)
@@ -114,14 +196,11 @@ def _get_path_and_footprints(content):
         box = np.insert(bbox, 0, bbox[-1], axis=0)
         p = Polygon(box, srid=srid)
         polys.append(p)
-        if union is None:
-            # Ony on first
-            union = p
-        else:
-            union = union.union(p)
 
     logger.info('Created ({}) Polygons '.format(len(polys)))
 
+    union = _union_footprints(polys, tolerance=union_tolerance)
+
     polys = MultiPolygon(polys)
     points = MultiPoint(path)
 
@@ -132,7 +211,7 @@ def _get_path_and_footprints(content):
             ]
         )
 
-    return points, polys, union, frame_numbers
+    return points, polys, union, frame_numbers, timestamps
 
 
 def _get_frame_rate_of_video(file_path):
@@ -142,55 +221,94 @@ def _get_frame_rate_of_video(file_path):
     return cap.get(cv2.CAP_PROP_FPS)
 
 
-def _convert_video_to_mp4(fmv_file_entry):
+def _get_ffmpeg_command(input_path, output_path):
+    cmd = [
+        'ffmpeg',
+        '-i',
+        str(input_path),
+        '-map_metadata',
+        '-1',
+        '-vcodec',
+        'libx264',
+        '-level',
+        '30',
+        '-maxrate',
+        '1024k',
+        '-movflags',
+        'faststart',
+        '-g',
+        '15',
+        '-an',
+    ]
+    preset = getattr(settings, 'GEODATA_FFMPEG_PRESET', None)
+    if preset:
+        cmd += ['-preset', preset]
+    threads = getattr(settings, 'GEODATA_FFMPEG_THREADS', None)
+    if threads is not None:
+        # 0 lets the encoder choose based on the number of cores
+        cmd += ['-threads', str(threads)]
+    cmd.append(output_path)
+    return cmd
+
+
+def _convert_video_to_mp4(fmv_file_entry, dataset_path, tmpdir):
+    """Transcode the local video to a web friendly MP4 in ``tmpdir``.
+
+    Nothing is stored on the entry so that this can run alongside
+    ``_extract_klv``. Returns the fields to update, with the path of the
+    output for file fields.
+
+    """
     video_file = fmv_file_entry.file
-    with video_file.yield_local_path() as dataset_path, tempfile.TemporaryDirectory() as tmpdir:
-        logger.info(f'Converting video file: {dataset_path}')
-        output_path = os.path.join(tmpdir, os.path.basename(video_file.file.name) + '.mp4')
-
-        cmd = [
-            'ffmpeg',
-            '-i',
-            str(dataset_path),
-            '-map_metadata',
-            '-1',
-            '-vcodec',
-            'libx264',
-            '-level',
-            '30',
-            '-maxrate',
-            '1024k',
-            '-movflags',
-            'faststart',
-            '-g',
-            '15',
-            '-an',
-            output_path,
-        ]
-        logger.info('Running {}'.format(cmd))
-        try:
-            subprocess.check_call(cmd)
-            # Store result
-            with open(output_path, 'rb') as f:
-                fmv_file_entry.web_video_file.save(os.path.basename(output_path), f)
-            fmv_file_entry.frame_rate = _get_frame_rate_of_video(dataset_path)
-            fmv_file_entry.save()
-        except subprocess.CalledProcessError as exc:
-            logger.info(f'Failed to successfully convert video ({exc!r})')
+    logger.info(f'Converting video file: {dataset_path}')
+    output_path = os.path.join(tmpdir, os.path.basename(video_file.file.name) + '.mp4')
+
+    cmd = _get_ffmpeg_command(dataset_path, output_path)
+    logger.info('Running {}'.format(cmd))
+    try:
+        subprocess.check_call(cmd)
+    except subprocess.CalledProcessError as exc:
+        logger.info(f'Failed to successfully convert video ({exc!r})')
+        return {}
+    return {'web_video_file': output_path, 'frame_rate': _get_frame_rate_of_video(dataset_path)}
+
+
+def _store_fmv_outputs(fmv_file_entry, outputs):
+    """Upload the outputs of the ETL steps and save them on the entry.
+
+    If anything fails, the files uploaded so far are deleted so that none
+    are left orphaned.
+
+    """
+    uploaded = []
+    try:
+        for field, value in outputs.items():
+            if field in FMV_FILE_FIELDS:
+                field_file = getattr(fmv_file_entry, field)
+                with open(value, 'rb') as f:
+                    field_file.save(os.path.basename(value), f, save=False)
+                uploaded.append(field_file)
+            else:
+                setattr(fmv_file_entry, field, value)
+        fmv_file_entry.save(update_fields=list(outputs))
+    except Exception:
+        for field_file in uploaded:
+            field_file.delete(save=False)
+        raise
 
 
 def _populate_fmv_entry(entry):
-    with field_file_to_local_path(entry.fmv_file.klv_file) as path:
-        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-
-    if not content:
-        raise Exception('FLV file not created')
-
-    # The returned `footprints` can have thoousands of Polygons which will not render well
-    #   for now we just ignore those. If there is a need, we can use later.
-    #   FYI: those footprints do not correspond to all frames, i.e. some are missing
-    path, polys, union, nf = _get_path_and_footprints(content)
+    with field_file_to_local_path(entry.fmv_file.klv_file) as klv_path:
+        if not os.path.getsize(klv_path):
+            raise Exception('FLV file not created')
+
+        # The returned `footprints` can have thoousands of Polygons which will not render well
+        #   for now we just ignore those. If there is a need, we can use later.
+        #   FYI: those footprints do not correspond to all frames, i.e. some are missing
+        with open(klv_path, 'r', encoding='utf-8', errors='ignore') as f:
+            path, polys, union, nf, timestamps = _get_path_and_footprints(
+                f, union_tolerance=getattr(settings, 'GEODATA_FMV_UNION_TOLERANCE', None)
+            )
 
     entry.ground_frames = polys
     entry.ground_union = union
@@ -201,6 +319,25 @@ def _populate_fmv_entry(entry):
     entry.footprint = union.convex_hull
 
     entry.save()
+    entry.populate_simplified_geometries(
+        ['ground_frames', 'ground_union', 'flight_path'],
+        decimate=['ground_frames', 'flight_path'],
+    )
+
+    FMVFrame.objects.filter(fmv_entry=entry).delete()
+    FMVFrame.objects.bulk_create(
+        [
+            FMVFrame(
+                fmv_entry=entry,
+                frame_number=frame_number,
+                timestamp=timestamp,
+                sensor_location=point,
+                footprint=poly,
+            )
+            for frame_number, timestamp, point, poly in zip(nf, timestamps, path, polys)
+        ],
+        batch_size=1000,
+    )
 
 
 def read_fmv_file(fmv_file_id):
@@ -208,11 +345,25 @@ def read_fmv_file(fmv_file_id):
     fmv_file.skip_task = True
 
     validation = True  # TODO: use `fmv_file.file.validate()`
+    steps = []
     # Only extraxt the KLV data if it does not exist or the checksum of the video has changed
     if not fmv_file.klv_file or not validation:
-        _extract_klv(fmv_file)
+        steps.append(_extract_klv)
     if not fmv_file.web_video_file or not validation:
-        _convert_video_to_mp4(fmv_file)
+        steps.append(_convert_video_to_mp4)
+
+    if steps:
+        # Both steps read the same local copy of the video and run concurrently since
+        #   they are independent subprocesses. Their outputs are only stored once both
+        #   succeed, so a failure does not leave uploaded files behind.
+        with fmv_file.file.yield_local_path() as dataset_path, tempfile.TemporaryDirectory() as tmpdir:
+            with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+                futures = [executor.submit(step, fmv_file, dataset_path, tmpdir) for step in steps]
+                outputs = {}
+                for future in futures:
+                    outputs.update(future.result())
+            if outputs:
+                _store_fmv_outputs(fmv_file, outputs)
 
     # create a model entry for that shapefile
     entry, created = get_or_create_no_commit(
@@ -7,22 +7,47 @@ from ..common import ChecksumFile, ModifiableEntry, SpatialEntry
 from ..constants import DB_SRID
 from ..mixins import TaskEventMixin
 
+# FlatGeobuf files start with "fgb", the major version and "fgb"
+FLATGEOBUF_MAGIC = b'fgb\x03fgb'
 
-def validate_archive(field_file):
-    """Validate file is a zip or tar archive."""
-    acceptable = ['application/zip', 'application/gzip']
 
-    mimetype = magic.from_buffer(field_file.read(16384), mime=True)
+def _is_geojson_text(header):
+    """Check if the start of a file looks like GeoJSON or GeoJSON-seq text."""
+    text = header.lstrip(b'\xef\xbb\xbf \t\r\n')  # BOM and whitespace
+    return text[:1] in (b'{', b'\x1e')
+
 
-    if mimetype not in acceptable:
-        raise ValidationError('Unsupported file archive.')
+def validate_archive(field_file):
+    """Validate file is a zip or tar archive or a supported vector file."""
+    acceptable = [
+        'application/zip',
+        'application/gzip',
+        'application/x-tar',
+        'application/x-sqlite3',  # GeoPackage
+        'application/json',  # GeoJSON
+        'application/geo+json',
+    ]
+
+    header = field_file.read(16384)
+    mimetype = magic.from_buffer(header, mime=True)
+
+    if mimetype in acceptable:
+        return
+    # These are detected as plain text or unknown binary data by their MIME
+    #  type, so check their content instead
+    if header.startswith(FLATGEOBUF_MAGIC) or _is_geojson_text(header):
+        return
+    raise ValidationError('Unsupported file archive.')
 
 
 class GeometryArchive(ModifiableEntry, TaskEventMixin):
-    """Container for ``zip`` archives of a shapefile.
+    """Container for archives (or single files) of vector data.
+
+    Supported are ``zip`` or ``tar`` archives of shapefiles, GeoPackages,
+    GeoJSON and FlatGeobuf files, or any of those files directly.
 
     When this model is created, it loads data from an archive into
-    a single ``GeometryEntry`` that is then associated with this entry.
+    a ``GeometryEntry`` per layer that are then associated with this entry.
     """
 
     task_funcs = (tasks.task_read_geometry_archive,)
@@ -47,4 +72,9 @@ class GeometryEntry(ModifiableEntry, SpatialEntry):
     # The actual collection is iterable so access is super easy
 
     # Can be null if not generated from uploaded ZIP file but something else
-    geometry_archive = models.OneToOneField(GeometryArchive, null=True, on_delete=models.CASCADE)
+    geometry_archive = models.ForeignKey(GeometryArchive, null=True, on_delete=models.CASCADE)
+    layer = models.CharField(
+        max_length=1000,
+        blank=True,
+        help_text='The archive member and layer name this entry was read from.',
+    )
@@ -1,15 +1,10 @@
 """Helper methods for creating a geometry entries from uploaded files."""
-from glob import glob
-import os
-import tempfile
-import zipfile
-
 from celery.utils.log import get_task_logger
-from django.conf import settings
 from django.contrib.gis.gdal import SpatialReference
 from django.contrib.gis.geos import GeometryCollection, GEOSGeometry, Polygon
 from django.core.exceptions import ValidationError
 import fiona
+from osgeo import gdal
 from shapely.geometry import shape
 from shapely.wkb import dumps
 
@@ -20,73 +15,106 @@ from .transform import transform_geometry
 
 logger = get_task_logger(__name__)
 
+# Vector formats that can be read from within an archive (or directly)
+VECTOR_EXTENSIONS = (
+    '.shp',
+    '.gpkg',
+    '.geojson',
+    '.geojsonl',
+    '.geojsons',
+    '.json',
+    '.fgb',
+)
 
-def read_geometry_archive(archive_id):
-    """Read an archive of a single shapefile (and associated) files.
 
-    This will load zipped archives of shape files and create entries
-    for a single shapefile (basename of files).
+def _read_header(path, size=512):
+    """Read the first bytes of a file through GDAL, which also handles ``/vsicurl/``."""
+    f = gdal.VSIFOpenL(str(path), 'rb')
+    if f is None:
+        return b''
+    try:
+        return gdal.VSIFReadL(1, size, f) or b''
+    finally:
+        gdal.VSIFCloseL(f)
 
-    A single shapefile will consist of a collection of one or many features
-    of varying types. We produce a single ``GeometryCollection`` of those
-    data. Hence, we associate a single shapefile with a single
-    ``GeometryCollection``.
 
-    We may need to do more checks/validation to make sure the user only
-    added a single shape file or provide a more explicit upload interface
-    where they upload the ``shp``, ``dbf``, etc. files individually and
-    we assert that they match.
+def _get_archive_root(path):
+    """Get the GDAL Virtual File System path to read a file in place.
+
+    The archive type is detected from the content of the file rather than
+    its name. Gzipped files are decompressed with ``/vsigzip/`` and their
+    decompressed content decides whether they are a tar archive or a single
+    compressed dataset.
+
+    Returns a ``(root, is_archive)`` tuple.
 
     """
-    archive = GeometryArchive.objects.get(id=archive_id)
+    path = str(path)
+    header = _read_header(path)
+    if header[:4] in (b'PK\x03\x04', b'PK\x05\x06'):  # Or an empty zip
+        return f'/vsizip/{{{path}}}', True
+    if header[:2] == b'\x1f\x8b':
+        path = f'/vsigzip/{path}'
+        header = _read_header(path)
+    if header[257:262] == b'ustar':
+        return f'/vsitar/{{{path}}}', True
+    return path, False
+
+
+def _get_vector_datasets(path):
+    """Get the paths of all vector datasets within the given file.
+
+    Archives are read in place through GDAL's ``/vsizip/``, ``/vsitar/`` or
+    ``/vsigzip/`` chained onto ``path`` (which can itself be a ``/vsicurl/``
+    URL) rather than being extracted.
+
+    Returns a list of ``(member, dataset_path)`` tuples where ``member`` is
+    the relative path within the archive (empty for non-archives).
+
+    """
+    root, is_archive = _get_archive_root(path)
+    if not is_archive:
+        # Not an archive: the file itself is a single vector dataset
+        return [('', root)]
+    members = gdal.ReadDirRecursive(root) or []
+    return [
+        (member, f'{root}/{member}')
+        for member in sorted(members)
+        if member.lower().endswith(VECTOR_EXTENSIONS)
+        and '__macosx' not in member.lower()  # Ignore resource forks
+    ]
 
-    # TODO: add a setting like this:
-    workdir = getattr(settings, 'GEODATA_WORKDIR', None)
-    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
-        with archive.file.yield_local_path() as archive_path:
-            logger.info(f'The geometry archive: {archive_path}')
-
-            # Unzip the contents to the working dir
-            with zipfile.ZipFile(archive_path, 'r') as zip_ref:
-                zip_ref.extractall(tmpdir)
-
-        msg = 'There must be one and only one shapefile in the archive. Found ({})'
-        shape_files = glob(os.path.join(tmpdir, '*.shp'))
-        if len(shape_files) > 1:
-            raise ValidationError(msg.format(len(shape_files)))
-        elif len(shape_files) == 0:
-            shape_files = glob(os.path.join(tmpdir, '**/*.shp'))
-            if len(shape_files) != 1:
-                raise ValidationError(msg.format(len(shape_files)))
-        shape_file = shape_files[0]
-
-        # load each shapefile using fiona
-        with fiona.open(shape_file) as shapes:
-            geometry_entry, created = get_or_create_no_commit(
-                GeometryEntry, defaults=dict(name=archive.file.name), geometry_archive=archive
-            )
 
-            shapes.meta  # TODO: dump this JSON into the model entry
-
-            crs_wkt = shapes.meta['crs_wkt']
-            logger.info(f'Geometry crs_wkt: {crs_wkt}')
-            spatial_ref = SpatialReference(crs_wkt)
-            logger.info(f'Geometry SRID: {spatial_ref.srid}')
-
-            collection = []
-            for item in shapes:
-                geom = shape(item['geometry'])  # not optimal?
-                # TODO: check this
-                collection.append(
-                    transform_geometry(
-                        GEOSGeometry(
-                            memoryview(dumps(geom, srid=spatial_ref.srid)), srid=spatial_ref.srid
-                        ),
-                        crs_wkt,
-                    )
+def _read_layer_geometry(dataset_path, layer):
+    """Read all features of a single layer into one ``GeometryCollection``."""
+    with fiona.open(dataset_path, layer=layer) as shapes:
+        shapes.meta  # TODO: dump this JSON into the model entry
+
+        crs_wkt = shapes.meta['crs_wkt']
+        logger.info(f'Geometry crs_wkt: {crs_wkt}')
+        spatial_ref = SpatialReference(crs_wkt)
+        logger.info(f'Geometry SRID: {spatial_ref.srid}')
+
+        collection = []
+        for item in shapes:
+            if not item['geometry']:
+                # Features are allowed to have null geometry
+                continue
+            geom = shape(item['geometry'])  # not optimal?
+            # TODO: check this
+            collection.append(
+                transform_geometry(
+                    GEOSGeometry(
+                        memoryview(dumps(geom, srid=spatial_ref.srid)), srid=spatial_ref.srid
+                    ),
+                    crs_wkt,
                 )
+            )
+    return GeometryCollection(*collection)
+
 
-    geometry_entry.data = GeometryCollection(*collection)
+def _populate_geometry_entry(geometry_entry, data):
+    geometry_entry.data = data
     geometry_entry.footprint = geometry_entry.data.convex_hull
     bounds = geometry_entry.footprint.extent
     coords = [
@@ -97,7 +125,64 @@ def read_geometry_archive(archive_id):
         (bounds[0], bounds[3]),  # Close the loop
     ]
     geometry_entry.outline = Polygon(coords)
-
     geometry_entry.save()
+    geometry_entry.populate_simplified_geometries(['data'])
+
+
+def read_geometry_archive(archive_id):
+    """Read an archive of vector data into one ``GeometryEntry`` per layer.
+
+    This supports zipped (or tarred) archives of shapefiles, GeoPackages,
+    GeoJSON(-seq) and FlatGeobuf files as well as any of those formats
+    uploaded directly. Archives are read in place with GDAL's virtual file
+    systems and may contain many datasets, each of which may contain many
+    layers.
+
+    Each layer will consist of a collection of one or many features
+    of varying types. We produce a single ``GeometryCollection`` of those
+    data. Hence, we associate a single layer with a single
+    ``GeometryCollection``.
+
+    """
+    archive = GeometryArchive.objects.get(id=archive_id)
+
+    layers = []
+    with archive.file.yield_local_path(vsi=True) as archive_path:
+        logger.info(f'The geometry archive: {archive_path}')
+
+        datasets = _get_vector_datasets(archive_path)
+        for member, dataset_path in datasets:
+            try:
+                layer_names = fiona.listlayers(dataset_path)
+            except Exception as e:  # Stray JSON files, etc.
+                logger.error(f'Unable to read vector dataset ({member}): {e}')
+                continue
+            for layer_name in layer_names:
+                # The member path disambiguates layers of the same name in different files
+                layer = f'{member}:{layer_name}' if member else layer_name
+                layers.append((layer, _read_layer_geometry(dataset_path, layer_name)))
+
+    if not layers:
+        raise ValidationError('No vector datasets found in the archive.')
+
+    # Entries read before layers were recorded have an empty layer
+    legacy = list(GeometryEntry.objects.filter(geometry_archive=archive, layer=''))
+    for layer, data in layers:
+        name = archive.file.name
+        if len(layers) > 1:
+            name = f'{name}: {layer}'
+        geometry_entry, created = get_or_create_no_commit(
+            GeometryEntry, defaults=dict(name=name), geometry_archive=archive, layer=layer
+        )
+        if created and legacy:
+            # Update the existing entry in place to keep its primary key
+            geometry_entry = legacy.pop(0)
+            geometry_entry.layer = layer
+        _populate_geometry_entry(geometry_entry, data)
+
+    # Remove entries of layers that are no longer in the archive
+    GeometryEntry.objects.filter(geometry_archive=archive).exclude(
+        layer__in=[layer for layer, _ in layers]
+    ).delete()
 
     return True
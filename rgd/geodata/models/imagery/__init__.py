@@ -10,7 +10,9 @@ from .annotation import Annotation, PolygonSegmentation, RLESegmentation, Segmen
 # flake8: noqa
 from .base import (
     BandMetaEntry,
+    ChipArchive,
     ConvertedImageFile,
+    FileMetadata,
     ImageEntry,
     ImageFile,
     ImageSet,
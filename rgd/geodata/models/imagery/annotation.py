@@ -1,13 +1,50 @@
-import base64
 import json
-import pickle
 
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import GEOSGeometry, Polygon
 from django.core.exceptions import ObjectDoesNotExist
 import numpy as np
 
+from rgd.utility import array_to_blob, blob_to_array
+
 from ..common import ModifiableEntry
 from .base import ImageEntry
+from .rle import decode_coco_counts, rle_area, rle_bbox, rle_decode, rle_iou
+
+
+def extents_to_bounds(extents):
+    """Get a pixel space bounding box Polygon containing all of the given extents.
+
+    Each extent is ``(xmin, ymin, xmax, ymax)``. Returns ``None`` if there
+    are none.
+
+    """
+    extents = np.array(list(extents), dtype=float).reshape((-1, 4))
+    if not extents.size:
+        return None
+    xmin, ymin = extents[:, :2].min(axis=0)
+    xmax, ymax = extents[:, 2:].max(axis=0)
+    bounds = Polygon.from_bbox((xmin, ymin, xmax, ymax))
+    bounds.srid = 0
+    return bounds
+
+
+def get_pixel_window(window):
+    """Coerce a pixel window to a geometry for region queries.
+
+    Parameters
+    ----------
+    window : tuple or GEOSGeometry
+        Either ``(xmin, ymin, xmax, ymax)`` in pixel coordinates or any
+        geometry in pixel space.
+
+    """
+    if isinstance(window, GEOSGeometry):
+        window = window.clone()
+    else:
+        window = Polygon.from_bbox(tuple(float(v) for v in window))
+    window.srid = 0
+    return window
 
 
 class Annotation(ModifiableEntry):
@@ -23,10 +60,58 @@ class Annotation(ModifiableEntry):
     keypoints = models.MultiPointField(null=True, srid=0)
     line = models.LineStringField(null=True, srid=0)
 
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        help_text='A hash of the source annotation content used to detect changes on re-import.',
+    )
+
+    # Spatially indexed so that annotations can be queried by pixel region
+    bounds = models.PolygonField(
+        srid=0,
+        null=True,
+        help_text='The pixel extent of the keypoints, line and segmentation of this annotation.',
+    )
+
     def segmentation_type(self):
         """Get type of segmentation."""
         return self.segmentation.get_type()
 
+    def get_segmentation(self):
+        """Get the segmentation as its most specific type, if any."""
+        try:
+            segmentation = self.segmentation
+        except ObjectDoesNotExist:
+            return None
+        for name in ('polygonsegmentation', 'rlesegmentation'):
+            try:
+                return getattr(segmentation, name)
+            except ObjectDoesNotExist:
+                pass
+        return segmentation
+
+    def update_bounds(self, segmentation=None):
+        """Set ``bounds`` from the annotation's geometry (does not save).
+
+        The segmentation can be given if it is not saved yet.
+
+        """
+        if segmentation is None and self.pk:
+            segmentation = self.get_segmentation()
+        extents = [g.extent for g in (self.keypoints, self.line) if g is not None and not g.empty]
+        if segmentation is not None:
+            extents.extend(segmentation.get_extents())
+        self.bounds = extents_to_bounds(extents)
+        return self.bounds
+
+    def save(self, *args, **kwargs):
+        # Keep the bounds current for region queries
+        self.update_bounds()
+        if kwargs.get('update_fields') is not None:
+            kwargs = kwargs.copy()
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'bounds'}
+        super(Annotation, self).save(*args, **kwargs)
+
 
 class Segmentation(models.Model):
     """A base class for segmentations as there are different kinds.
@@ -51,6 +136,12 @@ class Segmentation(models.Model):
     # This should come from the COCO format rather than be autopopulated by us
     outline = models.PolygonField(srid=0, null=True, help_text='The bounding box')
 
+    def save(self, *args, **kwargs):
+        super(Segmentation, self).save(*args, **kwargs)
+        # The bounds of the annotation include this segmentation
+        self.annotation.update_bounds(self)
+        Annotation.objects.filter(pk=self.annotation_id).update(bounds=self.annotation.bounds)
+
     def get_type(self):
         """Get type of segmentation."""
         try:
@@ -65,6 +156,12 @@ class Segmentation(models.Model):
             pass
         return 'Oultine/BBox'
 
+    def get_extents(self):
+        """Get the ``(xmin, ymin, xmax, ymax)`` pixel extents of this segmentation."""
+        if self.outline is None or self.outline.empty:
+            return []
+        return [self.outline.extent]
+
     def get_subsample_args(self, outline=False):
         """Get the GDAL arguments for subsampling with this Segmentation.
 
@@ -103,6 +200,12 @@ class PolygonSegmentation(Segmentation):
 
     feature = models.MultiPolygonField(srid=0, null=True)
 
+    def get_extents(self):
+        extents = super().get_extents()
+        if self.feature is not None and not self.feature.empty:
+            extents.append(self.feature.extent)
+        return extents
+
     def get_subsample_args(self):
         """Get the GDAL arguments for subsampling with this Segmentation."""
         # If the image is Geospatial, traslate this geometry into that SRID
@@ -113,7 +216,8 @@ class RLESegmentation(Segmentation):
     """run-length-encoded (RLE) segmentation.
 
     A bit mask of the entire image to label one thing (or a crowd of that
-    thing). The RLE array is stored as a binary blob.
+    thing). The RLE counts are stored as a binary blob of little-endian
+    unsigned integers.
 
     """
 
@@ -123,13 +227,11 @@ class RLESegmentation(Segmentation):
 
     @staticmethod
     def _array_to_blob(array):
-        if not isinstance(array, np.ndarray):
-            array = np.array(array)
-        return base64.b64encode(pickle.dumps(array))
+        return array_to_blob(array)
 
     @staticmethod
     def _blob_to_array(blob):
-        return pickle.loads(base64.b64decode(blob))
+        return blob_to_array(blob)
 
     def from_rle(self, rle):
         """Populate the entry from an RLE JSON spec.
@@ -137,9 +239,12 @@ class RLESegmentation(Segmentation):
         Parameters
         ----------
         rle : dict
-            A dictionary with ``counts`` and ``size`` fields
+            A dictionary with ``counts`` (a list or a compressed COCO string)
+            and ``size`` fields
         """
         counts = rle['counts']
+        if isinstance(counts, str):
+            counts = decode_coco_counts(counts)
         height, width = rle['size']
         self.height = height
         self.width = width
@@ -148,17 +253,31 @@ class RLESegmentation(Segmentation):
     def to_rle(self):
         """Generate an RLE JSON spec from the entry."""
         counts = self._blob_to_array(self.blob)
-        return {'counts': list(counts), 'size': [self.height, self.width]}
+        return {'counts': counts.tolist(), 'size': [self.height, self.width]}
 
     def to_mask(self):
         """Produce a 2D array of booleans for this RLE Segmentation."""
         counts = self._blob_to_array(self.blob)
-        shape = (self.height, self.width)
-        mask = np.zeros(shape, dtype=np.bool_).ravel()
-        current = 0
-        flag = False
-        for count in counts:
-            mask[current : current + count] = flag
-            current += count
-            flag = not flag
-        return mask.reshape(shape)
+        return rle_decode(counts, (self.height, self.width))
+
+    def area(self):
+        """Get the number of pixels in the mask without decoding it."""
+        return rle_area(self._blob_to_array(self.blob))
+
+    def bbox(self):
+        """Get the ``[x, y, width, height]`` bounding box of the mask without decoding it."""
+        return rle_bbox(self._blob_to_array(self.blob), self.width)
+
+    def get_extents(self):
+        extents = super().get_extents()
+        bbox = self.bbox()
+        if bbox is not None:
+            x, y, w, h = bbox
+            extents.append((x, y, x + w, y + h))
+        return extents
+
+    def iou(self, other):
+        """Get the intersection over union with another RLE Segmentation of the same image."""
+        if (self.height, self.width) != (other.height, other.width):
+            raise ValueError('RLE segmentations must be the same size.')
+        return rle_iou(self._blob_to_array(self.blob), self._blob_to_array(other.blob))
@@ -1,12 +1,17 @@
 """Base classes for raster dataset entries."""
+import hashlib
+import json
+
 from django.contrib.gis.db import models
 from django.contrib.postgres import fields
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.utils.translation import gettext_lazy as _
 
 from ... import tasks
 from ..common import ChecksumFile, ModifiableEntry, SpatialEntry
-from ..mixins import TaskEventMixin
+from ..constants import DB_SRID, SUBSAMPLE_FORMAT
+from ..mixins import Status, TaskEventMixin
 
 
 class ImageFile(ModifiableEntry, TaskEventMixin):
@@ -50,6 +55,22 @@ class ImageEntry(ModifiableEntry):
     height = models.PositiveIntegerField()
     width = models.PositiveIntegerField()
     number_of_bands = models.PositiveIntegerField()
+    is_cog = models.BooleanField(
+        null=True, help_text='Whether the original file is a valid Cloud Optimized GeoTIFF.'
+    )
+    cog_errors = models.TextField(
+        blank=True, help_text='The reasons the original file is not a Cloud Optimized GeoTIFF.'
+    )
+
+    def get_annotations_in_window(self, window):
+        """Get the annotations of this image that intersect a pixel window.
+
+        See ``get_pixel_window`` for the accepted windows.
+
+        """
+        from .annotation import get_pixel_window
+
+        return self.annotation_set.filter(bounds__intersects=get_pixel_window(window))
 
 
 class ImageSet(ModifiableEntry):
@@ -85,6 +106,18 @@ class ImageSet(ModifiableEntry):
             annots[image.pk] = image.annotation_set.all()
         return annots
 
+    def get_annotations_in_window(self, window):
+        """Get the annotations of all images in this set that intersect a pixel window.
+
+        This is a single query across all images rather than one per image.
+
+        """
+        from .annotation import Annotation, get_pixel_window
+
+        return Annotation.objects.filter(
+            image__imageset=self, bounds__intersects=get_pixel_window(window)
+        )
+
 
 class RasterEntry(ModifiableEntry, TaskEventMixin):
     """This class is a container for the metadata of a raster.
@@ -166,20 +199,142 @@ class BandMetaEntry(ModifiableEntry):
     interpretation = models.TextField()
 
 
+IMAGE_METADATA_FIELDS = ('driver', 'height', 'width', 'number_of_bands', 'is_cog', 'cog_errors')
+RASTER_METADATA_FIELDS = (
+    'crs',
+    'origin',
+    'extent',
+    'resolution',
+    'transform',
+    'outline',
+    'footprint',
+)
+
+
+class FileMetadata(ModifiableEntry):
+    """The meta info read from a file, cached by the checksum of the file.
+
+    Identical files in different ``ChecksumFile`` entries share this so
+    that ingesting duplicates does not open them again.
+
+    """
+
+    checksum = models.CharField(max_length=128, unique=True)  # sha512
+
+    # ImageEntry fields
+    driver = models.CharField(max_length=100)
+    height = models.PositiveIntegerField()
+    width = models.PositiveIntegerField()
+    number_of_bands = models.PositiveIntegerField()
+    is_cog = models.BooleanField(null=True)
+    cog_errors = models.TextField(blank=True)
+
+    # BandMetaEntry fields of each band
+    band_descriptions = fields.ArrayField(models.TextField(blank=True), default=list)
+    band_dtypes = fields.ArrayField(models.CharField(max_length=20, blank=True), default=list)
+    band_nodata_values = fields.ArrayField(models.FloatField(null=True), default=list)
+    band_interpretations = fields.ArrayField(models.TextField(), default=list)
+
+    # RasterMetaEntry fields, null if the file is not georeferenced
+    crs = models.TextField(null=True, blank=True, help_text='PROJ string')
+    origin = fields.ArrayField(models.FloatField(), size=2, null=True)
+    extent = fields.ArrayField(models.FloatField(), size=4, null=True)
+    resolution = fields.ArrayField(models.FloatField(), size=2, null=True)
+    transform = fields.ArrayField(models.FloatField(), size=6, null=True)
+    outline = models.PolygonField(srid=DB_SRID, null=True)
+    footprint = models.PolygonField(srid=DB_SRID, null=True)
+
+    @classmethod
+    def from_metadata(cls, checksum, metadata):
+        """Create an unsaved entry from the meta info of ``etl.get_file_metadata``."""
+        entry = cls(checksum=checksum, **metadata['image'])
+        bands = metadata['bands']
+        entry.band_descriptions = [band['description'] or '' for band in bands]
+        entry.band_dtypes = [band['dtype'] for band in bands]
+        entry.band_nodata_values = [band['nodata_value'] for band in bands]
+        entry.band_interpretations = [band['interpretation'] for band in bands]
+        if metadata['raster'] is not None:
+            for k in RASTER_METADATA_FIELDS:
+                setattr(entry, k, metadata['raster'][k])
+        return entry
+
+    def to_metadata(self):
+        """Get the meta info in the format of ``etl.get_file_metadata``."""
+        bands = [
+            dict(
+                band_number=i,
+                description=description,
+                dtype=dtype,
+                nodata_value=nodata_value,
+                interpretation=interpretation,
+            )
+            for i, (description, dtype, nodata_value, interpretation) in enumerate(
+                zip(
+                    self.band_descriptions,
+                    self.band_dtypes,
+                    self.band_nodata_values,
+                    self.band_interpretations,
+                ),
+                start=1,
+            )
+        ]
+        raster = None
+        if self.crs is not None:
+            raster = {k: getattr(self, k) for k in RASTER_METADATA_FIELDS}
+        return dict(
+            image={k: getattr(self, k) for k in IMAGE_METADATA_FIELDS},
+            bands=bands,
+            raster=raster,
+        )
+
+
 class ConvertedImageFile(ModifiableEntry, TaskEventMixin):
     """A model to store converted versions of a raster entry."""
 
     task_funcs = (tasks.task_convert_to_cog,)
     converted_file = models.OneToOneField(ChecksumFile, on_delete=models.SET_NULL, null=True)
+    is_source_alias = models.BooleanField(
+        default=False,
+        help_text='Whether the converted file is the source image file, which already is a COG.',
+    )
     source_image = models.OneToOneField(ImageEntry, on_delete=models.CASCADE)
 
+    profile = models.CharField(
+        max_length=20,
+        default='default',
+        help_text='The conversion profile (compression and tiling) to use.',
+    )
+    conversion_time = models.FloatField(
+        null=True, blank=True, help_text='The number of seconds the conversion took.'
+    )
+    size_ratio = models.FloatField(
+        null=True, blank=True, help_text='The size of the converted file relative to the source.'
+    )
+
     def _post_delete(self, *args, **kwargs):
-        # Cleanup the associated ChecksumFile
-        self.converted_file.delete()
+        # Cleanup the associated ChecksumFile unless it is the source image file
+        if self.converted_file and not self.is_source_alias:
+            self.converted_file.delete()
+
+
+def _normalize_parameters(value):
+    """Normalize subsample parameters so that equivalent requests compare equal."""
+    if isinstance(value, dict):
+        return {str(k): _normalize_parameters(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize_parameters(v) for v in value]
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    return float(value)
 
 
 class SubsampledImage(ModifiableEntry, TaskEventMixin):
-    """A subsample of an ImageEntry."""
+    """A subsample of an ImageEntry.
+
+    Subsamples are keyed by their content (see ``get_cache_key``) so that
+    identical subsamples share a single stored ``data`` file.
+
+    """
 
     task_funcs = (tasks.task_populate_subsampled_image,)
 
@@ -195,7 +350,48 @@ class SubsampledImage(ModifiableEntry, TaskEventMixin):
     )
     sample_parameters = models.JSONField()
 
-    data = models.OneToOneField(ChecksumFile, on_delete=models.SET_NULL, null=True)
+    data = models.ForeignKey(ChecksumFile, on_delete=models.SET_NULL, null=True)
+    cache_key = models.CharField(
+        max_length=64,
+        blank=True,
+        db_index=True,
+        help_text='A hash of the source content, subsample arguments and output format.',
+    )
+
+    def get_cache_key(self):
+        """Get a key of the content of this subsample.
+
+        Subsamples of sources with the same checksum and the same normalized
+        GDAL arguments produce the same output. The source is identified by
+        ``ChecksumFile.get_content_key`` so that the source is never read
+        here. Returns an empty string if the key cannot be determined.
+
+        """
+        source = self.source_image.image_file.file.get_content_key()
+        try:
+            kwargs = self.to_kwargs()
+        except (KeyError, ValueError, ObjectDoesNotExist):
+            return ''
+        content = {
+            'source': source,
+            'kwargs': _normalize_parameters(kwargs),
+            'format': SUBSAMPLE_FORMAT,
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def get_cached_data(self):
+        """Get the data of another succeeded subsample with the same ``cache_key``, if any."""
+        if not self.cache_key:
+            return None
+        match = (
+            SubsampledImage.objects.filter(
+                cache_key=self.cache_key, status=Status.SUCCEEDED, data__isnull=False
+            )
+            .exclude(pk=self.pk)
+            .select_related('data')
+            .first()
+        )
+        return match.data if match else None
 
     def to_kwargs(self):
         """Convert ``sample_parameters`` to kwargs ready for GDAL.
@@ -225,8 +421,47 @@ class SubsampledImage(ModifiableEntry, TaskEventMixin):
             raise ValueError('Sample type ({}) unknown.'.format(self.sample_type))
 
     def _post_delete(self, *args, **kwargs):
-        # Cleanup the associated ChecksumFile
-        self.data.delete()
+        # Cleanup the associated ChecksumFile unless it is shared
+        if self.data and not SubsampledImage.objects.filter(data=self.data).exists():
+            self.data.delete()
+
+
+class ChipArchive(ModifiableEntry, TaskEventMixin):
+    """Training chips of the annotations of an ``ImageSet``.
+
+    All chips are extracted by a single task into uncompressed tar shards
+    with a JSON index of the shard, byte offset and size of each chip.
+
+    """
+
+    task_funcs = (tasks.task_populate_chip_archive,)
+    image_set = models.ForeignKey(ImageSet, on_delete=models.CASCADE)
+    label = models.CharField(
+        max_length=100, blank=True, help_text='Only extract chips of annotations with this label.'
+    )
+    padding = models.PositiveIntegerField(
+        default=0, help_text='The number of pixels to pad around each annotation.'
+    )
+    shard_size = models.PositiveIntegerField(
+        default=10000, help_text='The maximum number of chips in each shard.'
+    )
+
+    shards = models.ManyToManyField(ChecksumFile, blank=True, related_name='+')
+    index_file = models.OneToOneField(
+        ChecksumFile, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    count = models.PositiveIntegerField(default=0, help_text='The number of chips extracted.')
+
+    def _pre_delete(self, *args, **kwargs):
+        # The shards must be found before their M2M rows are deleted
+        self._shard_ids = list(self.shards.values_list('pk', flat=True))
+
+    def _post_delete(self, *args, **kwargs):
+        # Cleanup the associated ChecksumFiles
+        for shard in ChecksumFile.objects.filter(pk__in=getattr(self, '_shard_ids', [])):
+            shard.delete()
+        if self.index_file:
+            self.index_file.delete()
 
 
 class KWCOCOArchive(ModifiableEntry, TaskEventMixin):
@@ -255,6 +490,9 @@ class KWCOCOArchive(ModifiableEntry, TaskEventMixin):
     )
     # Allowed null because model must be saved before task can populate this
     image_set = models.OneToOneField(ImageSet, on_delete=models.SET_NULL, null=True)
+    progress = models.FloatField(
+        default=0, help_text='The fraction of images read by the most recent import.'
+    )
 
     def _post_delete(self, *args, **kwargs):
         # Frist delete all the images in the image set
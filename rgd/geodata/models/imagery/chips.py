@@ -0,0 +1,188 @@
+"""Extract training chips of many annotations into sharded tar archives.
+
+Each image is opened once and its chips are read with windowed reads, then
+packed into uncompressed tar shards along with an index of where every
+chip is so that they can be read without unpacking the shards.
+
+"""
+import io
+from itertools import groupby
+import json
+import math
+import os
+import tarfile
+import tempfile
+import time
+
+from celery.utils.log import get_task_logger
+from django.conf import settings
+import rasterio
+from rasterio.windows import Window
+
+from ..common import ChecksumFile
+from .annotation import Annotation
+from .base import ChipArchive
+from .subsample import encode_subsample
+
+logger = get_task_logger(__name__)
+
+
+def _get_chip_window(bounds, padding, width, height):
+    """Get the pixel window of a chip clipped to the image, or ``None`` if it is outside."""
+    xmin, ymin, xmax, ymax = bounds.extent
+    col_off = max(math.floor(xmin) - padding, 0)
+    row_off = max(math.floor(ymin) - padding, 0)
+    # Points and lines still get at least one pixel
+    col_end = min(max(math.ceil(xmax), math.floor(xmin) + 1) + padding, width)
+    row_end = min(max(math.ceil(ymax), math.floor(ymin) + 1) + padding, height)
+    if col_end <= col_off or row_end <= row_off:
+        return None
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def _read_chip(src, window):
+    """Read a window of an open dataset into the bytes of a GeoTIFF."""
+    data = src.read(window=window)
+    content, _ = encode_subsample(src, data, src.window_transform(window))
+    return content
+
+
+class _ShardWriter:
+    """Write chips to numbered tar shards of at most ``shard_size`` chips."""
+
+    def __init__(self, directory, shard_size):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.paths = []
+        self.index = []
+        self._tar = None
+        self._count = 0
+
+    def _next_shard(self):
+        self.close()
+        path = os.path.join(self.directory, f'chips-{len(self.paths):05d}.tar')
+        self.paths.append(path)
+        self._tar = tarfile.open(path, 'w')
+        self._count = 0
+
+    def add(self, name, data, **info):
+        if self._tar is None or self._count >= self.shard_size:
+            self._next_shard()
+        member = tarfile.TarInfo(name)
+        member.size = len(data)
+        member.mtime = time.time()
+        self._tar.addfile(member, io.BytesIO(data))
+        # The data is padded to a whole number of blocks after its header
+        offset = self._tar.offset - math.ceil(member.size / tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.index.append(
+            dict(
+                info,
+                shard=os.path.basename(self.paths[-1]),
+                member=name,
+                offset=offset,
+                size=member.size,
+            )
+        )
+        self._count += 1
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+
+def write_chip_shards(annotations, directory, shard_size=10000, padding=0):
+    """Write the chips of many annotations to tar shards in a directory.
+
+    Chips are the bounds of each annotation (plus ``padding`` pixels),
+    read from the annotation's image as GeoTIFFs. Annotations are grouped
+    by image so that each image is opened once.
+
+    Parameters
+    ----------
+    annotations : QuerySet
+        The ``Annotation`` entries to extract chips of.
+    directory : str
+        Where to write the shards.
+
+    Returns
+    -------
+    tuple
+        The paths of the shards and the index, a list with the shard,
+        member name, byte offset and size of every chip.
+
+    """
+    writer = _ShardWriter(directory, shard_size)
+    annotations = (
+        annotations.filter(bounds__isnull=False)
+        .select_related('image__image_file__file')
+        .order_by('image', 'pk')
+    )
+    try:
+        for _, group in groupby(annotations.iterator(), key=lambda a: a.image_id):
+            group = list(group)
+            image = group[0].image
+            with image.image_file.file.yield_local_path(vsi=True) as file_path, rasterio.open(
+                file_path
+            ) as src:
+                for annotation in group:
+                    window = _get_chip_window(annotation.bounds, padding, image.width, image.height)
+                    if window is None:
+                        continue
+                    writer.add(
+                        f'{annotation.pk}.tif',
+                        _read_chip(src, window),
+                        annotation=annotation.pk,
+                        image=image.pk,
+                        label=annotation.label,
+                        window=[window.col_off, window.row_off, window.width, window.height],
+                    )
+            logger.info(f'Extracted chips of image ({image.pk}): {len(writer.index)} chips')
+    finally:
+        writer.close()
+    return writer.paths, writer.index
+
+
+def populate_chip_archive(chip_archive_id):
+    """Extract the chips of a ``ChipArchive`` into sharded tar files in a single task."""
+    chip_archive = ChipArchive.objects.get(id=chip_archive_id)
+    annotations = Annotation.objects.filter(image__imageset=chip_archive.image_set)
+    if chip_archive.label:
+        annotations = annotations.filter(label=chip_archive.label)
+
+    # Remove the outputs of any previous run
+    for shard in chip_archive.shards.all():
+        shard.delete()
+    if chip_archive.index_file:
+        chip_archive.index_file.delete()
+        chip_archive.index_file = None
+
+    workdir = getattr(settings, 'GEODATA_WORKDIR', None)
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+        paths, index = write_chip_shards(
+            annotations, tmpdir, shard_size=chip_archive.shard_size, padding=chip_archive.padding
+        )
+        shards = []
+        for path in paths:
+            shard = ChecksumFile(name=os.path.basename(path))
+            with open(path, 'rb') as f:
+                shard.file.save(os.path.basename(path), f)
+            shards.append(shard)
+        chip_archive.shards.set(shards)
+
+        index_path = os.path.join(tmpdir, 'index.json')
+        with open(index_path, 'w') as f:
+            json.dump({'shards': [os.path.basename(p) for p in paths], 'chips': index}, f)
+        chip_archive.index_file = ChecksumFile(name='index.json')
+        with open(index_path, 'rb') as f:
+            chip_archive.index_file.file.save('index.json', f)
+
+    chip_archive.count = len(index)
+    chip_archive.save(
+        update_fields=[
+            'index_file',
+            'count',
+        ]
+    )
+    logger.info(f'Wrote ({len(index)}) chips to ({len(paths)}) shards')
+    return chip_archive.id
@@ -1,9 +1,16 @@
 """Helper methods for creating a ``GDALRaster`` entry from a raster file."""
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
+import copy
+import hashlib
+import io
 import json
 import os
-import tempfile
-import zipfile
+import posixpath
+import tarfile
+import threading
+from urllib.parse import urlparse
 
 from celery.utils.log import get_task_logger
 from django.conf import settings
@@ -15,24 +22,37 @@ from django.contrib.gis.geos import (
     Point,
     Polygon,
 )
+from django.core.files import File
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
 import kwcoco
 import kwimage
 import numpy as np
 from osgeo import gdal
 import rasterio
-from rasterio import Affine, MemoryFile
+from rasterio import Affine
+from rasterio.dtypes import dtype_fwd
+from rasterio.enums import ColorInterp
 import rasterio.features
+import rasterio.transform
 import rasterio.warp
-from rasterio.warp import Resampling, calculate_default_transform, reproject, transform_bounds
+from rasterio.warp import transform_bounds
 
-from rgd.utility import get_or_create_no_commit
+from rgd.utility import (
+    bulk_create_inherited,
+    get_or_create_no_commit,
+    safe_urlopen,
+    url_file_to_local_path,
+)
 
 from ..common import ChecksumFile
 from ..constants import DB_SRID
+from ..geometry.etl import _read_header
 from .annotation import Annotation, PolygonSegmentation, RLESegmentation, Segmentation
 from .base import (
     BandMetaEntry,
     ConvertedImageFile,
+    FileMetadata,
     ImageEntry,
     ImageFile,
     ImageSet,
@@ -40,6 +60,7 @@ from .base import (
     RasterEntry,
     RasterMetaEntry,
 )
+from .subsample import validate_cloud_optimized_geotiff
 
 logger = get_task_logger(__name__)
 
@@ -47,91 +68,17 @@ GDAL_DATA = os.path.join(os.path.dirname(rasterio.__file__), 'gdal_data')
 os.environ['GDAL_DATA'] = GDAL_DATA
 
 
-MAX_LOAD_SHAPE = (4000, 4000)
-
-
-def _read_image_to_entry(image_entry, image_file_path):
-
-    with rasterio.open(image_file_path) as src:
-        image_entry.number_of_bands = src.count
-        image_entry.driver = src.driver
-        image_entry.height = src.shape[0]
-        image_entry.width = src.shape[1]
-
-        # A catch-all metadata feild:
-        # TODO: image_entry.metadata =
-
-        # These are things I couldn't figure out how to get with gdal directly
-        dtypes = src.dtypes
-        interps = src.colorinterp
-
-    # No longer editing image_entry
-    image_entry.save()
-
-    # Rasterio is no longer open... using gdal directly:
-    gsrc = gdal.Open(str(image_file_path))  # Have to cast Path to str
-
-    n = gsrc.RasterCount
-    if n != image_entry.number_of_bands:
-        # Sanity check
-        raise ValueError('gdal detects different number of bands than rasterio.')
-    for i in range(n):
-        gdal_band = gsrc.GetRasterBand(i + 1)  # off by 1 indexing
-        band_meta = BandMetaEntry()
-        band_meta.parent_image = image_entry
-        band_meta.band_number = i + 1  # off by 1 indexing
-        band_meta.description = gdal_band.GetDescription()
-        band_meta.nodata_value = gdal_band.GetNoDataValue()
-        try:
-            band_meta.dtype = dtypes[i]
-        except IndexError:
-            pass
-        # TODO: seperate out band stats into separate tasks
-        # bmin, bmax, mean, std = gdal_band.GetStatistics(True, True)
-        # band_meta.min = bmin
-        # band_meta.max = bmax
-        # band_meta.mean = mean
-        # band_meta.std = std
-
-        try:
-            band_meta.interpretation = interps[i].name
-        except IndexError:
-            pass
-
-        # Save this band entirely
-        band_meta.save()
-
-
-def read_image_file(ife):
-    """Image ingestion routine.
-
-    This helper will open an image file from ``ImageFile`` and create a
-    ``ImageEntry`` and collection of ``BandMetaEntry`` entries.
-
-    """
-    # Fetch the image file this Layer corresponds to
-    if not isinstance(ife, ImageFile):
-        ife = ImageFile.objects.get(id=ife)
-
-    with ife.file.yield_local_path(vsi=True) as file_path:
-        image_entry, created = get_or_create_no_commit(
-            ImageEntry, defaults=dict(name=ife.file.name), image_file=ife
-        )
-        if not created:
-            # Clear out associated entries because they could be invalid
-            BandMetaEntry.objects.filter(parent_image=image_entry).delete()
-            ConvertedImageFile.objects.filter(source_image=image_entry).delete()
+# The largest shape to read raster masks at for footprints
+MAX_LOAD_SHAPE = (1024, 1024)
 
-        _read_image_to_entry(image_entry, file_path)
 
-    return image_entry
+# The number of files to keep the meta info of in memory
+METADATA_CACHE_SIZE = 256
 
 
-def _extract_raster_outline_fast(src):
+def _extract_raster_outline_fast(crs, bounds):
     dst_crs = rasterio.crs.CRS.from_epsg(DB_SRID)
-    left, bottom, right, top = transform_bounds(
-        src.crs, dst_crs, src.bounds.left, src.bounds.bottom, src.bounds.right, src.bounds.top
-    )
+    left, bottom, right, top = transform_bounds(crs, dst_crs, *bounds)
     coords = np.array(
         (
             (left, top),
@@ -144,134 +91,201 @@ def _extract_raster_outline_fast(src):
     return Polygon(coords, srid=DB_SRID)
 
 
-def _extract_raster_meta(image_file_entry):
-    """Extract all of the raster meta info in our models from an image file.
+def _read_raster_meta(ds):
+    """Read the raster meta info of an open GDAL dataset.
 
     The keys of the returned dict should match the fields of the
-    ``RasterEntry``.
+    ``RasterMetaEntry``. Returns ``None`` if the dataset is not
+    georeferenced.
 
     """
+    wkt = ds.GetProjection()
+    if not wkt:
+        return None
+    crs = rasterio.crs.CRS.from_wkt(wkt)
+    transform = Affine.from_gdal(*ds.GetGeoTransform())
+    bounds = rasterio.transform.array_bounds(ds.RasterYSize, ds.RasterXSize, transform)
     raster_meta = dict()
-    with image_file_entry.file.yield_local_path(vsi=True) as path:
-        with rasterio.open(path) as src:
-            raster_meta['crs'] = src.crs.to_proj4()
-            raster_meta['origin'] = [src.bounds.left, src.bounds.bottom]
-            raster_meta['extent'] = [
-                src.bounds.left,
-                src.bounds.bottom,
-                src.bounds.right,
-                src.bounds.top,
-            ]
-            raster_meta['resolution'] = src.res
-            raster_meta['transform'] = src.transform.to_gdal()  # TODO: check this
-            raster_meta['outline'] = _extract_raster_outline_fast(src)
-            raster_meta['footprint'] = raster_meta['outline']
+    raster_meta['crs'] = crs.to_proj4()
+    raster_meta['origin'] = [bounds[0], bounds[1]]
+    raster_meta['extent'] = list(bounds)
+    # Same as rasterio's ``res``
+    raster_meta['resolution'] = (
+        np.hypot(transform.a, transform.d),
+        np.hypot(transform.b, transform.e),
+    )
+    raster_meta['transform'] = transform.to_gdal()
+    raster_meta['outline'] = _extract_raster_outline_fast(crs, bounds)
+    raster_meta['footprint'] = raster_meta['outline']
     return raster_meta
 
 
-def _get_valid_data_footprint(src, band_num):
-    """Get ``GEOSGeometry`` of valid data footprint from the raster mask."""
-    # Determine mask resolution to prevent loading massive imagery
-    # shape = tuple(np.min([src.shape, MAX_LOAD_SHAPE], axis=0))
-    # mask = src.read_masks(band_num, out_shape=shape, resampling=5)
-    # TODO: fix transform to match this resampling
-    mask = src.dataset_mask()
+def _read_band_meta(gdal_band, band_number):
+    """Read the fields of a ``BandMetaEntry`` from a GDAL band."""
+    try:
+        interpretation = ColorInterp(gdal_band.GetColorInterpretation()).name
+    except ValueError:
+        interpretation = ColorInterp.undefined.name
+    # TODO: seperate out band stats into separate tasks
+    return dict(
+        band_number=band_number,
+        description=gdal_band.GetDescription(),
+        nodata_value=gdal_band.GetNoDataValue(),
+        dtype=dtype_fwd.get(gdal_band.DataType) or '',
+        interpretation=interpretation,
+    )
+
+
+def _read_metadata(file_path):
+    """Read all of the meta info in our models from a single open of a file.
 
-    # Extract feature shapes and values from the array.
-    # Assumes already working in correct spatial reference
-    for geom, val in rasterio.features.shapes(mask, transform=src.transform):
-        # Ignore the 0-feature and only return on valid data feature
-        if val:
-            return GEOSGeometry(json.dumps(geom))
+    Only the header of the file is read, so this is cheap over ``/vsicurl``.
 
-    raise ValueError('No valid raster footprint found.')
+    Returns
+    -------
+    dict
+        The fields of the ``ImageEntry`` under ``'image'``, of each
+        ``BandMetaEntry`` under ``'bands'`` and of the ``RasterMetaEntry``
+        under ``'raster'`` (``None`` if the file is not georeferenced).
 
+    """
+    ds = gdal.Open(str(file_path))  # Have to cast Path to str
+    if ds is None:
+        raise ValueError(f'GDAL cannot open {file_path}.')
+    # Check if the file can be served as is without converting to COG
+    cog_errors = validate_cloud_optimized_geotiff(ds)
+    metadata = dict(
+        image=dict(
+            number_of_bands=ds.RasterCount,
+            driver=ds.GetDriver().ShortName,
+            height=ds.RasterYSize,
+            width=ds.RasterXSize,
+            is_cog=not cog_errors,
+            cog_errors='\n'.join(cog_errors),
+        ),
+        bands=[_read_band_meta(ds.GetRasterBand(i), i) for i in range(1, ds.RasterCount + 1)],
+        raster=_read_raster_meta(ds),
+    )
+    ds = None
+    return metadata
 
-@contextmanager
-def _yield_downsampled_raster(raster):
-    # https://gis.stackexchange.com/questions/329434/creating-an-in-memory-rasterio-dataset-from-numpy-array/329439#329439
-    max_n = np.product(MAX_LOAD_SHAPE)
-    n = raster.height * raster.width
-    scale = 1.0
-    if n > max_n:
-        scale = max_n / n
-
-    if scale == 1.0:
-        yield raster
-        return
 
-    t = raster.transform
-    # rescale the metadata
-    transform = Affine(t.a / scale, t.b, t.c, t.d, t.e / scale, t.f)
-    height = int(raster.height * scale)
-    width = int(raster.width * scale)
+_metadata_cache = OrderedDict()
+_metadata_cache_lock = threading.Lock()
 
-    profile = raster.profile
-    profile.update(transform=transform, height=height, width=width)
 
-    data = raster.read(
-        out_shape=(raster.count, height, width),
-        resampling=Resampling.bilinear,
-    )
+def _get_cached_metadata(key):
+    """Get the meta info of a checksum from memory or the ``FileMetadata`` table."""
+    with _metadata_cache_lock:
+        if key in _metadata_cache:
+            _metadata_cache.move_to_end(key)
+            return _metadata_cache[key]
+    try:
+        return FileMetadata.objects.get(checksum=key).to_metadata()
+    except FileMetadata.DoesNotExist:
+        return None
 
-    with MemoryFile() as memfile:
-        with memfile.open(**profile) as dataset:
-            dataset.write(data)
-            del data
 
-        with memfile.open() as dataset:  # Reopen as DatasetReader
-            yield dataset  # Note yield not return
+def get_file_metadata(checksum_file):
+    """Get the meta info of a ``ChecksumFile``, reading it only once.
 
+    The meta info is cached in memory and in the ``FileMetadata`` table,
+    keyed by ``ChecksumFile.get_content_key`` so that the file is never
+    read in full to find the key. Files with a known checksum share the
+    meta info of identical files. See ``_read_metadata`` for the returned
+    dict. Each call gets a copy that is safe to modify.
+
+    """
+    key = checksum_file.get_content_key()
+    metadata = _get_cached_metadata(key)
+    if metadata is None:
+        with checksum_file.yield_local_path(vsi=True) as file_path:
+            metadata = _read_metadata(file_path)
+        try:
+            with transaction.atomic():
+                FileMetadata.from_metadata(key, metadata).save()
+        except IntegrityError:
+            pass  # Cached by a concurrent read of an identical file
+    with _metadata_cache_lock:
+        _metadata_cache[key] = metadata
+        while len(_metadata_cache) > METADATA_CACHE_SIZE:
+            _metadata_cache.popitem(last=False)
+    return copy.deepcopy(metadata)
+
+
+def _read_image_to_entry(image_entry, metadata):
+    for k, v in metadata['image'].items():
+        setattr(image_entry, k, v)
+    # No longer editing image_entry
+    image_entry.save()
+
+    now = timezone.now()
+    bands = [
+        BandMetaEntry(parent_image=image_entry, created=now, modified=now, **band)
+        for band in metadata['bands']
+    ]
+    # All of the bands in one statement: hyperspectral images can have hundreds
+    bulk_create_inherited(BandMetaEntry, bands)
 
-@contextmanager
-def _reproject_raster(file_path, epsg):
-    """Reproject an open raster to given spatial reference.
 
-    This will return an open rasterio handle.
+def read_image_file(ife):
+    """Image ingestion routine.
+
+    This helper will open an image file from ``ImageFile`` and create a
+    ``ImageEntry`` and collection of ``BandMetaEntry`` entries.
 
     """
-    dst_crs = rasterio.crs.CRS.from_epsg(epsg)
-    with rasterio.open(file_path, 'r') as src:
-        if src.crs == dst_crs:
-            # If raster already in desired CRS, return itself
-            yield src
-            return
-        workdir = getattr(settings, 'GEODATA_WORKDIR', None)
-        with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
-            # Get a downsampled version of the original raster
-            with _yield_downsampled_raster(src) as dsrc:
-                # If raster is NTIF format, convert first
-                if dsrc.driver == 'NITF':
-                    f = dsrc.files[0]
-                    output_path = os.path.join(tmpdir, os.path.basename(f)) + '.tiff'
-                    ds = gdal.Open(f)
-                    ds = gdal.Translate(output_path, ds, options=['-of', 'GTiff'])
-                    ds = None
-                    # TODO: this file is not closed properly.
-                    dsrc = rasterio.open(output_path, 'r')
-
-                transform, width, height = calculate_default_transform(
-                    dsrc.crs, dst_crs, dsrc.width, dsrc.height, *dsrc.bounds
-                )
-                kwargs = dsrc.meta.copy()
-                kwargs.update(
-                    {'crs': dst_crs, 'transform': transform, 'width': width, 'height': height}
-                )
-                path = os.path.join(tmpdir, 'temp_raster')
-                with rasterio.open(path, 'w', **kwargs) as dst:
-                    for i in range(1, dsrc.count + 1):
-                        reproject(
-                            source=rasterio.band(dsrc, i),
-                            destination=rasterio.band(dst, i),
-                            src_transform=dsrc.transform,
-                            src_crs=dsrc.crs,
-                            dst_transform=transform,
-                            dst_crs=dst_crs,
-                            resampling=Resampling.bilinear,
-                        )
-                    dst.colorinterp = dsrc.colorinterp
-            with rasterio.open(path, 'r') as rsrc:
-                yield rsrc
+    # Fetch the image file this Layer corresponds to
+    if not isinstance(ife, ImageFile):
+        ife = ImageFile.objects.get(id=ife)
+
+    metadata = get_file_metadata(ife.file)
+    # Re-ingesting replaces the entry and its bands all at once
+    with transaction.atomic():
+        image_entry, created = get_or_create_no_commit(
+            ImageEntry, defaults=dict(name=ife.file.name), image_file=ife
+        )
+        if not created:
+            # Clear out associated entries because they could be invalid
+            BandMetaEntry.objects.filter(parent_image=image_entry).delete()
+            ConvertedImageFile.objects.filter(source_image=image_entry).delete()
+
+        _read_image_to_entry(image_entry, metadata)
+
+    return image_entry
+
+
+def _get_valid_data_footprint(src):
+    """Get ``GEOSGeometry`` of valid data footprint from the raster mask.
+
+    The mask is read decimated to at most ``MAX_LOAD_SHAPE``, which GDAL
+    serves from the smallest suitable overview when the file has them.
+    Only the vectorized polygon is reprojected to the DB SRID.
+
+    """
+    scale = max(src.height / MAX_LOAD_SHAPE[0], src.width / MAX_LOAD_SHAPE[1], 1.0)
+    shape = (max(int(src.height / scale), 1), max(int(src.width / scale), 1))
+    mask = src.dataset_mask(out_shape=shape)
+    # Scale the transform to the decimated mask
+    transform = src.transform * Affine.scale(src.width / shape[1], src.height / shape[0])
+
+    # Extract feature shapes and values from the array, keeping the largest
+    #  valid data feature if the data is in pieces
+    polygons = [
+        GEOSGeometry(json.dumps(geom))
+        for geom, val in rasterio.features.shapes(mask, mask=mask > 0, transform=transform)
+        if val
+    ]
+    if not polygons:
+        raise ValueError('No valid raster footprint found.')
+    polygon = max(polygons, key=lambda p: p.area)
+    # Remove the stair steps of the mask pixels
+    polygon = polygon.simplify(max(abs(transform.a), abs(transform.e)), preserve_topology=True)
+
+    geom = rasterio.warp.transform_geom(
+        src.crs, rasterio.crs.CRS.from_epsg(DB_SRID), json.loads(polygon.geojson)
+    )
+    return GEOSGeometry(json.dumps(geom), srid=DB_SRID)
 
 
 def _extract_raster_footprint(image_file_entry):
@@ -281,12 +295,9 @@ def _extract_raster_footprint(image_file_entry):
 
     """
     with image_file_entry.file.yield_local_path(vsi=True) as file_path:
-        # Reproject the raster to the DB SRID using rasterio directly rather
-        #  than transforming the extracted geometry which had issues.
-        with _reproject_raster(file_path, DB_SRID) as src:
+        with rasterio.open(file_path) as src:
             try:
-                # Only implement for first band for now
-                return _get_valid_data_footprint(src, 1)
+                return _get_valid_data_footprint(src)
             except Exception as e:  # TODO: be more clever about this
                 logger.error(f'Issue computing valid data footprint: {e}')
 
@@ -304,26 +315,63 @@ def _compare_raster_meta(a, b):
     return True
 
 
+def _get_raster_meta(image_entry):
+    """Get the raster meta info of an image from the metadata cache."""
+    try:
+        raster_meta = get_file_metadata(image_entry.image_file.file)['raster']
+    finally:
+        # This runs in worker threads which each get their own connection
+        connection.close()
+    if raster_meta is None:
+        raise ValueError(f'Image ({image_entry.pk}) has no spatial reference.')
+    return raster_meta
+
+
+def _check_raster_meta_consistent(images, metas):
+    """Check that all images of a raster have the same CRS and extent.
+
+    The extents may differ by up to the largest pixel size, as bands of
+    different resolutions are not always aligned to the exact same edges.
+
+    """
+    base_image, base_meta = images[0], metas[0]
+    tolerance = max(max(meta['resolution']) for meta in metas)
+    for image, meta in zip(images[1:], metas[1:]):
+        if meta['crs'] != base_meta['crs']:
+            raise ValueError(
+                f'Image ({image.pk}) has a different spatial reference than image '
+                f'({base_image.pk}): {meta["crs"]} != {base_meta["crs"]}'
+            )
+        if not np.allclose(meta['extent'], base_meta['extent'], rtol=0, atol=tolerance):
+            raise ValueError(
+                f'Image ({image.pk}) has a different extent than image '
+                f'({base_image.pk}): {meta["extent"]} != {base_meta["extent"]}'
+            )
+
+
 def _validate_image_set_is_raster(image_set_entry):
     """Validate if all of the images in a single ``ImageSet`` are a raster.
 
-    Will check if all have a spatial reference/geo meta info but not
-    necessarily the same.
+    Will check if all have a spatial reference/geo meta info and that they
+    share a CRS and extent. The meta info of the images is read
+    concurrently, in at most ``GEODATA_RASTER_META_WORKERS`` threads.
 
     Returns the first image's meta info if it checks out.
 
     """
-    images = list(image_set_entry.images.all())
+    images = list(image_set_entry.images.select_related('image_file__file'))
 
     if not images:
         raise ValueError('ImageSet returned no images.')
 
-    base_image = images.pop()
-    first_meta = _extract_raster_meta(base_image.image_file.imagefile)
-    for image in images:
-        _extract_raster_meta(image.image_file.imagefile)
+    # The base image has always been the last one
+    images.insert(0, images.pop())
+    max_workers = min(getattr(settings, 'GEODATA_RASTER_META_WORKERS', 8), len(images))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        metas = list(executor.map(_get_raster_meta, images))
+    _check_raster_meta_consistent(images, metas)
 
-    return first_meta
+    return metas[0]
 
 
 def populate_raster_entry(raster_entry):
@@ -346,43 +394,48 @@ def populate_raster_entry(raster_entry):
     for k, v in meta.items():
         # Yeah. This is sketchy, but it works.
         setattr(raster_meta, k, v)
+    update_fields = list(meta.keys())
     if not raster_meta.footprint:
         # Only set if not already set since this func defaults it to using outline
         raster_meta.footprint = footprint
-    raster_meta.save()
+        update_fields.append('footprint')
+    if created:
+        raster_meta.save()
+    else:
+        raster_meta.save(update_fields=update_fields)
+    # The valid data footprint is computed once the RasterMetaEntry exists
+    populate_raster_footprint(raster_entry)
     return True
 
 
-def populate_raster_footprint(raster_id):
-    raster_entry = RasterEntry.objects.get(id=raster_id)
-    # Only set the footprint if the RasterMetaEntry has been created already
-    #   this avoids a race condition where footprint might not get set correctly.
-    try:
-        raster_meta = RasterMetaEntry.objects.get(parent_raster=raster_entry)
-        base_image = raster_entry.image_set.images.first()
-        footprint = _extract_raster_footprint(base_image.image_file.imagefile)
-        if footprint:
-            raster_meta.footprint = footprint
-            raster_meta.save(update_fields=['footprint'])
-    except RasterMetaEntry.DoesNotExist:
-        logger.error('Cannot populate raster footprint yet due to race condition. Try again later.')
+def populate_raster_footprint(raster_entry):
+    """Set the footprint of a raster to the valid data of its base image."""
+    if not isinstance(raster_entry, RasterEntry):
+        raster_entry = RasterEntry.objects.get(id=raster_entry)
+    raster_meta = RasterMetaEntry.objects.get(parent_raster=raster_entry)
+    base_image = raster_entry.image_set.images.first()
+    footprint = _extract_raster_footprint(base_image.image_file.imagefile)
+    if footprint:
+        raster_meta.footprint = footprint
+        raster_meta.save(update_fields=['footprint'])
 
 
 def _fill_annotation_segmentation(annotation_entry, ann_json):
-    """For converting KWCOCO annotation JSON to an Annotation entry."""
+    """For converting KWCOCO annotation JSON to an Annotation entry.
+
+    Neither the annotation nor its segmentation are saved. Returns the
+    segmentation, if any, which must be saved after the annotation.
+
+    """
     if 'keypoints' in ann_json and ann_json['keypoints']:
         # populate keypoints - ignore 3rd value visibility
-        logger.info('Keypoints: {}'.format(ann_json['keypoints']))
+        logger.debug('Keypoints: {}'.format(ann_json['keypoints']))
         points = np.array(ann_json['keypoints']).astype(float).reshape((-1, 3))
-        keypoints = []
-        for pt in points:
-            logger.info(f'The Point: {pt}')
-            keypoints.append(Point(pt[0], pt[1]))
-        annotation_entry.keypoints = MultiPoint(*keypoints)
+        annotation_entry.keypoints = MultiPoint(*[Point(pt[0], pt[1]) for pt in points])
     if 'line' in ann_json and ann_json['line']:
         # populate line
         points = np.array(ann_json['line']).astype(float).reshape((-1, 2))
-        logger.info(f'The line: {points}')
+        logger.debug(f'The line: {points}')
         annotation_entry.line = LineString(*[(pt[0], pt[1]) for pt in points], srid=0)
     # Add a segmentation
     segmentation = None
@@ -414,11 +467,196 @@ def _fill_annotation_segmentation(annotation_entry, ann_json):
             [x0, y0],  # close the loop
         ]
         segmentation.outline = Polygon(points, srid=0)
-    annotation_entry.save()
-    # Save if a segmentation is used
     if segmentation:
         segmentation.annotation = annotation_entry
-        segmentation.save()
+    annotation_entry.update_bounds(segmentation)
+    return segmentation
+
+
+def _bulk_create_annotations(annotations, segmentations, batch_size=1000):
+    """Insert many unsaved annotations and their segmentations in batches.
+
+    ``Annotation`` inherits from ``ModifiableEntry`` and the segmentation
+    subclasses from ``Segmentation``, which ``bulk_create`` does not
+    support, so those are inserted with ``bulk_create_inherited``.
+
+    """
+    now = timezone.now()
+    for annotation in annotations:
+        annotation.created = annotation.modified = now
+    with transaction.atomic():
+        bulk_create_inherited(Annotation, annotations, batch_size=batch_size)
+        # The segmentations pick up the new annotation primary keys
+        Segmentation.objects.bulk_create(
+            [seg for seg in segmentations if type(seg) is Segmentation], batch_size=batch_size
+        )
+        for model in (PolygonSegmentation, RLESegmentation):
+            bulk_create_inherited(
+                model, [seg for seg in segmentations if type(seg) is model], batch_size=batch_size
+            )
+
+
+@contextmanager
+def _open_kwcoco_image_path(file_name):
+    """Open a KWCOCO image that is not in an archive, by absolute path or URL."""
+    if urlparse(file_name).scheme in ('http', 'https'):
+        with url_file_to_local_path(file_name) as path, open(path, 'rb') as stream:
+            yield stream, os.path.getsize(path)
+    elif os.path.isabs(file_name):
+        with open(file_name, 'rb') as stream:
+            yield stream, os.path.getsize(file_name)
+    else:
+        raise ValueError(
+            f'KWCOCO image ({file_name}) must be an absolute path or URL without an image archive.'
+        )
+
+
+class _HashingReader(io.RawIOBase):
+    """A read-only stream that computes the checksum of everything read through it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha = hashlib.sha512()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.sha.update(data)
+        return n
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+class _VSIFileReader(io.RawIOBase):
+    """A read-only stream of a file in a GDAL Virtual File System."""
+
+    def __init__(self, path):
+        self._handle = gdal.VSIFOpenL(path, 'rb')
+        if self._handle is None:
+            raise FileNotFoundError(path)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = gdal.VSIFReadL(1, len(b), self._handle) or b''
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def close(self):
+        if getattr(self, '_handle', None) is not None:
+            gdal.VSIFCloseL(self._handle)
+            self._handle = None
+        super().close()
+
+
+def _iter_kwcoco_paths(file_names):
+    for file_name in file_names:
+        with _open_kwcoco_image_path(file_name) as (stream, size):
+            yield file_name, stream, size
+
+
+def _iter_kwcoco_zip_members(root, file_names):
+    for file_name in file_names:
+        path = f'{root}/{posixpath.normpath(file_name)}'
+        stat = gdal.VSIStatL(path)
+        if stat is None:
+            raise ValueError(f'KWCOCO image ({file_name}) is not in the image archive.')
+        with _VSIFileReader(path) as stream:
+            yield file_name, stream, stat.size
+
+
+def _iter_kwcoco_tar_members(archive, file_names):
+    wanted = {posixpath.normpath(file_name): file_name for file_name in file_names}
+    for info in archive:
+        file_name = wanted.pop(posixpath.normpath(info.name), None)
+        if file_name is None or not info.isfile():
+            continue
+        with archive.extractfile(info) as stream:
+            yield file_name, stream, info.size
+    if wanted:
+        missing = ', '.join(sorted(wanted.values()))
+        raise ValueError(f'KWCOCO images ({missing}) are not in the image archive.')
+
+
+@contextmanager
+def _yield_kwcoco_images(image_archive, file_names):
+    """Yield an iterator of ``(file_name, stream, size)`` over the images of a KWCOCO dataset.
+
+    Nothing is extracted to disk. Zip archives are read in place through
+    ``/vsizip/``, member by member. Tar archives have no index, so they
+    are streamed once and their members come in the order they are stored.
+    Without an archive, the ``file_name`` of each image must be an absolute
+    path or a URL. Each stream must be read before advancing the iterator.
+
+    """
+    if image_archive is None:
+        yield _iter_kwcoco_paths(file_names)
+        return
+    with image_archive.yield_local_path(vsi=True) as archive_path:
+        if _read_header(archive_path)[:4] in (b'PK\x03\x04', b'PK\x05\x06'):
+            yield _iter_kwcoco_zip_members(f'/vsizip/{{{archive_path}}}', file_names)
+            return
+    with safe_urlopen(image_archive.get_url(internal=True)) as remote:
+        try:
+            archive = tarfile.open(fileobj=remote, mode='r|*')
+        except tarfile.ReadError:
+            raise ValueError('KWCOCO image archive must be a zip or tar file.')
+        with archive:
+            yield _iter_kwcoco_tar_members(archive, file_names)
+
+
+def _upload_kwcoco_image(file_name, stream, size, collection):
+    """Upload a KWCOCO image straight from its stream into a new ``ChecksumFile``.
+
+    The checksum is computed while uploading so the image is read once.
+    The ``ChecksumFile`` is not saved.
+
+    """
+    name = posixpath.basename(urlparse(file_name).path)
+    reader = _HashingReader(stream)
+    content = File(reader, name=name)
+    content.size = size
+    checksum_file = ChecksumFile(collection=collection)
+    checksum_file.file.save(name, content, save=False)
+    checksum_file.checksum = reader.hexdigest()
+    return checksum_file
+
+
+def _read_kwcoco_image(checksum_file):
+    """Read an uploaded KWCOCO image into a new ``ImageEntry``.
+
+    This runs in a worker thread so it closes its database connection when
+    done.
+
+    """
+    try:
+        # Create the ImageFile entry to track each image's location
+        image_file = ImageFile(file=checksum_file)
+        image_file.skip_signal = True
+        image_file.save()
+        return read_image_file(image_file)
+    finally:
+        connection.close()
+
+
+def _annotation_content_hash(ann_json, label):
+    """Hash the content of a KWCOCO annotation, ignoring its IDs."""
+    content = {k: v for k, v in ann_json.items() if k not in ('id', 'image_id')}
+    content['label'] = label
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _update_kwcoco_progress(ds_entry, progress):
+    ds_entry.progress = progress
+    # Avoid `save` so that this does not trigger any signals
+    KWCOCOArchive.objects.filter(pk=ds_entry.pk).update(progress=progress)
 
 
 def load_kwcoco_dataset(kwcoco_dataset_id):
@@ -432,73 +670,104 @@ def load_kwcoco_dataset(kwcoco_dataset_id):
             ]
         )
 
-    # TODO: add a setting like this:
-    workdir = getattr(settings, 'GEODATA_WORKDIR', None)
-    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
-
-        if ds_entry.image_set:
-            # Delete all previously existing data
-            # This should cascade to all the annotations
-            for imageentry in ds_entry.image_set.images.all():
-                imageentry.image_file.file.delete()
-        else:
-            ds_entry.image_set = ImageSet()
-        ds_entry.image_set.name = ds_entry.name
-        ds_entry.image_set.save()
-        ds_entry.save(
-            update_fields=[
-                'image_set',
-            ]  # noqa: E231
-        )
+    # Previously imported images are reused if their content has not changed
+    existing = defaultdict(list)
+    if ds_entry.image_set:
+        for image_entry in ds_entry.image_set.images.select_related('image_file__file'):
+            existing[image_entry.image_file.file.checksum].append(image_entry)
+        # Images imported without a checksum can never match
+        existing.pop('', None)
+    else:
+        ds_entry.image_set = ImageSet()
+    ds_entry.image_set.name = ds_entry.name
+    ds_entry.image_set.save()
+    _update_kwcoco_progress(ds_entry, 0.0)
+    ds_entry.save(
+        update_fields=[
+            'image_set',
+        ]  # noqa: E231
+    )
 
-        # Unarchive the images locally so we can import them when loading the spec
-        # Images could come from a URL, so this is optional
-        if ds_entry.image_archive:
-            with ds_entry.image_archive.file as file_obj:
-                logger.info(f'The KWCOCO image archive: {ds_entry.image_archive}')
-                # Place images in a local directory and keep track of root path
-                # Unzip the contents to the working dir
-                with zipfile.ZipFile(file_obj, 'r') as zip_ref:
-                    zip_ref.extractall(tmpdir)
-                logger.info(f'The extracted KWCOCO image archive: {tmpdir}')
-        else:
-            pass
-            # TODO: how should we download data from specified URLs?
-
-        # Load the KWCOCO JSON spec and make annotations on the images
-        with ds_entry.spec_file.yield_local_path() as file_path:
-            ds = kwcoco.CocoDataset(str(file_path))
-            # Set the root dir to where the images were extracted / the temp dir
-            # If images are coming from URL, they will download to here
-            ds.img_root = tmpdir
-            # Iterate over images and create an ImageEntry from them.
-            # Any images in the archive that aren't listed in the JSON will be deleted
-            for imgid in ds.imgs.keys():
-                ak = ds.index.gid_to_aids[imgid]
-                img = ds.imgs[imgid]
-                anns = [ds.anns[k] for k in ak]
-                # Create the ImageFile entry to track each image's location
-                image_file_abs_path = os.path.join(ds.img_root, img['file_name'])
-                name = os.path.basename(image_file_abs_path)
-                image_file = ImageFile()
-                image_file.collection = ds_entry.spec_file.collection
-                image_file.skip_signal = True
-                image_file.file = ChecksumFile()
-                image_file.file.file.save(name, open(image_file_abs_path, 'rb'))
-                image_file.save()
-                # Create a new ImageEntry
-                image_entry = read_image_file(image_file)
-                # Add ImageEntry to ImageSet
-                ds_entry.image_set.images.add(image_entry)
-                # Create annotations that link to that ImageEntry
-                for ann in anns:
-                    annotation_entry = Annotation()
-                    annotation_entry.image = image_entry
-                    try:
-                        annotation_entry.label = ds.cats[ann['category_id']]['name']
-                    except KeyError:
-                        pass
-                    # annotation_entry.annotator =
-                    # annotation_entry.notes =
-                    _fill_annotation_segmentation(annotation_entry, ann)
+    # Load the KWCOCO JSON spec and make annotations on the images
+    # Images could come from a URL or absolute path, so the archive is optional
+    with ds_entry.spec_file.yield_local_path() as file_path:
+        ds = kwcoco.CocoDataset(str(file_path))
+    logger.info(f'The KWCOCO image archive: {ds_entry.image_archive}')
+    imgids = defaultdict(list)
+    for imgid, img in ds.imgs.items():
+        imgids[img['file_name']].append(imgid)
+    # Images are uploaded in the order they are read from the archive, then
+    #  read into ImageEntries in a bounded pool and joined to assemble the ImageSet
+    images = {}
+    created = set()
+    n_images = len(ds.imgs)
+    max_workers = getattr(settings, 'GEODATA_KWCOCO_WORKERS', None)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        with _yield_kwcoco_images(ds_entry.image_archive, list(imgids)) as members:
+            for file_name, stream, size in members:
+                checksum_file = _upload_kwcoco_image(
+                    file_name, stream, size, ds_entry.spec_file.collection
+                )
+                if existing.get(checksum_file.checksum):
+                    # Already imported: the upload is not needed
+                    checksum_file.file.delete(save=False)
+                    image_entry = existing[checksum_file.checksum].pop()
+                    for imgid in imgids[file_name]:
+                        images[imgid] = image_entry
+                    continue
+                checksum_file.save()
+                futures[executor.submit(_read_kwcoco_image, checksum_file)] = file_name
+        for i, future in enumerate(as_completed(futures)):
+            image_entry = future.result()
+            for imgid in imgids[futures[future]]:
+                images[imgid] = image_entry
+                created.add(imgid)
+            _update_kwcoco_progress(ds_entry, (i + 1) / len(futures))
+    _update_kwcoco_progress(ds_entry, 1.0)
+    logger.info(f'Reused ({n_images - len(created)}) of ({n_images}) images')
+
+    # Delete the images that are no longer in the dataset
+    # This should cascade to all their annotations
+    for stale in existing.values():
+        for image_entry in stale:
+            image_entry.image_file.file.delete()
+    ds_entry.image_set.images.set([images[imgid] for imgid in ds.imgs])
+
+    # Annotations are built in memory and bulk inserted once all images are read
+    annotations = []
+    segmentations = []
+    stale_annotations = []
+    for imgid in ds.imgs:
+        # Existing annotations of reused images are matched by their content
+        previous = defaultdict(list)
+        if imgid not in created:
+            for pk, content_hash in Annotation.objects.filter(image=images[imgid]).values_list(
+                'pk', 'content_hash'
+            ):
+                previous[content_hash].append(pk)
+        # Create annotations that link to that ImageEntry
+        for ann in [ds.anns[k] for k in ds.index.gid_to_aids[imgid]]:
+            try:
+                label = ds.cats[ann['category_id']]['name']
+            except KeyError:
+                label = None
+            content_hash = _annotation_content_hash(ann, label)
+            if previous[content_hash]:
+                previous[content_hash].pop()
+                continue
+            annotation_entry = Annotation()
+            annotation_entry.image = images[imgid]
+            annotation_entry.label = label
+            annotation_entry.content_hash = content_hash
+            # annotation_entry.annotator =
+            # annotation_entry.notes =
+            segmentation = _fill_annotation_segmentation(annotation_entry, ann)
+            annotations.append(annotation_entry)
+            if segmentation:
+                segmentations.append(segmentation)
+        stale_annotations.extend(pk for pks in previous.values() for pk in pks)
+    Annotation.objects.filter(pk__in=stale_annotations).delete()
+    _bulk_create_annotations(annotations, segmentations)
+    logger.info(f'Created ({len(annotations)}) and deleted ({len(stale_annotations)}) annotations')
     logger.info('Done with KWCOCO ETL routine')
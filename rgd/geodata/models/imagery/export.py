@@ -0,0 +1,149 @@
+"""Export an ``ImageSet`` and its annotations to KWCOCO.
+
+The JSON spec is generated incrementally from queryset iterators so that
+datasets with millions of annotations can be written without holding them
+in memory.
+
+"""
+import json
+import zipfile
+
+from celery.utils.log import get_task_logger
+from django.core.exceptions import ObjectDoesNotExist
+
+from .annotation import Annotation
+
+logger = get_task_logger(__name__)
+
+
+def _iter_image_file_names(images):
+    """Yield each image with a file name that is unique within the dataset."""
+    seen = set()
+    for image in images:
+        file_name = image.image_file.file.name or str(image.pk)
+        if file_name in seen:
+            file_name = f'{image.pk}_{file_name}'
+        seen.add(file_name)
+        yield image, file_name
+
+
+def _iter_images(image_set):
+    images = image_set.images.select_related('image_file__file').order_by('pk')
+    return _iter_image_file_names(images.iterator())
+
+
+def _get_categories(image_set):
+    labels = (
+        Annotation.objects.filter(image__imageset=image_set, label__isnull=False)
+        .order_by('label')
+        .values_list('label', flat=True)
+        .distinct()
+    )
+    return {label: i for i, label in enumerate(labels, start=1)}
+
+
+def _flatten(coords):
+    return [float(v) for pt in coords for v in pt]
+
+
+def _kwcoco_annotation(annotation, category_ids):
+    """Convert an Annotation entry to KWCOCO annotation JSON."""
+    ann = {'id': annotation.pk, 'image_id': annotation.image_id}
+    if annotation.label in category_ids:
+        ann['category_id'] = category_ids[annotation.label]
+    if annotation.keypoints:
+        # Mark every keypoint as visible
+        ann['keypoints'] = [float(v) for x, y in annotation.keypoints.coords for v in (x, y, 2)]
+    if annotation.line:
+        ann['line'] = _flatten(annotation.line.coords)
+    try:
+        segmentation = annotation.segmentation
+    except ObjectDoesNotExist:
+        return ann
+    if segmentation.outline is not None:
+        xmin, ymin, xmax, ymax = segmentation.outline.extent
+        ann['bbox'] = [xmin, ymin, xmax - xmin, ymax - ymin]
+    try:
+        ann['segmentation'] = segmentation.rlesegmentation.to_rle()
+        return ann
+    except ObjectDoesNotExist:
+        pass
+    try:
+        feature = segmentation.polygonsegmentation.feature
+    except ObjectDoesNotExist:
+        return ann
+    if feature:
+        # Leave the loops open as in the COCO polygon format
+        ann['segmentation'] = [_flatten(poly.exterior_ring.coords[:-1]) for poly in feature]
+    return ann
+
+
+def _iter_json_list(items, chunk_size):
+    """Yield a JSON list in chunks of ``chunk_size`` items."""
+    yield '['
+    buffer = []
+    first = True
+    for item in items:
+        buffer.append(json.dumps(item))
+        if len(buffer) == chunk_size:
+            yield ('\n' if first else ',\n') + ',\n'.join(buffer)
+            buffer = []
+            first = False
+    if buffer:
+        yield ('\n' if first else ',\n') + ',\n'.join(buffer)
+    yield '\n]'
+
+
+def iter_kwcoco_json(image_set, chunk_size=2000):
+    """Generate the KWCOCO JSON spec of an ``ImageSet`` as chunks of text.
+
+    Annotations are read with their segmentations in a single query and
+    streamed in batches of ``chunk_size``.
+
+    """
+    category_ids = _get_categories(image_set)
+    categories = [{'id': i, 'name': label} for label, i in category_ids.items()]
+    yield '{"categories": ' + json.dumps(categories) + ',\n"images": '
+    images = (
+        {'id': image.pk, 'file_name': file_name, 'width': image.width, 'height': image.height}
+        for image, file_name in _iter_images(image_set)
+    )
+    yield from _iter_json_list(images, chunk_size)
+    yield ',\n"annotations": '
+    annotations = (
+        Annotation.objects.filter(image__imageset=image_set)
+        .select_related(
+            'segmentation',
+            'segmentation__polygonsegmentation',
+            'segmentation__rlesegmentation',
+        )
+        .order_by('pk')
+    )
+    yield from _iter_json_list(
+        (
+            _kwcoco_annotation(annotation, category_ids)
+            for annotation in annotations.iterator(chunk_size=chunk_size)
+        ),
+        chunk_size,
+    )
+    yield '}\n'
+
+
+def write_kwcoco_json(image_set, fileobj, chunk_size=2000):
+    """Write the KWCOCO JSON spec of an ``ImageSet`` to a text file object."""
+    for chunk in iter_kwcoco_json(image_set, chunk_size=chunk_size):
+        fileobj.write(chunk)
+
+
+def write_kwcoco_image_archive(image_set, path):
+    """Write the images of an ``ImageSet`` to a zip archive for KWCOCO.
+
+    The archive members match the ``file_name`` of the images in the
+    exported JSON spec. Images are stored without further compression.
+
+    """
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for image, file_name in _iter_images(image_set):
+            logger.info(f'Archiving image ({image.pk}) as {file_name}')
+            with image.image_file.file.yield_local_path() as file_path:
+                archive.write(file_path, arcname=file_name)
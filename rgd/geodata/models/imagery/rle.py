@@ -0,0 +1,140 @@
+"""Vectorized helpers for run-length-encoded (RLE) masks.
+
+Counts alternate between background and foreground runs, starting with
+background, over the row-major (C order) flattened mask. These operate on
+the counts directly so that areas, bounding boxes and overlaps can be
+computed for many annotations without materializing their masks.
+
+"""
+import numpy as np
+
+
+def decode_coco_counts(string):
+    """Decode the counts of a compressed COCO RLE string (as in ``pycocotools``)."""
+    counts = []
+    p = 0
+    while p < len(string):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = ord(string[p]) - 48
+            x |= (c & 0x1F) << (5 * k)
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and c & 0x10:
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+
+def rle_encode(mask):
+    """Run-length encode a 2D boolean mask into counts."""
+    flat = np.asarray(mask, dtype=np.bool_).ravel()
+    if not flat.size:
+        return np.zeros(0, dtype=np.int64)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        # Counts always start with a (here empty) background run
+        counts = np.concatenate(([0], counts))
+    return counts
+
+
+def rle_decode(counts, shape):
+    """Decode counts into a 2D boolean mask of the given shape."""
+    counts = np.asarray(counts, dtype=np.int64)
+    flags = np.arange(len(counts)) % 2 == 1
+    mask = np.repeat(flags, counts)
+    size = shape[0] * shape[1]
+    if mask.size < size:
+        # Trailing background can be left off
+        mask = np.concatenate((mask, np.zeros(size - mask.size, dtype=np.bool_)))
+    return mask[:size].reshape(shape)
+
+
+def _foreground_runs(counts):
+    """Get the start and (exclusive) end indices of the foreground runs."""
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    runs = slice(1, None, 2)
+    keep = counts[runs] > 0
+    return starts[runs][keep], ends[runs][keep]
+
+
+def rle_area(counts):
+    """Get the number of foreground pixels."""
+    return int(np.asarray(counts, dtype=np.int64)[1::2].sum())
+
+
+def rle_bbox(counts, width):
+    """Get the ``[x, y, width, height]`` bounding box of the foreground.
+
+    Returns ``None`` for an empty mask.
+
+    """
+    starts, ends = _foreground_runs(counts)
+    if not starts.size:
+        return None
+    last = ends - 1
+    row_start, col_start = np.divmod(starts, width)
+    row_end, col_end = np.divmod(last, width)
+    # Runs that wrap onto another row cover every column in between
+    wraps = row_start != row_end
+    xmin = np.where(wraps, 0, col_start).min()
+    xmax = np.where(wraps, width - 1, col_end).max()
+    ymin = row_start.min()
+    ymax = row_end.max()
+    return [int(xmin), int(ymin), int(xmax - xmin + 1), int(ymax - ymin + 1)]
+
+
+def rle_intersection(counts_a, counts_b):
+    """Get the number of foreground pixels shared by two masks of the same shape."""
+    ends_a = np.cumsum(np.asarray(counts_a, dtype=np.int64))
+    ends_b = np.cumsum(np.asarray(counts_b, dtype=np.int64))
+    if not ends_a.size or not ends_b.size:
+        return 0
+    # Split the masks at every run boundary of either and check both per segment
+    bounds = np.union1d(ends_a, ends_b)
+    lengths = np.diff(bounds, prepend=0)
+    run_a = np.searchsorted(ends_a, bounds - 1, side='right')
+    run_b = np.searchsorted(ends_b, bounds - 1, side='right')
+    both = (run_a % 2 == 1) & (run_a < ends_a.size) & (run_b % 2 == 1) & (run_b < ends_b.size)
+    return int(lengths[both].sum())
+
+
+def rle_iou(counts_a, counts_b):
+    """Get the intersection over union of two masks of the same shape."""
+    intersection = rle_intersection(counts_a, counts_b)
+    union = rle_area(counts_a) + rle_area(counts_b) - intersection
+    return intersection / union if union else 0.0
+
+
+def rle_ious(counts_a, counts_b, width):
+    """Get the pairwise IoU matrix between two lists of masks of the same shape.
+
+    Pairs whose bounding boxes do not overlap are skipped.
+
+    """
+    areas_a = [rle_area(c) for c in counts_a]
+    areas_b = [rle_area(c) for c in counts_b]
+    boxes_a = [rle_bbox(c, width) for c in counts_a]
+    boxes_b = [rle_bbox(c, width) for c in counts_b]
+    ious = np.zeros((len(counts_a), len(counts_b)))
+    for i, (a, box_a) in enumerate(zip(counts_a, boxes_a)):
+        for j, (b, box_b) in enumerate(zip(counts_b, boxes_b)):
+            if box_a is None or box_b is None or not _boxes_overlap(box_a, box_b):
+                continue
+            intersection = rle_intersection(a, b)
+            ious[i, j] = intersection / (areas_a[i] + areas_b[j] - intersection)
+    return ious
+
+
+def _boxes_overlap(box_a, box_b):
+    xa, ya, wa, ha = box_a
+    xb, yb, wb, hb = box_b
+    return xa < xb + wb and xb < xa + wa and ya < yb + hb and yb < ya + ha
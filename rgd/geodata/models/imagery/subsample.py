@@ -1,31 +1,141 @@
 """Tasks for subsampling images with GDAL."""
+from collections import OrderedDict
+from contextlib import contextmanager
+import io
 import os
 import tempfile
+import threading
+import time
 
 from celery.utils.log import get_task_logger
 from django.conf import settings
+import numpy as np
 from osgeo import gdal
 import rasterio
+from rasterio import MemoryFile
+from rasterio.errors import RasterioIOError, WindowError
+from rasterio.features import geometry_window
 from rasterio.mask import mask
+from rasterio.windows import Window, from_bounds
 
 from rgd.utility import get_or_create_no_commit
 
 from ..common import ChecksumFile
+from ..constants import SUBSAMPLE_FORMAT
 from .base import ConvertedImageFile, SubsampledImage
 
 logger = get_task_logger(__name__)
 
 
-COG_OPTIONS = [
-    '-co',
-    'COMPRESS=LZW',
-    '-co',
-    'PREDICTOR=YES',
-    '-of',
-    'COG',
-    '-co',
-    'BLOCKSIZE=256',
-]
+# Creation options of the COG driver for each conversion profile. These
+# can be extended or overridden with the ``GEODATA_COG_PROFILES`` setting.
+COG_PROFILES = {
+    'default': {'COMPRESS': 'LZW', 'PREDICTOR': 'YES', 'BLOCKSIZE': 256},
+    'deflate': {'COMPRESS': 'DEFLATE', 'LEVEL': 6, 'PREDICTOR': 'YES', 'BLOCKSIZE': 512},
+    'zstd': {'COMPRESS': 'ZSTD', 'LEVEL': 9, 'PREDICTOR': 'YES', 'BLOCKSIZE': 512},
+    'jpeg': {'COMPRESS': 'JPEG', 'QUALITY': 85, 'BLOCKSIZE': 512},
+    'webp': {'COMPRESS': 'WEBP', 'QUALITY': 85, 'BLOCKSIZE': 512},
+}
+
+
+def get_cog_options(profile='default'):
+    """Get the ``gdal_translate`` options to convert to COG with a profile.
+
+    Conversion is multi-threaded with ``NUM_THREADS`` from the
+    ``GEODATA_COG_THREADS`` setting (all CPUs by default).
+
+    """
+    profiles = {**COG_PROFILES, **getattr(settings, 'GEODATA_COG_PROFILES', {})}
+    if profile not in profiles:
+        raise ValueError('COG profile ({}) unknown.'.format(profile))
+    creation = {
+        'OVERVIEW_RESAMPLING': 'AVERAGE',
+        'NUM_THREADS': getattr(settings, 'GEODATA_COG_THREADS', 'ALL_CPUS'),
+        **profiles[profile],
+    }
+    options = ['-of', 'COG']
+    for key, value in creation.items():
+        options += ['-co', f'{key}={value}']
+    return options
+
+
+def _get_main_ifd_offset(ds):
+    """Get where the first IFD of a COG is expected: after the header and the ghost area."""
+    f = gdal.VSIFOpenL(ds.GetDescription(), 'rb')
+    if f is None:
+        return None
+    try:
+        header = gdal.VSIFReadL(1, 1024, f)
+    finally:
+        gdal.VSIFCloseL(f)
+    offset = 16 if header[2:4] in (b'\x2b\x00', b'\x00\x2b') else 8  # BigTIFF or classic
+    # GDAL writes its structural metadata between the header and the first IFD
+    prefix = b'GDAL_STRUCTURAL_METADATA_SIZE='
+    if header[offset : offset + len(prefix)] == prefix:
+        size = int(header[offset + len(prefix) : offset + len(prefix) + 6])
+        offset += len(prefix + b'000000 bytes\n') + size
+        offset += offset % 2  # IFDs are word aligned
+    return offset
+
+
+def validate_cloud_optimized_geotiff(ds):
+    """Check the layout of a GeoTIFF opened with GDAL against the COG specification.
+
+    This follows GDAL's ``validate_cloud_optimized_geotiff.py`` and only
+    reads the TIFF header: the tiling, the overviews and the order of the
+    IFDs and the image data.
+
+    Returns
+    -------
+    list
+        The reasons the dataset is not a COG, empty if it is one.
+
+    """
+    if ds.GetDriver().ShortName != 'GTiff':
+        return ['The file is not a GeoTIFF.']
+    errors = []
+    main_band = ds.GetRasterBand(1)
+    overview_count = main_band.GetOverviewCount()
+    block_width, _ = main_band.GetBlockSize()
+    if block_width == ds.RasterXSize and ds.RasterXSize > 512:
+        errors.append('The full resolution image is not tiled.')
+    if overview_count == 0 and (ds.RasterXSize > 512 or ds.RasterYSize > 512):
+        errors.append('The file is larger than 512x512 but has no overviews.')
+
+    bands = [main_band] + [main_band.GetOverview(i) for i in range(overview_count)]
+    for i, band in enumerate(bands[1:]):
+        width, _ = band.GetBlockSize()
+        if width == band.XSize and band.XSize > 512:
+            errors.append(f'Overview {i} is not tiled.')
+
+    def _offset(band, item):
+        value = band.GetMetadataItem(item, 'TIFF')
+        return int(value) if value else 0
+
+    ifd_offsets = [_offset(band, 'IFD_OFFSET') for band in bands]
+    if ifd_offsets[0] != _get_main_ifd_offset(ds):
+        errors.append('The IFD of the full resolution image is not at the start of the file.')
+    for i in range(1, len(ifd_offsets)):
+        if ifd_offsets[i] < ifd_offsets[i - 1]:
+            errors.append(f'The IFD of overview {i - 1} is before the previous IFD.')
+    data_offsets = [_offset(band, 'BLOCK_OFFSET_0_0') for band in bands]
+    for i in range(len(data_offsets) - 1):
+        if data_offsets[i] and data_offsets[i + 1] and data_offsets[i] < data_offsets[i + 1]:
+            errors.append(f'The data of overview {i} is not before the data of the higher level.')
+    if any(data_offsets) and max(ifd_offsets) > min(o for o in data_offsets if o):
+        errors.append('The IFDs are not all before the image data.')
+    return errors
+
+
+def _is_cloud_optimized(source):
+    """Check if a file is a COG from its header."""
+    with source.yield_local_path(vsi=True) as file_path:
+        ds = gdal.Open(str(file_path))
+        if ds is None:
+            return False
+        errors = validate_cloud_optimized_geotiff(ds)
+        ds = None
+    return not errors
 
 
 def _gdal_translate(src_path, dest_path, **kwargs):
@@ -35,11 +145,12 @@ def _gdal_translate(src_path, dest_path, **kwargs):
     return dest_path
 
 
-def _gdal_translate_helper(source, output_field, prefix='', **kwargs):
+def _gdal_translate_helper(source, output_field, prefix='', vsi=False, **kwargs):
     workdir = getattr(settings, 'GEODATA_WORKDIR', None)
     with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
 
-        with source.yield_local_path() as file_path:
+        # With ``vsi``, GDAL reads only what it needs with range requests
+        with source.yield_local_path(vsi=vsi) as file_path:
             logger.info(f'The image file path: {file_path}')
             output_path = os.path.join(tmpdir, prefix + os.path.basename(source.name))
             _gdal_translate(file_path, output_path, **kwargs)
@@ -49,23 +160,69 @@ def _gdal_translate_helper(source, output_field, prefix='', **kwargs):
 
 
 def convert_to_cog(cog):
-    """Populate ConvertedImageFile with COG file."""
+    """Populate ConvertedImageFile with COG file.
+
+    Sources that already are COGs are not converted: the ConvertedImageFile
+    points to the source file instead.
+
+    """
     if not isinstance(cog, ConvertedImageFile):
         cog = ConvertedImageFile.objects.get(id=cog)
     else:
         cog.refresh_from_db()
-    if not cog.converted_file:
+    image_entry = cog.source_image
+    src = image_entry.image_file.file
+    is_cog = image_entry.is_cog
+    if is_cog is None:
+        # Validated when the image is read, but older entries may not be
+        is_cog = _is_cloud_optimized(src)
+    if is_cog:
+        previous = None if cog.is_source_alias else cog.converted_file
+        cog.converted_file = src
+        cog.is_source_alias = True
+        cog.conversion_time = 0.0
+        cog.size_ratio = 1.0
+        cog.save(
+            update_fields=[
+                'converted_file',
+                'is_source_alias',
+                'conversion_time',
+                'size_ratio',
+            ]
+        )
+        if previous and previous != src:
+            # Cleanup the file of an earlier conversion
+            previous.delete()
+        logger.info(f'Source is already a COG: {src.id}')
+        return cog.id
+
+    if not cog.converted_file or cog.is_source_alias:
         cog.converted_file = ChecksumFile()
-    src = cog.source_image.image_file.imagefile.file
+    cog.is_source_alias = False
     output = cog.converted_file.file
-    _gdal_translate_helper(src, output, prefix='cog_', options=COG_OPTIONS)
+    workdir = getattr(settings, 'GEODATA_WORKDIR', None)
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+        with src.yield_local_path() as file_path:
+            output_path = os.path.join(tmpdir, 'cog_' + os.path.basename(src.name))
+            start = time.perf_counter()
+            _gdal_translate(file_path, output_path, options=get_cog_options(cog.profile))
+            cog.conversion_time = time.perf_counter() - start
+            cog.size_ratio = os.path.getsize(output_path) / max(os.path.getsize(file_path), 1)
+        with open(output_path, 'rb') as f:
+            output.save(os.path.basename(output_path), f)
     cog.converted_file.save()
     cog.save(
         update_fields=[
             'converted_file',
+            'is_source_alias',
+            'conversion_time',
+            'size_ratio',
         ]
     )
-    logger.info(f'Produced COG in ChecksumFile: {cog.converted_file.id}')
+    logger.info(
+        f'Produced COG in ChecksumFile: {cog.converted_file.id} '
+        f'({cog.conversion_time:.1f}s, size ratio {cog.size_ratio:.2f})'
+    )
     return cog.id
 
 
@@ -73,19 +230,18 @@ def _subsample_with_geojson(source, output_field, geojson, prefix=''):
     workdir = getattr(settings, 'GEODATA_WORKDIR', None)
     with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
 
-        with source.yield_local_path() as file_path:
-            # load the raster, mask it by the polygon and crop it
+        with source.yield_local_path(vsi=True) as file_path:
+            # load the raster, mask it by the polygon and crop it (a windowed read)
             with rasterio.open(file_path) as src:
                 out_image, out_transform = mask(src, [geojson], crop=True)
                 out_meta = src.meta.copy()
-                driver = src.driver
 
             output_path = os.path.join(tmpdir, prefix + os.path.basename(source.name))
 
         # save the resulting raster
         out_meta.update(
             {
-                'driver': driver,
+                'driver': SUBSAMPLE_FORMAT,
                 'height': out_image.shape[1],
                 'width': out_image.shape[2],
                 'transform': out_transform,
@@ -102,6 +258,45 @@ def _subsample_with_geojson(source, output_field, geojson, prefix=''):
             output_field.save(os.path.basename(output_path), f)
 
 
+def _supports_windowed_reads(source):
+    """Check if windows of a file can be read efficiently with range requests.
+
+    This is the case when the file is tiled or has overviews. Only the header
+    of the file is read.
+
+    """
+    with source.yield_local_path(vsi=True) as file_path:
+        try:
+            with rasterio.open(file_path) as src:
+                _, block_width = src.block_shapes[0]
+                return block_width < src.width or bool(src.overviews(1))
+        except RasterioIOError as exc:
+            logger.info(f'Unable to check the layout of {source.name}: {exc}')
+            return False
+
+
+def get_subsample_source(image_entry):
+    """Get the ChecksumFile to subsample an image from.
+
+    An existing COG is preferred, then the original file if it supports
+    windowed reads. Otherwise, the image is converted to a COG first.
+
+    """
+    cog, created = get_or_create_no_commit(ConvertedImageFile, source_image=image_entry)
+    if not created and cog.converted_file:
+        return cog.converted_file
+    original = image_entry.image_file.file
+    if image_entry.is_cog or _supports_windowed_reads(original):
+        logger.info('Subsampling directly from the original file.')
+        return original
+    logger.info('Converting to COG before subsampling.')
+    cog.skip_signal = True  # Run conversion synchronously
+    cog.save()
+    convert_to_cog(cog)
+    cog.refresh_from_db()
+    return cog.converted_file
+
+
 def populate_subsampled_image(subsampled):
     if not isinstance(subsampled, SubsampledImage):
         subsampled = SubsampledImage.objects.get(id=subsampled)
@@ -109,18 +304,28 @@ def populate_subsampled_image(subsampled):
         subsampled.refresh_from_db()
     image_entry = subsampled.source_image
 
-    cog, created = get_or_create_no_commit(ConvertedImageFile, source_image=image_entry)
-    if created:
-        cog.skip_signal = True  # Run conversion synchronously
-        cog.save()
-        convert_to_cog(cog)
+    # Reuse the output of an identical subsample
+    subsampled.cache_key = subsampled.get_cache_key()
+    cached = subsampled.get_cached_data()
+    if cached is not None:
+        subsampled.data = cached
+        subsampled.save(
+            update_fields=[
+                'data',
+                'cache_key',
+            ]
+        )
+        logger.info(f'Reused subsampled image in ChecksumFile: {cached.id}')
+        return subsampled.id
 
     # Create kwargs based on subsample type
     logger.info(f'Subsample parameters: {subsampled.sample_parameters}')
     kwargs = subsampled.to_kwargs()
 
-    source = cog.converted_file
-    if not subsampled.data:
+    source = get_subsample_source(image_entry)
+    shared = SubsampledImage.objects.filter(data=subsampled.data).exclude(pk=subsampled.pk).exists()
+    if not subsampled.data or shared:
+        # Never overwrite data that other subsamples point to
         subsampled.data = ChecksumFile()
 
     if subsampled.sample_type == SubsampledImage.SampleTypes.GEOJSON or (
@@ -131,13 +336,141 @@ def populate_subsampled_image(subsampled):
         _subsample_with_geojson(source, subsampled.data.file, kwargs, prefix='subsampled_')
     else:
         logger.info('Subsampling with bounding box feature.')
-        _gdal_translate_helper(source, subsampled.data.file, prefix='subsampled_', **kwargs)
+        _gdal_translate_helper(
+            source, subsampled.data.file, prefix='subsampled_', vsi=True, **kwargs
+        )
 
     subsampled.data.save()
     subsampled.save(
         update_fields=[
             'data',
+            'cache_key',
         ]
     )
     logger.info(f'Produced subsampled image in ChecksumFile: {subsampled.data.id}')
     return subsampled.id
+
+
+# Presigned URLs of pooled datasets expire, so they are only kept this long
+DATASET_POOL_TTL = 600
+
+
+class _DatasetPool:
+    """Keep recently used datasets open to skip reopening them for every read.
+
+    A dataset is only ever used by one thread at a time: it is checked out
+    of the pool while in use and returned after.
+
+    """
+
+    def __init__(self):
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def open(self, key, get_path):
+        src = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle and src is None:
+                opened, candidate = idle.pop()
+                if time.monotonic() - opened < DATASET_POOL_TTL:
+                    src = (opened, candidate)
+                else:
+                    candidate.close()
+        if src is None:
+            src = (time.monotonic(), rasterio.open(get_path()))
+        try:
+            yield src[1]
+        finally:
+            self._release(key, src)
+
+    def _release(self, key, src):
+        size = getattr(settings, 'GEODATA_DATASET_POOL_SIZE', 16)
+        with self._lock:
+            self._idle.setdefault(key, []).append(src)
+            self._idle.move_to_end(key)
+            while sum(len(v) for v in self._idle.values()) > size:
+                oldest = next(iter(self._idle))
+                _, evicted = self._idle[oldest].pop(0)
+                evicted.close()
+                if not self._idle[oldest]:
+                    del self._idle[oldest]
+
+
+_dataset_pool = _DatasetPool()
+
+
+@contextmanager
+def open_pooled_dataset(source):
+    """Open a ChecksumFile with rasterio through ``/vsicurl``, reusing pooled datasets.
+
+    Pooled datasets are keyed by the last save of the file so that a
+    replaced file is never read from a stale dataset.
+
+    """
+    key = (source.pk, source.modified)
+    with _dataset_pool.open(key, lambda: source.get_vsi_path(internal=True)) as src:
+        yield src
+
+
+def get_subsample_window(src, sample_type, params):
+    """Get the pixel window of a subsample of an open dataset.
+
+    Boxes and GeoJSON are in the coordinates of the dataset as for
+    ``SubsampledImage``. The window is clipped to the dataset.
+
+    """
+    try:
+        if sample_type == SubsampledImage.SampleTypes.PIXEL_BOX:
+            window = Window.from_slices(
+                (params['vmin'], params['vmax']), (params['umin'], params['umax'])
+            )
+        elif sample_type == SubsampledImage.SampleTypes.GEO_BOX:
+            window = from_bounds(
+                params['xmin'], params['ymin'], params['xmax'], params['ymax'], src.transform
+            )
+        elif sample_type == SubsampledImage.SampleTypes.GEOJSON:
+            window = geometry_window(src, [params])
+        else:
+            raise ValueError('Sample type ({}) unknown.'.format(sample_type))
+        full = Window(0, 0, src.width, src.height)
+        return window.round_offsets().round_lengths().intersection(full)
+    except WindowError:
+        raise ValueError('The subsample does not overlap the image.')
+
+
+def read_subsample(src, window, sample_type, params):
+    """Read a subsample of an open dataset, masking outside of a GeoJSON feature."""
+    if sample_type == SubsampledImage.SampleTypes.GEOJSON:
+        return mask(src, [params], crop=True)
+    return src.read(window=window), src.window_transform(window)
+
+
+def encode_subsample(src, data, transform, output_format='tif'):
+    """Encode a subsample of a dataset as GeoTIFF, PNG or NPY bytes.
+
+    Returns the bytes and their content type.
+
+    """
+    if output_format == 'npy':
+        with io.BytesIO() as f:
+            np.save(f, data)
+            return f.getvalue(), 'application/octet-stream'
+    drivers = {'tif': (SUBSAMPLE_FORMAT, 'image/tiff'), 'png': ('PNG', 'image/png')}
+    if output_format not in drivers:
+        raise ValueError('Output format ({}) unknown.'.format(output_format))
+    driver, content_type = drivers[output_format]
+    if driver == 'PNG' and data.dtype not in (np.uint8, np.uint16):
+        raise ValueError(
+            'PNG output does not support the data type ({}) of the image.'.format(data.dtype)
+        )
+    profile = src.profile.copy()
+    profile.update(driver=driver, width=data.shape[2], height=data.shape[1], transform=transform)
+    # Drop creation options of the source format, e.g. for tiling
+    for key in ('blockxsize', 'blockysize', 'tiled', 'compress', 'interleave', 'photometric'):
+        profile.pop(key, None)
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dst:
+            dst.write(data)
+        return memfile.read(), content_type
@@ -61,19 +61,23 @@ def get_collection_membership_path(model) -> Optional[str]:
         return 'source_image__image_file__file__collection__collection_memberships'
     if issubclass(model, models.SubsampledImage):
         return 'source_image__image_file__file__collection__collection_memberships'
+    if issubclass(model, models.ChipArchive):
+        return 'image_set__images__image_file__file__collection__collection_memberships'
     if issubclass(model, models.KWCOCOArchive):
         return 'spec_file__collection__collection_memberships'
     # Annotation
     if issubclass(model, models.Annotation):
-        return 'image__image_file__collection__collection_memberships'
+        return 'image__image_file__file__collection__collection_memberships'
     if issubclass(model, models.Segmentation):
-        return 'annotation__image__image_file__collection__collection_memberships'
+        return 'annotation__image__image_file__file__collection__collection_memberships'
     # Geometry
     if issubclass(model, models.GeometryEntry):
         return 'geometry_archive__file__collection__collection_memberships'
     # FMV
     if issubclass(model, models.FMVEntry):
         return 'fmv_file__file__collection__collection_memberships'
+    if issubclass(model, models.FMVFrame):
+        return 'fmv_entry__fmv_file__file__collection__collection_memberships'
     # SpatialEntry
     if model == models.SpatialEntry:
         return '_collection_memberships'
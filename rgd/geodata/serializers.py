@@ -4,9 +4,11 @@ from rest_framework import serializers
 from rest_framework.reverse import reverse
 
 from rgd import utility
-from rgd.geodata.permissions import check_write_perm
+from rgd.geodata.permissions import check_read_perm, check_write_perm
 
 from . import models
+from .models.common import get_simplify_tolerance
+from .models.imagery.subsample import get_cog_options
 
 
 class SpatialEntrySerializer(serializers.ModelSerializer):
@@ -45,10 +47,26 @@ class GeometryEntrySerializer(SpatialEntrySerializer):
         exclude = ['data']
 
 
-class GeometryEntryDataSerializer(GeometryEntrySerializer):
+class _SimplifiedGeometryMixin:
+    """Serialize geometry at the level of detail requested by ``tolerance`` or ``zoom``."""
+
+    def _get_tolerance(self):
+        if 'request' not in self.context:
+            return None
+        try:
+            return get_simplify_tolerance(self.context['request'].query_params)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+    def _get_geojson(self, value, field):
+        geometry = value.get_simplified_geometry(field, self._get_tolerance())
+        return json.loads(geometry.geojson)
+
+
+class GeometryEntryDataSerializer(_SimplifiedGeometryMixin, GeometryEntrySerializer):
     def to_representation(self, value):
         ret = super().to_representation(value)
-        ret['data'] = json.loads(value.data.geojson)
+        ret['data'] = self._get_geojson(value, 'data')
         return ret
 
     class Meta:
@@ -62,10 +80,25 @@ class ConvertedImageFileSerializer(serializers.ModelSerializer):
             check_write_perm(self.context['request'].user, value)
         return value
 
+    def validate_profile(self, value):
+        try:
+            get_cog_options(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
+
     class Meta:
         model = models.ConvertedImageFile
         fields = '__all__'
-        read_only_fields = ['id', 'status', 'failure_reason', 'converted_file']
+        read_only_fields = [
+            'id',
+            'status',
+            'failure_reason',
+            'converted_file',
+            'is_source_alias',
+            'conversion_time',
+            'size_ratio',
+        ]
 
 
 class ChecksumFileSerializer(serializers.ModelSerializer):
@@ -81,12 +114,22 @@ class ChecksumFileSerializer(serializers.ModelSerializer):
 
 
 class SubsampledImageSerializer(serializers.ModelSerializer):
+    """Serialize ``SubsampledImage``.
+
+    Creating a subsample requires write access to the source image unless
+    ``read_only_source`` is set in the context, for views that read the
+    source on behalf of a user who can only read it.
+
+    """
 
     data = ChecksumFileSerializer(read_only=True)
 
     def validate_source_image(self, value):
         if 'request' in self.context:
-            check_write_perm(self.context['request'].user, value)
+            if self.context.get('read_only_source'):
+                check_read_perm(self.context['request'].user, value)
+            else:
+                check_write_perm(self.context['request'].user, value)
         return value
 
     def to_representation(self, value):
@@ -110,11 +153,24 @@ class SubsampledImageSerializer(serializers.ModelSerializer):
         ]
 
     def create(self, validated_data):
-        """Prevent duplicated subsamples from being created."""
-        obj, created = models.SubsampledImage.objects.get_or_create(**validated_data)
-        if not created:
-            # Trigger save event to reprocess the subsampling
-            obj.save()
+        """Prevent duplicated subsamples from being created.
+
+        Subsamples with a fresh result, or with the same content as another
+        finished subsample, are returned without queuing any work.
+        """
+        obj, created = utility.get_or_create_no_commit(models.SubsampledImage, **validated_data)
+        cache_key = obj.get_cache_key()
+        fresh = obj.status == models.mixins.Status.SUCCEEDED and obj.data
+        if not created and fresh and obj.cache_key and obj.cache_key == cache_key:
+            return obj
+        obj.cache_key = cache_key
+        cached = obj.get_cached_data()
+        if cached is not None:
+            obj.data = cached
+            obj.status = models.mixins.Status.SUCCEEDED
+            obj.skip_signal = True
+        # Otherwise, the save event triggers (re)processing the subsample
+        obj.save()
         return obj
 
 
@@ -166,6 +222,33 @@ class ImageSetSerializer(serializers.ModelSerializer):
         ]
 
 
+class AnnotationSerializer(serializers.ModelSerializer):
+    def _get_geojson(self, geometry):
+        return json.loads(geometry.geojson) if geometry is not None else None
+
+    def to_representation(self, value):
+        ret = super().to_representation(value)
+        for field in ('keypoints', 'line', 'bounds'):
+            ret[field] = self._get_geojson(getattr(value, field))
+        segmentation = value.get_segmentation()
+        if segmentation is not None:
+            ret['segmentation'] = {
+                'type': value.segmentation.get_type(),
+                'outline': self._get_geojson(segmentation.outline),
+            }
+            if isinstance(segmentation, models.PolygonSegmentation):
+                ret['segmentation']['feature'] = self._get_geojson(segmentation.feature)
+            elif isinstance(segmentation, models.RLESegmentation):
+                ret['segmentation']['rle'] = segmentation.to_rle()
+        else:
+            ret['segmentation'] = None
+        return ret
+
+    class Meta:
+        model = models.Annotation
+        exclude = ['content_hash']
+
+
 class RasterEntrySerializer(serializers.ModelSerializer):
     image_set = ImageSetSerializer()
     ancillary_files = ChecksumFileSerializer(many=True)
@@ -199,12 +282,12 @@ class FMVEntrySerializer(SpatialEntrySerializer):
         exclude = ['ground_frames', 'ground_union', 'flight_path', 'frame_numbers']
 
 
-class FMVEntryDataSerializer(FMVEntrySerializer):
+class FMVEntryDataSerializer(_SimplifiedGeometryMixin, FMVEntrySerializer):
     def to_representation(self, value):
         ret = super().to_representation(value)
-        ret['ground_frames'] = json.loads(value.ground_frames.geojson)
-        ret['ground_union'] = json.loads(value.ground_union.geojson)
-        ret['flight_path'] = json.loads(value.flight_path.geojson)
+        ret['ground_frames'] = self._get_geojson(value, 'ground_frames')
+        ret['ground_union'] = self._get_geojson(value, 'ground_union')
+        ret['flight_path'] = self._get_geojson(value, 'flight_path')
         return ret
 
     class Meta:
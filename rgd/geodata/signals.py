@@ -2,13 +2,14 @@ from functools import wraps
 import os
 
 from django.db import transaction
-from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
 from .models.common import ChecksumFile
 from .models.fmv import FMVFile
 from .models.geometry import GeometryArchive
 from .models.imagery import (
+    ChipArchive,
     ConvertedImageFile,
     ImageFile,
     ImageSet,
@@ -109,3 +110,21 @@ def _post_delete_converted_image_file(sender, instance, *args, **kwargs):
 @skip_signal()
 def _post_delete_subsampled_image(sender, instance, *args, **kwargs):
     transaction.on_commit(lambda: instance._post_delete(*args, **kwargs))
+
+
+@receiver(post_save, sender=ChipArchive)
+@skip_signal()
+def _post_save_chip_archive(sender, instance, *args, **kwargs):
+    transaction.on_commit(lambda: instance._post_save_event_task(*args, **kwargs))
+
+
+@receiver(pre_delete, sender=ChipArchive)
+@skip_signal()
+def _pre_delete_chip_archive(sender, instance, *args, **kwargs):
+    instance._pre_delete(*args, **kwargs)
+
+
+@receiver(post_delete, sender=ChipArchive)
+@skip_signal()
+def _post_delete_chip_archive(sender, instance, *args, **kwargs):
+    transaction.on_commit(lambda: instance._post_delete(*args, **kwargs))
@@ -103,6 +103,15 @@ def task_populate_subsampled_image(subsampled_id):
     _run_with_failure_reason(cog, populate_subsampled_image, subsampled_id)
 
 
+@shared_task(time_limit=86400)
+def task_populate_chip_archive(chip_archive_id):
+    from .models.imagery.base import ChipArchive
+    from .models.imagery.chips import populate_chip_archive
+
+    chip_archive = ChipArchive.objects.get(id=chip_archive_id)
+    _run_with_failure_reason(chip_archive, populate_chip_archive, chip_archive_id)
+
+
 @shared_task(time_limit=86400)
 def task_checksum_file_post_save(checksumfile_id):
     from .models.common import ChecksumFile
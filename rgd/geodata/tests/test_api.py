@@ -1,4 +1,9 @@
+import io
+
+import numpy as np
 import pytest
+import rasterio
+import rasterio.transform
 from rest_framework import status
 
 from rgd.geodata import models
@@ -135,6 +140,68 @@ def test_create_get_subsampled_image(admin_api_client, astro_image):
     assert response.status_code == 201
     assert response.data
     assert id == response.data['id']  # Compare against original PK
+    # A fresh result is not reprocessed
+    assert models.imagery.SubsampledImage.objects.get(id=id).data == sub.data
+    assert sub.cache_key
+
+
+@pytest.mark.django_db(transaction=True)
+def test_download_image_entry_subsample(admin_api_client, astro_image, settings):
+    url = f'/api/geoprocess/imagery/{astro_image.pk}/subsample'
+    box = {'umin': 10, 'umax': 60, 'vmin': 20, 'vmax': 40}
+    response = admin_api_client.get(url, {**box, 'format': 'npy'})
+    assert response.status_code == status.HTTP_200_OK
+    data = np.load(io.BytesIO(response.content))
+    assert data.shape[1:] == (20, 50)
+    response = admin_api_client.get(url, {**box, 'format': 'png'})
+    assert response['Content-Type'] == 'image/png'
+    # Missing parameters are rejected
+    response = admin_api_client.get(url, {'umin': 10})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    # Large windows are redirected to an asynchronous subsample
+    settings.GEODATA_SUBSAMPLE_MAX_PIXELS = 100
+    response = admin_api_client.get(url, box)
+    assert response.status_code == status.HTTP_302_FOUND
+    assert models.imagery.SubsampledImage.objects.filter(source_image=astro_image).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_download_image_entry_subsample_read_only(
+    authenticated_api_client, user, settings, tmp_path
+):
+    collection = models.Collection.objects.create(name='Readers')
+    models.CollectionMembership.objects.create(
+        collection=collection, user=user, role=models.CollectionMembership.READER
+    )
+    path = str(tmp_path / 'float.tif')
+    with rasterio.open(
+        path,
+        'w',
+        driver='GTiff',
+        width=64,
+        height=64,
+        count=1,
+        dtype='float32',
+        crs='EPSG:4326',
+        transform=rasterio.transform.from_origin(-107, 39, 0.001, 0.001),
+    ) as dst:
+        dst.write(np.random.random((1, 64, 64)).astype('float32'))
+    imagefile = factories.ImageFileFactory(
+        file__file__filename='float.tif',
+        file__file__from_path=path,
+        file__collection=collection,
+    )
+    url = f'/api/geoprocess/imagery/{imagefile.imageentry.pk}/subsample'
+    box = {'umin': 0, 'umax': 20, 'vmin': 0, 'vmax': 20}
+    response = authenticated_api_client.get(url, {**box, 'format': 'tif'})
+    assert response.status_code == status.HTTP_200_OK
+    # PNG cannot hold floats
+    response = authenticated_api_client.get(url, {**box, 'format': 'png'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    # Readers are redirected to an asynchronous subsample of large windows
+    settings.GEODATA_SUBSAMPLE_MAX_PIXELS = 100
+    response = authenticated_api_client.get(url, box)
+    assert response.status_code == status.HTTP_302_FOUND
 
 
 @pytest.mark.django_db(transaction=True)
@@ -154,3 +221,42 @@ def test_create_and_download_cog(admin_api_client, landsat_image):
     pk = cog.pk
     response = admin_api_client.get(f'/api/geoprocess/imagery/cog/{pk}/data')
     assert status.is_redirect(response.status_code)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_create_cog_with_unknown_profile(admin_api_client, landsat_image):
+    response = admin_api_client.post(
+        '/api/geoprocess/imagery/cog',
+        {'source_image': landsat_image.id, 'profile': 'unknown'},
+    )
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert 'profile' in response.data
+    assert not models.imagery.ConvertedImageFile.objects.filter(
+        source_image=landsat_image.id
+    ).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_search_annotations(admin_api_client):
+    kwds = factories.KWCOCOArchiveFactory(
+        image_archive__file__filename='demodata.zip',
+        image_archive__file__from_path=datastore.fetch('demodata.zip'),
+        spec_file__file__filename='demo.kwcoco.json',
+        spec_file__file__from_path=datastore.fetch('demo.kwcoco.json'),
+    )
+    image = kwds.image_set.images.first()
+    n_annotations = image.annotation_set.count()
+    response = admin_api_client.get(
+        '/api/geosearch/imagery/annotations',
+        {'image': image.pk, 'window': f'0,0,{image.width},{image.height}', 'limit': 1},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data['count'] == n_annotations
+    assert len(response.data['results']) == 1
+    assert response.data['results'][0]['bounds']['type'] == 'Polygon'
+    response = admin_api_client.get(
+        '/api/geosearch/imagery/annotations', {'image': image.pk, 'window': '-20,-20,-10,-10'}
+    )
+    assert response.data['count'] == 0
+    response = admin_api_client.get('/api/geosearch/imagery/annotations', {'window': '1,2,3'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
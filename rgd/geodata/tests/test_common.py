@@ -1,10 +1,15 @@
+import inspect
 import os
 
 from django.db import IntegrityError
+from django.db.models import QuerySet
+from django.utils import timezone
+import numpy as np
 import pytest
 
 from rgd.geodata.datastore import datastore, registry
-from rgd.geodata.models import common
+from rgd.geodata.models import ChipArchive, ImageSet, common
+from rgd.utility import array_to_blob, blob_to_array, bulk_create_inherited
 
 FILENAME = 'stars.png'
 
@@ -121,3 +126,39 @@ def test_checksumfile_url_yield_local_path():
         with model.yield_local_path() as path:
             raise ValueError()
     assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('array', [[], [0, 5, 3, 2**20], list(range(1000)), [2**40, 1]])
+def test_array_blob_roundtrip(array, compress):
+    blob = array_to_blob(array, compress=compress)
+    # Raw blobs are 4 bytes per value when possible
+    if not compress and max(array, default=0) < 2**32:
+        assert len(blob) == 1 + 4 * len(array)
+    result = blob_to_array(memoryview(blob))
+    np.testing.assert_array_equal(result, array)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_bulk_create_inherited():
+    now = timezone.now()
+    image_sets = [ImageSet(name=f'set {i}', created=now, modified=now) for i in range(3)]
+    # Assigned before the image sets have primary keys
+    archives = [ChipArchive(image_set=s, created=now, modified=now) for s in image_sets]
+    bulk_create_inherited(ImageSet, image_sets, batch_size=2)
+    bulk_create_inherited(ChipArchive, archives)
+
+    assert ImageSet.objects.filter(name__startswith='set ').count() == 3
+    for archive, image_set in zip(archives, image_sets):
+        archive = ChipArchive.objects.get(pk=archive.pk)
+        assert archive.image_set == image_set
+        assert archive.created == now
+    pks = [obj.pk for obj in image_sets + archives]
+    assert common.ModifiableEntry.objects.filter(pk__in=pks).count() == 6
+
+
+def test_bulk_create_inherited_insert_signature():
+    # bulk_create_inherited calls the private QuerySet._insert(objs, fields=..., using=...)
+    parameters = list(inspect.signature(QuerySet._insert).parameters)
+    assert parameters[:3] == ['self', 'objs', 'fields'], parameters
+    assert 'using' in parameters, parameters
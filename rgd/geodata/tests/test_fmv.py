@@ -1,14 +1,45 @@
 import os
+import shutil
+import time
 
+from django.contrib.gis.geos import Polygon
 import pytest
 
 from rgd.geodata.datastore import datastore
+from rgd.geodata.models.fmv import etl
 from rgd.geodata.models.fmv.base import FMVEntry
+from rgd.geodata.models.fmv.etl import (
+    _get_ffmpeg_command,
+    _get_path_and_footprints,
+    _union_footprints,
+)
 from rgd.geodata.models.mixins import Status
 
 from . import factories
 
 NO_KWIVER = os.environ.get('NO_KWIVER', False)
+RUN_BENCHMARKS = os.environ.get('RUN_BENCHMARKS', False)
+
+
+def _synthetic_klv_lines(n_frames, skip=()):
+    """Yield the lines of ``dump-klv`` style output for a straight flight."""
+    for i in range(n_frames):
+        yield f'========== Read frame {i + 1} (index {i}) =========='
+        if i in skip:
+            continue
+        x, y = -84.0 + i * 1e-4, 39.0
+        for offset in (0, 1):  # two metadata blocks per frame
+            corners = ', '.join(
+                f'{x + dx + offset}/{y + dy}'
+                for dx, dy in ((0, 0), (1e-3, 0), (1e-3, 1e-3), (0, 1e-3))
+            )
+            yield '---------------- Metadata from: MISP'
+            yield f'Metadata item: Unix Timestamp (microseconds): {1600000000000000 + i * 33333}'
+            yield (
+                f'Metadata item: Sensor Geodetic Location (WGS84): '
+                f'geo_point [ {x + offset}, {y}, 1000 ] @ 4326 with height 1000'
+            )
+            yield f'Metadata item: Corner points (WGS84): {{{corners}}} @ 4326'
 
 
 @pytest.mark.django_db(transaction=True)
@@ -21,6 +52,69 @@ def test_populate_fmv_entry_from_klv_file():
     )
     fmv_entry = FMVEntry.objects.filter(fmv_file=fmv_file).first()
     assert fmv_entry.ground_frames is not None
+    assert fmv_entry.frames.count() == len(fmv_entry.ground_frames)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_search_fmv_frames(admin_api_client):
+    fmv_file = factories.FMVFileFactory(
+        klv_file__filename='subset_metadata.klv',
+        klv_file__from_path=datastore.fetch('subset_metadata.klv'),
+    )
+    fmv_entry = FMVEntry.objects.get(fmv_file=fmv_file)
+    frame = fmv_entry.frames.first()
+    response = admin_api_client.get(
+        '/api/geosearch/fmv/frames', {'geojson': frame.footprint.centroid.geojson}
+    )
+    assert response.status_code == 200
+    assert response.data['count'] == 1
+    ranges = {r['fmv_entry']: r['ranges'] for r in response.data['results']}[fmv_entry.pk]
+    assert any(r['start_frame'] <= frame.frame_number <= r['end_frame'] for r in ranges)
+    # Nothing is found far away from the video
+    response = admin_api_client.get(
+        '/api/geosearch/fmv/frames', {'geojson': '{"type": "Point", "coordinates": [0, 0]}'}
+    )
+    assert fmv_entry.pk not in [r['fmv_entry'] for r in response.data['results']]
+    # A filter is required and must be valid
+    response = admin_api_client.get('/api/geosearch/fmv/frames')
+    assert response.status_code == 400
+    response = admin_api_client.get('/api/geosearch/fmv/frames', {'geojson': 'not geojson'})
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db(transaction=True)
+def test_fmv_etl_steps_stored_together(monkeypatch):
+    def _convert(fmv_file_entry, dataset_path, tmpdir):
+        output_path = os.path.join(tmpdir, 'video.mp4')
+        with open(output_path, 'wb') as f:
+            f.write(b'mp4')
+        return {'web_video_file': output_path, 'frame_rate': 24}
+
+    def _fail(fmv_file_entry, dataset_path, tmpdir):
+        raise RuntimeError('dump-klv failed')
+
+    # Neither output is stored if either step fails
+    monkeypatch.setattr(etl, '_convert_video_to_mp4', _convert)
+    monkeypatch.setattr(etl, '_extract_klv', _fail)
+    fmv_file = factories.FMVFileFactory(klv_file=None, web_video_file=None)
+    assert fmv_file.status == Status.FAILED
+    assert 'dump-klv failed' in fmv_file.failure_reason
+    assert not fmv_file.web_video_file
+    assert not fmv_file.klv_file
+
+    # Both are stored once both succeed
+    def _extract(fmv_file_entry, dataset_path, tmpdir):
+        output_path = os.path.join(tmpdir, 'video.klv')
+        shutil.copy(datastore.fetch('subset_metadata.klv'), output_path)
+        return {'klv_file': output_path}
+
+    monkeypatch.setattr(etl, '_extract_klv', _extract)
+    etl.read_fmv_file(fmv_file.id)
+    fmv_file.refresh_from_db()
+    assert fmv_file.web_video_file.read() == b'mp4'
+    assert fmv_file.klv_file
+    assert fmv_file.frame_rate == 24
+    assert FMVEntry.objects.filter(fmv_file=fmv_file).exists()
 
 
 @pytest.mark.skipif(NO_KWIVER, reason='User set NO_KWIVER')
@@ -35,3 +129,75 @@ def test_full_fmv_etl():
     assert fmv_file.status == Status.SUCCEEDED, fmv_file.failure_reason
     fmv_entry = FMVEntry.objects.get(fmv_file=fmv_file)
     assert fmv_entry.ground_frames is not None
+
+
+def test_parse_klv_stream():
+    path, polys, union, frame_numbers, timestamps = _get_path_and_footprints(
+        _synthetic_klv_lines(10, skip=(3,))
+    )
+    # The last frame is dropped as it may be truncated and frame 4 has no metadata
+    assert frame_numbers == [1, 2, 3, 5, 6, 7, 8, 9]
+    assert len(polys) == len(path) == 8
+    # The first of the two metadata blocks is used
+    assert path[0].coords == (-84.0, 39.0)
+    assert union.extent[0] == pytest.approx(-84.0)
+    assert timestamps[0].timestamp() == pytest.approx(1600000000)
+
+
+def _synthetic_footprints(n_frames, hover=1):
+    """Overlapping frame footprints of a sensor that stays on each location for ``hover`` frames."""
+    polys = []
+    for i in range(n_frames):
+        x = -84.0 + (i // hover) * 1e-4 + (i % hover) * 1e-9
+        polys.append(Polygon.from_bbox((x, 39.0, x + 1e-3, 39.001)))
+        polys[-1].srid = 4326
+    return polys
+
+
+def _incremental_union(polys):
+    union = polys[0]
+    for p in polys[1:]:
+        union = union.union(p)
+    return union
+
+
+@pytest.mark.parametrize('n_frames', [100, 1000])
+def test_union_footprints(n_frames):
+    polys = _synthetic_footprints(n_frames)
+    cascaded = _union_footprints(polys)
+    incremental = _incremental_union(polys)
+    assert cascaded.area == pytest.approx(incremental.area)
+    assert cascaded.sym_difference(incremental).area == pytest.approx(0, abs=1e-12)
+
+
+@pytest.mark.benchmark
+@pytest.mark.skipif(not RUN_BENCHMARKS, reason='Set RUN_BENCHMARKS to run timing benchmarks')
+def test_union_footprints_benchmark():
+    polys = _synthetic_footprints(1000)
+
+    tic = time.perf_counter()
+    _incremental_union(polys)
+    incremental_time = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    _union_footprints(polys)
+    cascaded_time = time.perf_counter() - tic
+
+    assert cascaded_time < incremental_time
+
+
+def test_union_footprints_tolerance():
+    polys = _synthetic_footprints(300, hover=3)
+    snapped = _union_footprints(polys, tolerance=1e-6)
+    assert snapped.area == pytest.approx(_union_footprints(polys).area)
+
+
+def test_ffmpeg_command_options(settings):
+    cmd = _get_ffmpeg_command('in.ts', 'out.mp4')
+    assert '-threads' not in cmd and '-preset' not in cmd
+    settings.GEODATA_FFMPEG_THREADS = 4
+    settings.GEODATA_FFMPEG_PRESET = 'veryfast'
+    cmd = _get_ffmpeg_command('in.ts', 'out.mp4')
+    assert cmd[cmd.index('-threads') + 1] == '4'
+    assert cmd[cmd.index('-preset') + 1] == 'veryfast'
+    assert cmd[-1] == 'out.mp4'
@@ -1,3 +1,13 @@
+import gzip
+import io
+import math
+import shutil
+import tarfile
+import zipfile
+
+from django.core.exceptions import ValidationError
+import fiona
+from fiona.crs import from_epsg
 import pytest
 
 from rgd.geodata import models
@@ -23,3 +33,155 @@ def test_geometry_etl(sample_file):
     read_geometry_archive(geom_archive.id)
     # test the field file validator
     models.geometry.base.validate_archive(geom_archive.file.file)
+
+
+def _write_vector_layers(path, driver, layers):
+    schema = {'geometry': 'Polygon', 'properties': {'name': 'str'}}
+    for layer in layers:
+        kwargs = dict(layer=layer) if driver == 'GPKG' else {}
+        with fiona.open(
+            path, 'w', driver=driver, schema=schema, crs=from_epsg(4326), **kwargs
+        ) as dst:
+            dst.write(
+                {
+                    'geometry': {
+                        'type': 'Polygon',
+                        'coordinates': [[(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]],
+                    },
+                    'properties': {'name': layer},
+                }
+            )
+    return path
+
+
+@pytest.mark.django_db(transaction=True)
+def test_geometry_etl_geojson(tmp_path):
+    path = _write_vector_layers(str(tmp_path / 'sample.geojson'), 'GeoJSON', ['sample'])
+    geom_archive = factories.GeometryArchiveFactory(
+        file__file__filename='sample.geojson',
+        file__file__from_path=path,
+    )
+    entries = models.GeometryEntry.objects.filter(geometry_archive=geom_archive)
+    assert entries.count() == 1
+    assert len(entries.first().data) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_geometry_etl_multi_layer_archive(tmp_path):
+    gpkg = _write_vector_layers(str(tmp_path / 'layers.gpkg'), 'GPKG', ['one', 'two'])
+    geojson = _write_vector_layers(str(tmp_path / 'other.geojson'), 'GeoJSON', ['other'])
+    archive_path = str(tmp_path / 'layers.zip')
+    with zipfile.ZipFile(archive_path, 'w') as zf:
+        zf.write(gpkg, 'data/layers.gpkg')
+        zf.write(geojson, 'other.geojson')
+
+    geom_archive = factories.GeometryArchiveFactory(
+        file__file__filename='layers.zip',
+        file__file__from_path=archive_path,
+    )
+    entries = models.GeometryEntry.objects.filter(geometry_archive=geom_archive)
+    assert set(entries.values_list('layer', flat=True)) == {
+        'data/layers.gpkg:one',
+        'data/layers.gpkg:two',
+        'other.geojson:other',
+    }
+    # Re-reading the archive should update the entries in place
+    read_geometry_archive(geom_archive.id)
+    assert models.GeometryEntry.objects.filter(geometry_archive=geom_archive).count() == 3
+
+
+@pytest.mark.django_db(transaction=True)
+def test_geometry_etl_archive_without_extension(tmp_path):
+    # The archive type is detected from the content, not the name
+    path = str(tmp_path / 'streams')
+    shutil.copy(datastore.fetch('Streams.zip'), path)
+    geom_archive = factories.GeometryArchiveFactory(
+        file__file__filename='streams',
+        file__file__from_path=path,
+    )
+    assert models.GeometryEntry.objects.filter(geometry_archive=geom_archive).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_geometry_etl_gzipped_without_extension(tmp_path):
+    geojson = _write_vector_layers(str(tmp_path / 'sample.geojson'), 'GeoJSON', ['sample'])
+    # A single gzipped dataset
+    path = str(tmp_path / 'single')
+    with open(geojson, 'rb') as src, gzip.open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    geom_archive = factories.GeometryArchiveFactory(
+        file__file__filename='single',
+        file__file__from_path=path,
+    )
+    entries = models.GeometryEntry.objects.filter(geometry_archive=geom_archive)
+    assert entries.count() == 1
+    # A gzipped tar of datasets
+    path = str(tmp_path / 'archive')
+    with tarfile.open(path, 'w:gz') as tf:
+        tf.add(geojson, 'data/sample.geojson')
+    geom_archive = factories.GeometryArchiveFactory(
+        file__file__filename='archive',
+        file__file__from_path=path,
+    )
+    entries = models.GeometryEntry.objects.filter(geometry_archive=geom_archive)
+    assert list(entries.values_list('layer', flat=True)) == ['data/sample.geojson:sample']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_geometry_etl_keeps_legacy_entries():
+    geom_archive = factories.GeometryArchiveFactory(
+        file__file__filename='Streams.zip',
+        file__file__from_path=datastore.fetch('Streams.zip'),
+    )
+    entry = models.GeometryEntry.objects.get(geometry_archive=geom_archive)
+    # Entries read before layers were recorded are updated in place
+    models.GeometryEntry.objects.filter(pk=entry.pk).update(layer='')
+    read_geometry_archive(geom_archive.id)
+    entry.refresh_from_db()
+    assert entry.layer
+    assert models.GeometryEntry.objects.filter(geometry_archive=geom_archive).count() == 1
+
+
+def test_validate_archive(tmp_path):
+    geojson = _write_vector_layers(str(tmp_path / 'sample.geojson'), 'GeoJSON', ['sample'])
+    fgb = _write_vector_layers(str(tmp_path / 'sample.fgb'), 'FlatGeobuf', ['sample'])
+    for path in (geojson, fgb):
+        with open(path, 'rb') as f:
+            models.geometry.base.validate_archive(f)
+    with pytest.raises(ValidationError):
+        models.geometry.base.validate_archive(io.BytesIO(b'Not a vector file.'))
+    with pytest.raises(ValidationError):
+        models.geometry.base.validate_archive(io.BytesIO(bytes(range(256))))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_geometry_simplified_levels(tmp_path, admin_api_client):
+    path = str(tmp_path / 'circle.geojson')
+    circle = [
+        (math.cos(2 * math.pi * i / 10000), math.sin(2 * math.pi * i / 10000)) for i in range(10000)
+    ]
+    circle.append(circle[0])
+    schema = {'geometry': 'Polygon', 'properties': {}}
+    with fiona.open(path, 'w', driver='GeoJSON', schema=schema, crs=from_epsg(4326)) as dst:
+        dst.write({'geometry': {'type': 'Polygon', 'coordinates': [circle]}, 'properties': {}})
+    geom_archive = factories.GeometryArchiveFactory(
+        file__file__filename='circle.geojson',
+        file__file__from_path=path,
+    )
+    entry = models.GeometryEntry.objects.get(geometry_archive=geom_archive)
+    levels = models.SimplifiedGeometry.objects.filter(spatial_entry_id=entry.spatial_id)
+    assert levels.exists()
+    # Each level is coarser than the one before it
+    num_coords = [level.geometry.num_coords for level in levels.order_by('tolerance')]
+    assert num_coords == sorted(num_coords, reverse=True)
+    assert num_coords[0] < entry.data.num_coords
+    assert entry.get_simplified_geometry('data').num_coords == entry.data.num_coords
+    assert entry.get_simplified_geometry('data', 0.1).num_coords == num_coords[-1]
+
+    response = admin_api_client.get(f'/api/geodata/geometry/{entry.pk}/data?zoom=2')
+    assert response.status_code == 200
+    coords = response.data['data']['geometries'][0]['coordinates'][0]
+    assert len(coords) < len(circle)
+    for params in ('tolerance=foo', 'tolerance=nan', 'zoom=1e6', 'zoom=-1e6', 'zoom=inf'):
+        response = admin_api_client.get(f'/api/geodata/geometry/{entry.pk}/data?{params}')
+        assert response.status_code == 400
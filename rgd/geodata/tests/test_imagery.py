@@ -1,16 +1,45 @@
+import hashlib
+import json
+import tarfile
+import zipfile
+
+from django.contrib.gis.geos import LineString, MultiPolygon, Polygon
+from django.core.management import call_command
+import numpy as np
 import pytest
+import rasterio
+from rasterio import MemoryFile
+import rasterio.transform
 
 from rgd.geodata.datastore import datastore
-from rgd.geodata.models.common import FileSourceType
-from rgd.geodata.models.imagery.annotation import Annotation, RLESegmentation
+from rgd.geodata.models.common import ChecksumFile, FileSourceType
+from rgd.geodata.models.imagery import etl
+from rgd.geodata.models.imagery.annotation import (
+    Annotation,
+    PolygonSegmentation,
+    RLESegmentation,
+)
 from rgd.geodata.models.imagery.base import (
+    ChipArchive,
     ConvertedImageFile,
+    FileMetadata,
     ImageEntry,
     ImageFile,
+    RasterMetaEntry,
     SubsampledImage,
 )
-from rgd.geodata.models.imagery.etl import populate_raster_footprint, read_image_file
-from rgd.geodata.models.imagery.subsample import populate_subsampled_image
+from rgd.geodata.models.imagery.etl import (
+    populate_raster_entry,
+    populate_raster_footprint,
+    read_image_file,
+)
+from rgd.geodata.models.imagery.rle import rle_bbox, rle_decode, rle_encode, rle_ious
+from rgd.geodata.models.imagery.subsample import (
+    convert_to_cog,
+    get_cog_options,
+    populate_subsampled_image,
+)
+from rgd.geodata.models.mixins import Status
 
 from . import factories
 
@@ -93,6 +122,24 @@ def test_repopulate_image_entry():
     read_image_file(imagefile.id)
 
 
+@pytest.mark.django_db(transaction=True)
+def test_repopulate_multiband_image_entry():
+    testfile = SampleFiles[6]
+    imagefile = factories.ImageFileFactory(
+        file__file__filename=testfile['name'],
+        file__file__from_path=datastore.fetch(testfile['name']),
+    )
+    # The bands are replaced rather than added to
+    for _ in range(2):
+        image_entry = read_image_file(imagefile.id)
+        bands = image_entry.bandmetaentry_set.order_by('band_number')
+        assert image_entry.number_of_bands > 1
+        assert list(bands.values_list('band_number', flat=True)) == list(
+            range(1, image_entry.number_of_bands + 1)
+        )
+        assert all(band.created for band in bands)
+
+
 @pytest.mark.django_db(transaction=True)
 def test_multi_file_raster():
     """Test the use case where a raster is generated from multiple files."""
@@ -125,6 +172,97 @@ def test_multi_file_raster():
     assert meta.crs is not None
 
 
+@pytest.mark.django_db(transaction=True)
+def test_raster_of_inconsistent_images():
+    images = [
+        factories.ImageFileFactory(
+            file__file__filename=name,
+            file__file__from_path=datastore.fetch(name),
+        )
+        for name in (LandsatFiles[0], SampleFiles[2]['name'])
+    ]
+    image_set = factories.ImageSetFactory(images=[i.imageentry.id for i in images])
+    raster = factories.RasterEntryFactory(name='Inconsistent', image_set=image_set)
+    raster.refresh_from_db()
+    assert raster.status == Status.FAILED
+    assert 'different spatial reference' in raster.failure_reason
+
+
+@pytest.mark.django_db(transaction=True)
+def test_file_metadata_cached(monkeypatch):
+    image_file = factories.ImageFileFactory(
+        file__file__filename=SampleFiles[2]['name'],
+        file__file__from_path=datastore.fetch(SampleFiles[2]['name']),
+    )
+    image_file.file.refresh_from_db()
+    # The file is not hashed to key its meta info
+    assert not image_file.file.checksum
+    metadata = etl.get_file_metadata(image_file.file)
+    image_entry = image_file.imageentry
+    assert metadata['image']['width'] == image_entry.width
+    assert len(metadata['bands']) == image_entry.bandmetaentry_set.count()
+    assert metadata['raster']['crs']
+
+    def _fail(file_path):
+        raise AssertionError('The file was read again.')
+
+    # Both ingestion and rasters reuse the meta info of identical files
+    monkeypatch.setattr(etl, '_read_metadata', _fail)
+    metadata['raster'].pop('footprint')
+    assert 'footprint' in etl.get_file_metadata(image_file.file)['raster']
+    read_image_file(image_file)
+    image_set = factories.ImageSetFactory(images=[image_file.imageentry.id])
+    raster = factories.RasterEntryFactory(name='Cached', image_set=image_set)
+    raster.refresh_from_db()
+    assert raster.rastermetaentry.crs == metadata['raster']['crs']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_file_metadata_shared_by_duplicates(monkeypatch):
+    name = SampleFiles[5]['name']
+    with open(datastore.fetch(name), 'rb') as f:
+        checksum = hashlib.sha512(f.read()).hexdigest()
+    # Files with a known checksum, e.g. from the KWCOCO ETL, share their meta info
+    original = factories.ImageFileFactory(
+        file__file__filename=name,
+        file__file__from_path=datastore.fetch(name),
+        file__checksum=checksum,
+    )
+    original.file.refresh_from_db()
+    cached = FileMetadata.objects.get(checksum=checksum)
+    assert cached.width == original.imageentry.width
+    assert len(cached.band_dtypes) == original.imageentry.number_of_bands
+
+    # A duplicate upload is ingested from the table without opening the file
+    etl._metadata_cache.clear()
+    read_paths = []
+    read_metadata = etl._read_metadata
+
+    def _read_metadata(file_path):
+        read_paths.append(file_path)
+        return read_metadata(file_path)
+
+    monkeypatch.setattr(etl, '_read_metadata', _read_metadata)
+    duplicate = factories.ImageFileFactory(
+        file__file__filename=name,
+        file__file__from_path=datastore.fetch(name),
+        file__checksum=checksum,
+    )
+    duplicate.file.refresh_from_db()
+    assert read_paths == []
+    image_entry = duplicate.imageentry
+    assert image_entry.width == original.imageentry.width
+    assert image_entry.is_cog == original.imageentry.is_cog
+    assert list(
+        image_entry.bandmetaentry_set.order_by('band_number').values_list('dtype', 'interpretation')
+    ) == list(
+        original.imageentry.bandmetaentry_set.order_by('band_number').values_list(
+            'dtype', 'interpretation'
+        )
+    )
+    assert FileMetadata.objects.filter(checksum=checksum).count() == 1
+
+
 @pytest.mark.parametrize(
     'name',
     [
@@ -135,10 +273,25 @@ def test_multi_file_raster():
 @pytest.mark.django_db(transaction=True)
 def test_raster_footprint(name):
     raster = _make_raster_from_datastore(name)
-    populate_raster_footprint(raster.id)
-    meta = raster.rastermetaentry
-    assert meta.footprint
+    # The footprint is populated on ingest
+    meta = RasterMetaEntry.objects.get(parent_raster=raster)
     assert meta.footprint != meta.outline
+    assert meta.footprint.intersects(meta.outline)
+
+    raster.refresh_from_db()
+    assert raster.status == Status.SUCCEEDED
+    footprint = meta.footprint
+
+    # The footprint can be computed again on its own
+    meta.footprint = None
+    meta.save(update_fields=['footprint'])
+    populate_raster_footprint(raster.id)
+    meta.refresh_from_db()
+    assert meta.footprint.equals(footprint)
+    # Populating the raster again does not reset the footprint to the outline
+    populate_raster_entry(raster)
+    meta.refresh_from_db()
+    assert meta.footprint.equals(footprint)
 
 
 def _run_kwcoco_import(demo):
@@ -164,14 +317,22 @@ def test_kwcoco_basic_demo():
 
     kwds = _run_kwcoco_import(demo)
     assert kwds.image_set.count == demo['n_images']
+    kwds.refresh_from_db()
+    assert kwds.progress == 1.0
     annotations = [a for anns in kwds.image_set.get_all_annotations().values() for a in anns]
     assert len(annotations) == demo['n_annotations']
-    # Trigger save event and make sure original images were deleted
+    # Bulk inserted segmentations are linked to their annotations and subclass rows
+    for annotation in annotations:
+        if not hasattr(annotation, 'segmentation'):
+            continue
+        if annotation.segmentation.get_type() == 'PolygonSegmentation':
+            assert annotation.segmentation.polygonsegmentation.feature is not None
+    # Trigger save event and make sure unchanged images and annotations are kept
     image_file_ids = [im.image_file.id for im in kwds.image_set.images.all()]
+    annotation_ids = {a.id for a in annotations}
     kwds.save()
-    for id in image_file_ids:
-        with pytest.raises(ImageFile.DoesNotExist):
-            ImageFile.objects.get(id=id)
+    assert {im.image_file.id for im in kwds.image_set.images.all()} == set(image_file_ids)
+    assert set(Annotation.objects.values_list('id', flat=True)) == annotation_ids
     # Now do same for delete
     image_file_ids = [im.image_file.id for im in kwds.image_set.images.all()]
     kwds.delete()
@@ -180,6 +341,183 @@ def test_kwcoco_basic_demo():
             ImageFile.objects.get(id=id)
 
 
+@pytest.mark.django_db(transaction=True)
+def test_kwcoco_annotations_in_window():
+    kwds = _run_kwcoco_import({'archive': 'demodata.zip', 'spec': 'demo.kwcoco.json'})
+    assert not Annotation.objects.filter(bounds__isnull=True).exists()
+    image = kwds.image_set.images.first()
+    everything = (0, 0, image.width, image.height)
+    assert image.get_annotations_in_window(everything).count() == image.annotation_set.count()
+    assert kwds.image_set.get_annotations_in_window(everything).count() == (
+        Annotation.objects.filter(image__imageset=kwds.image_set).count()
+    )
+    # Only annotations whose extent intersects the window are found
+    annotation = image.annotation_set.first()
+    xmin, ymin, xmax, ymax = annotation.bounds.extent
+    found = image.get_annotations_in_window((xmin, ymin, xmax, ymax))
+    assert annotation in found
+    for other in image.annotation_set.exclude(pk__in=found):
+        oxmin, oymin, oxmax, oymax = other.bounds.extent
+        assert oxmax < xmin or oxmin > xmax or oymax < ymin or oymin > ymax
+    assert not image.get_annotations_in_window((-20, -20, -10, -10)).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_annotation_bounds_on_save():
+    image_file = factories.ImageFileFactory(
+        file__file__filename=SampleFiles[0]['name'],
+        file__file__from_path=datastore.fetch(SampleFiles[0]['name']),
+    )
+    image = ImageEntry.objects.get(image_file=image_file)
+    # Annotations created outside of the KWCOCO ETL are found by region
+    annotation = Annotation.objects.create(image=image, label='created')
+    PolygonSegmentation.objects.create(
+        annotation=annotation,
+        feature=MultiPolygon(Polygon.from_bbox((10, 20, 30, 40)), srid=0),
+    )
+    assert annotation in image.get_annotations_in_window((0, 0, 15, 25))
+    assert not image.get_annotations_in_window((50, 50, 60, 60)).exists()
+    # Editing the geometry moves the bounds
+    annotation.refresh_from_db()
+    annotation.line = LineString((50, 50), (55, 55), srid=0)
+    annotation.save()
+    assert annotation in image.get_annotations_in_window((50, 50, 60, 60))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_kwcoco_incremental_reimport(tmp_path):
+    kwds = _run_kwcoco_import({'archive': 'demodata.zip', 'spec': 'demo.kwcoco.json'})
+    image_file_ids = {im.image_file.id for im in kwds.image_set.images.all()}
+    annotation_ids = set(Annotation.objects.values_list('id', flat=True))
+
+    # Relabel a single annotation
+    with open(datastore.fetch('demo.kwcoco.json')) as f:
+        spec = json.load(f)
+    spec['annotations'][0]['bbox'] = [0, 0, 5, 5]
+    spec_path = tmp_path / 'demo.kwcoco.json'
+    spec_path.write_text(json.dumps(spec))
+    with open(spec_path, 'rb') as f:
+        kwds.spec_file.file.save('demo.kwcoco.json', f)
+    kwds.save()
+
+    assert {im.image_file.id for im in kwds.image_set.images.all()} == image_file_ids
+    new_annotation_ids = set(Annotation.objects.values_list('id', flat=True))
+    assert len(new_annotation_ids) == len(annotation_ids)
+    assert len(new_annotation_ids - annotation_ids) == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_kwcoco_tar_archive(tmp_path):
+    # Repack the demo images as a compressed tar archive
+    tar_path = str(tmp_path / 'demodata.tar.gz')
+    with zipfile.ZipFile(datastore.fetch('demodata.zip')) as zf, tarfile.open(
+        tar_path, 'w:gz'
+    ) as tf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            member = tarfile.TarInfo(info.filename)
+            member.size = info.file_size
+            tf.addfile(member, zf.open(info))
+    kwds = factories.KWCOCOArchiveFactory(
+        image_archive__file__filename='demodata.tar.gz',
+        image_archive__file__from_path=tar_path,
+        spec_file__file__filename='demo.kwcoco.json',
+        spec_file__file__from_path=datastore.fetch('demo.kwcoco.json'),
+    )
+    assert kwds.image_set.count == 3
+    # The checksum is computed while the images are streamed into storage
+    for image_entry in kwds.image_set.images.all():
+        checksum_file = image_entry.image_file.file
+        assert checksum_file.checksum == checksum_file.get_checksum()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_kwcoco_without_archive(tmp_path):
+    # Without an archive, images are read from the absolute paths in the spec
+    with zipfile.ZipFile(datastore.fetch('demodata.zip')) as zf:
+        zf.extractall(tmp_path)
+    with open(datastore.fetch('demo.kwcoco.json')) as f:
+        spec = json.load(f)
+    for img in spec['images']:
+        img['file_name'] = str(tmp_path / img['file_name'])
+    spec_path = str(tmp_path / 'absolute.kwcoco.json')
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+    kwds = factories.KWCOCOArchiveFactory(
+        image_archive=None,
+        spec_file__file__filename='absolute.kwcoco.json',
+        spec_file__file__from_path=spec_path,
+    )
+    assert kwds.image_set.count == 3
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize(
+    'demo',
+    [
+        {'archive': 'demodata.zip', 'spec': 'demo.kwcoco.json'},
+        {'archive': 'demo_rle.zip', 'spec': 'demo_rle.kwcoco.json'},
+    ],
+)
+def test_kwcoco_export_roundtrip(tmp_path, demo):
+    kwds = _run_kwcoco_import(demo)
+    spec_path = str(tmp_path / 'export.kwcoco.json')
+    archive_path = str(tmp_path / 'export.zip')
+    call_command('export_kwcoco', kwds.image_set.pk, spec_path, archive=archive_path)
+    with open(spec_path) as f:
+        spec = json.load(f)
+    assert len(spec['images']) == kwds.image_set.count
+    assert len(spec['annotations']) == Annotation.objects.count()
+
+    exported = factories.KWCOCOArchiveFactory(
+        image_archive__file__filename='export.zip',
+        image_archive__file__from_path=archive_path,
+        spec_file__file__filename='export.kwcoco.json',
+        spec_file__file__from_path=spec_path,
+    )
+    assert exported.image_set.count == kwds.image_set.count
+    original = Annotation.objects.filter(image__imageset=kwds.image_set)
+    roundtrip = Annotation.objects.filter(image__imageset=exported.image_set)
+    assert roundtrip.count() == original.count()
+    assert list(roundtrip.order_by('label').values_list('label', flat=True)) == list(
+        original.order_by('label').values_list('label', flat=True)
+    )
+    assert RLESegmentation.objects.filter(annotation__in=roundtrip).count() == (
+        RLESegmentation.objects.filter(annotation__in=original).count()
+    )
+
+
+@pytest.mark.django_db(transaction=True)
+def test_chip_archive(tmp_path):
+    kwds = _run_kwcoco_import({'archive': 'demodata.zip', 'spec': 'demo.kwcoco.json'})
+    # Task should complete synchronously
+    chips = ChipArchive.objects.create(image_set=kwds.image_set, padding=2, shard_size=4)
+    chips.refresh_from_db()
+    assert chips.status == 'success', chips.failure_reason
+    n_annotations = Annotation.objects.filter(image__imageset=kwds.image_set).count()
+    assert chips.count == n_annotations
+    assert chips.shards.count() == -(-n_annotations // 4)
+
+    with chips.index_file.yield_local_path() as path:
+        with open(path) as f:
+            index = json.load(f)
+    assert len(index['chips']) == chips.count
+    # Chips can be read straight from the shard by their offset
+    chip = index['chips'][0]
+    shard = chips.shards.get(name=chip['shard'])
+    with shard.yield_local_path() as path:
+        with open(path, 'rb') as f:
+            f.seek(chip['offset'])
+            data = f.read(chip['size'])
+    with MemoryFile(data) as memfile, memfile.open() as src:
+        assert [src.width, src.height] == chip['window'][2:]
+    # Deleting the archive cleans up all of its files
+    file_ids = [*chips.shards.values_list('pk', flat=True), chips.index_file.pk]
+    chips.delete()
+    assert not ChecksumFile.objects.filter(pk__in=file_ids).exists()
+
+
 @pytest.mark.django_db(transaction=True)
 def test_kwcoco_rle_demo():
     demo = {
@@ -207,6 +545,24 @@ def test_kwcoco_rle_demo():
 
     mask = seg.to_mask()
     assert mask.shape == (seg.height, seg.width)
+    assert seg.area() == mask.sum()
+    assert seg.iou(seg) == 1.0
+    x, y, w, h = seg.bbox()
+    assert mask[y : y + h, x : x + w].sum() == mask.sum()
+
+
+def test_rle_vectorized():
+    rng = np.random.default_rng(0)
+    masks = [rng.random((20, 30)) < p for p in (0, 0.1, 0.5, 1)]
+    masks[1][:, :5] = True  # A run that wraps across rows
+    counts = [rle_encode(mask) for mask in masks]
+    for mask, c in zip(masks, counts):
+        np.testing.assert_array_equal(rle_decode(c, mask.shape), mask)
+    ys, xs = np.nonzero(masks[1])
+    assert rle_bbox(counts[1], 30) == [0, 0, xs.max() + 1, ys.max() + 1]
+    assert rle_bbox(counts[0], 30) is None
+    expected = np.array([[(a & b).sum() / max((a | b).sum(), 1) for b in masks] for a in masks])
+    np.testing.assert_allclose(rle_ious(counts, counts, 30), expected)
 
 
 @pytest.mark.django_db(transaction=True)
@@ -222,6 +578,132 @@ def test_cog_image_conversion():
     # Task should complete synchronously
     c.refresh_from_db()
     assert c.converted_file
+    assert c.converted_file != image_file.file
+    assert c.conversion_time > 0
+    assert c.size_ratio > 0
+
+
+def test_cog_options(settings):
+    options = get_cog_options('zstd')
+    assert options[:2] == ['-of', 'COG']
+    assert 'COMPRESS=ZSTD' in options
+    assert 'NUM_THREADS=ALL_CPUS' in options
+    settings.GEODATA_COG_PROFILES = {'fast': {'COMPRESS': 'DEFLATE', 'LEVEL': 1}}
+    settings.GEODATA_COG_THREADS = 2
+    options = get_cog_options('fast')
+    assert 'LEVEL=1' in options
+    assert 'NUM_THREADS=2' in options
+    with pytest.raises(ValueError):
+        get_cog_options('unknown')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cog_conversion_skipped_for_cog(tmp_path):
+    path = str(tmp_path / 'source.tif')
+    with rasterio.open(
+        path,
+        'w',
+        driver='COG',
+        width=512,
+        height=512,
+        count=1,
+        dtype='uint8',
+        crs='EPSG:4326',
+        transform=rasterio.transform.from_origin(-107, 39, 0.001, 0.001),
+    ) as dst:
+        dst.write(np.zeros((1, 512, 512), dtype='uint8'))
+    image_file = factories.ImageFileFactory(
+        file__file__filename='source.tif',
+        file__file__from_path=path,
+    )
+    image_entry = ImageEntry.objects.get(image_file=image_file)
+    assert image_entry.is_cog
+    assert not image_entry.cog_errors
+    c = ConvertedImageFile.objects.create(source_image=image_entry)
+    c.refresh_from_db()
+    assert c.converted_file == image_file.file
+    assert c.is_source_alias
+    assert c.size_ratio == 1.0
+    # The file of an earlier conversion is removed when the source is aliased
+    previous = factories.ChecksumFileFactory()
+    c.converted_file = previous
+    c.is_source_alias = False
+    c.skip_signal = True
+    c.save()
+    convert_to_cog(c)
+    c.refresh_from_db()
+    assert c.converted_file == image_file.file
+    assert c.is_source_alias
+    assert not ChecksumFile.objects.filter(pk=previous.pk).exists()
+    # Deleting the source keeps the user's file that the conversion pointed to
+    image_file.delete()
+    assert not ConvertedImageFile.objects.filter(pk=c.pk).exists()
+    assert ChecksumFile.objects.filter(pk=c.converted_file.pk).exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_cog_validation_of_striped_image(tmp_path):
+    path = str(tmp_path / 'striped.tif')
+    with rasterio.open(
+        path,
+        'w',
+        driver='GTiff',
+        width=1024,
+        height=1024,
+        count=1,
+        dtype='uint8',
+        crs='EPSG:4326',
+        transform=rasterio.transform.from_origin(-107, 39, 0.001, 0.001),
+    ) as dst:
+        dst.write(np.zeros((1, 1024, 1024), dtype='uint8'))
+    image_file = factories.ImageFileFactory(
+        file__file__filename='striped.tif',
+        file__file__from_path=path,
+    )
+    image_entry = ImageEntry.objects.get(image_file=image_file)
+    assert image_entry.is_cog is False
+    assert 'not tiled' in image_entry.cog_errors
+    assert 'no overviews' in image_entry.cog_errors
+
+
+@pytest.mark.django_db(transaction=True)
+def test_subsampling_tiled_source(tmp_path):
+    # Tiled sources are subsampled directly without converting to COG
+    path = str(tmp_path / 'tiled.tif')
+    data = np.arange(512 * 512, dtype=np.uint16).reshape((1, 512, 512))
+    with rasterio.open(
+        path,
+        'w',
+        driver='GTiff',
+        width=512,
+        height=512,
+        count=1,
+        dtype=data.dtype,
+        crs='EPSG:4326',
+        transform=rasterio.transform.from_origin(-107, 39, 0.001, 0.001),
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+    ) as dst:
+        dst.write(data)
+    image_file = factories.ImageFileFactory(
+        file__file__filename='tiled.tif',
+        file__file__from_path=path,
+    )
+    img = ImageEntry.objects.get(image_file=image_file)
+    sub = SubsampledImage(
+        source_image=img,
+        sample_type='pixel box',
+        sample_parameters={'umin': 10, 'umax': 110, 'vmin': 20, 'vmax': 70},
+    )
+    sub.skip_signal = True
+    sub.save()
+    populate_subsampled_image(sub)
+    sub.refresh_from_db()
+    assert not ConvertedImageFile.objects.filter(source_image=img).exists()
+    with sub.data.yield_local_path() as out_path, rasterio.open(out_path) as src:
+        assert (src.width, src.height) == (100, 50)
+        assert (src.read(1) == data[0, 20:70, 10:110]).all()
 
 
 @pytest.mark.django_db(transaction=True)
@@ -274,5 +756,11 @@ def test_subsampling():
     a = Annotation.objects.get(image=img.id)  # Should be only one
     sub = create_subsampled(img, 'annotation', {'id': a.id})
     assert sub.data
+    assert sub.cache_key
+    # Different parameters for the same subsample share the stored result
+    shared = create_subsampled(img, 'annotation', {'id': a.id, 'outline': False})
+    assert shared.pk != sub.pk
+    assert shared.cache_key == sub.cache_key
+    assert shared.data == sub.data
     sub = create_subsampled(img, 'annotation', {'id': a.id, 'outline': True})
     assert sub.data
@@ -47,6 +47,12 @@ urlpatterns = [
     path('api/geosearch/geojson/extent', api.search.search_geojson_extent),
     path('api/geosearch/raster/geojson/extent', api.search.search_geojson_extent_raster),
     path('api/geosearch/geometry/geojson/extent', api.search.search_geojson_extent_geometry),
+    path('api/geosearch/fmv/frames', api.search.search_fmv_frames),
+    path(
+        'api/geosearch/imagery/annotations',
+        api.search.SearchAnnotationView.as_view(),
+        name='annotation-search',
+    ),
     path('api/geosearch', api.search.SearchSpatialEntryView.as_view()),
     #############
     # Other
@@ -95,6 +101,11 @@ urlpatterns = [
         api.get.GetImageSet.as_view(),
         name='image-set',
     ),
+    path(
+        'api/geodata/imagery/image_set/<int:pk>/kwcoco',
+        api.download.download_image_set_kwcoco,
+        name='image-set-kwcoco',
+    ),
     path(
         'api/geodata/imagery/raster/<int:pk>',
         api.get.GetRasterMetaEntry.as_view(),
@@ -138,6 +149,11 @@ urlpatterns = [
         api.download.download_cog_file,
         name='cog-data',
     ),
+    path(
+        'api/geoprocess/imagery/<int:pk>/subsample',
+        api.download.download_image_entry_subsample,
+        name='image-subsample',
+    ),
     path(
         'api/geoprocess/imagery/subsample',
         api.post.CreateSubsampledImage.as_view(),
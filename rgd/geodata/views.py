@@ -9,7 +9,7 @@ from rgd.geodata import permissions
 
 from .api import search
 from .filters import SpatialEntryFilter
-from .models.common import SpatialEntry
+from .models.common import SpatialEntry, get_simplify_tolerance
 from .models.fmv.base import FMVEntry
 from .models.geometry import GeometryEntry
 from .models.imagery.base import RasterMetaEntry
@@ -64,6 +64,13 @@ class _SpatialDetailView(DetailView):
         permissions.check_read_perm(self.request.user, obj)
         return obj
 
+    def _get_tolerance(self):
+        try:
+            return get_simplify_tolerance(self.request.GET)
+        except ValueError:
+            # Malformed parameters fall back to full resolution
+            return None
+
     def _get_extent(self):
         extent = {
             'count': 0,
@@ -102,9 +109,12 @@ class FMVEntryDetailView(_SpatialDetailView):
         extent = super()._get_extent()
         if self.object.ground_union is not None:
             # All or none of these will be set, only check one
-            extent['collect'] = self.object.ground_union.json
+            # The frames are mapped to `frame_numbers` so they are never simplified
+            extent['collect'] = self.object.get_simplified_geometry(
+                'ground_union', self._get_tolerance()
+            ).json
             extent['ground_frames'] = self.object.ground_frames.json
-            extent['frame_numbers'] = self.object._blob_to_array(self.object.frame_numbers)
+            extent['frame_numbers'] = self.object._blob_to_array(self.object.frame_numbers).tolist()
         return extent
 
     def get_context_data(self, *args, **kwargs):
@@ -118,7 +128,7 @@ class GeometryEntryDetailView(_SpatialDetailView):
 
     def _get_extent(self):
         extent = super()._get_extent()
-        extent['data'] = self.object.data.json
+        extent['data'] = self.object.get_simplified_geometry('data', self._get_tolerance()).json
         return extent
 
 